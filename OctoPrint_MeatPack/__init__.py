@@ -4,15 +4,26 @@ from __future__ import absolute_import, unicode_literals
 import octoprint.plugin
 from octoprint.util.platform import get_os, set_close_exec
 from octoprint.settings import settings
+from octoprint.events import Events
 import flask
 import serial
 import os
+import threading
 from OctoPrint_MeatPack.packing_serial import PackingSerial
+from OctoPrint_MeatPack.pack_cache import PackCache, hash_file
+from OctoPrint_MeatPack.link_monitor import format_report
+from OctoPrint_MeatPack.pack_profiler import format_profile, profile_file
+from OctoPrint_MeatPack.meatpack import PackEngineDefault
 
 __author__ = "Scott Mudge <mail@scottmudge.com, https://scottmudge.com>"
 __license__ = "BSD-3-Clause License - https://raw.githubusercontent.com/scottmudge/OctoPrint-MeatPack/master/LICENSE"
 __copyright__ = "Copyright (C) 2020-2025 Scott Mudge - Released under terms of the BSD-3-Clause License"
 
+# Scripts OctoPrint runs around its prints
+JobScriptTags = frozenset("script:{}".format(name) for name in ("beforePrintStarted", "afterPrintDone",
+                                                                "afterPrintCancelled", "afterPrintPaused",
+                                                                "beforePrintResumed"))
+
 
 class MeatPackPlugin(
     octoprint.plugin.SettingsPlugin,
@@ -20,7 +31,9 @@ class MeatPackPlugin(
     octoprint.plugin.TemplatePlugin,
     octoprint.plugin.AssetPlugin,
     octoprint.plugin.SimpleApiPlugin,
-    octoprint.plugin.ShutdownPlugin
+    octoprint.plugin.ShutdownPlugin,
+    octoprint.plugin.EventHandlerPlugin,
+    octoprint.plugin.BlueprintPlugin
 ):
     """MeatPack plugin - provides various utilities for custom Prusa Firmware.
 
@@ -36,7 +49,30 @@ class MeatPackPlugin(
         octoprint.plugin.AssetPlugin.__init__(self)
         octoprint.plugin.SimpleApiPlugin.__init__(self)
         octoprint.plugin.ShutdownPlugin.__init__(self)
+        octoprint.plugin.EventHandlerPlugin.__init__(self)
+        octoprint.plugin.BlueprintPlugin.__init__(self)
         self._serial_obj = None
+        self._pack_cache = None
+        self._last_link_report = None
+        self._file_profile = None
+
+# -------------------------------------------------------------------------------
+    def gcode_queuing_hook(self, comm_instance, phase, cmd, cmd_type, gcode, subcode=None, tags=None, *args,
+                           **kwargs):
+        # While a packed stream is sent, OctoPrint's own prints are refused: their lines, the scripts around them and
+        # "M110" (which would reset the device's line number in the middle of the stream) are dropped
+        if not self._streaming():
+            return None
+        tags = tags or set()
+        if gcode == "M110" or "source:file" in tags or not tags.isdisjoint(JobScriptTags):
+            self._logger.info("Not sending {} while a packed stream is being sent".format(cmd))
+            return None,
+        return None
+
+# -------------------------------------------------------------------------------
+    def _streaming(self):
+        streamer = self._serial_obj.get_packed_stream() if self._serial_obj is not None else None
+        return streamer is not None and streamer.running
 
 # -------------------------------------------------------------------------------
     def serial_factory_hook(self, comm_instance, port, baudrate, read_timeout, *args, **kwargs):
@@ -81,17 +117,90 @@ class MeatPackPlugin(
         self._serial_obj.log_transmission_stats = self._settings.get_boolean(["logTransmissionStats"])
         self._serial_obj.play_song_on_print_complete = self._settings.get_boolean(["playSongOnPrintComplete"])
         self._serial_obj.packing_enabled = self._settings.get_boolean(["enableMeatPack"])
+        self._serial_obj.adaptive_packing = self._settings.get_boolean(["adaptivePacking"])
         self._serial_obj.omit_all_spaces = self._settings.get_boolean(["omitSpaces"])
+        self._serial_obj.packing_engine = self._settings.get(["packingEngine"])
+        self._serial_obj.minimize_level = self._settings.get_int(["minimizeGcode"])
+        self._serial_obj.pipeline_queue_size = self._settings.get_int(["pipelineQueueSize"])
+        self._serial_obj.pipelined_writes = self._settings.get_boolean(["pipelineWrites"])
+        self._serial_obj.sync_backlog_size = self._settings.get_int(["syncBacklogSize"])
+        self._serial_obj.sync_backlog_timeout = self._settings.get_float(["syncBacklogTimeout"])
+        self._serial_obj.stream_window = self._settings.get_int(["streamWindow"])
+        self._serial_obj.collect_metrics = self._settings.get_boolean(["collectMetrics"])
+        self._serial_obj.profile_packing = self._settings.get_boolean(["profilePacking"])
+        self._serial_obj.monitor_link = self._settings.get_boolean(["monitorLink"])
+        self._serial_obj.link_saturation_threshold = self._settings.get_float(["linkSaturationThreshold"]) / 100.0
 
 # -------------------------------------------------------------------------------
     def get_settings_defaults(self):
         return dict(
             enableMeatPack=True,
+            adaptivePacking=False,
             logTransmissionStats=True,
             playSongOnPrintComplete=False,
-            omitSpaces=True
+            omitSpaces=True,
+            packingEngine=PackEngineDefault,
+            minimizeGcode=0,
+            prepackCacheSizeMB=256,
+            pipelineWrites=False,
+            pipelineQueueSize=256,
+            syncBacklogSize=256,
+            syncBacklogTimeout=10.0,
+            streamWindow=4,
+            collectMetrics=False,
+            profilePacking=False,
+            monitorLink=False,
+            linkSaturationThreshold=95.0
         )
 
+# -------------------------------------------------------------------------------
+    def get_pack_cache(self):
+        if self._pack_cache is None:
+            self._pack_cache = PackCache(os.path.join(self.get_plugin_data_folder(), "prepacked"), self._logger)
+        self._pack_cache.max_bytes = self._settings.get_int(["prepackCacheSizeMB"]) * 1024 * 1024
+        return self._pack_cache
+
+# -------------------------------------------------------------------------------
+    def _get_local_file_hash(self, path):
+        metadata = self._file_manager.get_metadata("local", path) or dict()
+        file_hash = metadata.get("hash")
+        if not file_hash:
+            file_hash = hash_file(self._file_manager.path_on_disk("local", path))
+        return file_hash
+
+# -------------------------------------------------------------------------------
+    def on_event(self, event, payload):
+        if self._serial_obj is not None:
+            if event == Events.PRINT_STARTED:
+                if self._streaming():
+                    self._logger.warning("A print was started while a packed stream is being sent, cancelling it.")
+                    self._printer.cancel_print()
+                self._serial_obj.begin_link_report()
+                profile = self._serial_obj.get_packing_profile()
+                if profile is not None:
+                    profile.reset()
+            elif event in (Events.PRINT_DONE, Events.PRINT_FAILED, Events.PRINT_CANCELLED):
+                self._finish_link_report(event, payload)
+                self._log_packing_profile(payload)
+
+# -------------------------------------------------------------------------------
+    def _finish_link_report(self, event, payload):
+        report = self._serial_obj.get_link_report()
+        if report is None:
+            return
+        report['event'] = event
+        report['path'] = payload.get("path") if payload is not None else None
+        self._last_link_report = report
+        self._logger.info("Print {}: {}".format(report['path'], format_report(report)))
+
+# -------------------------------------------------------------------------------
+    def _log_packing_profile(self, payload):
+        profile = self._serial_obj.get_packing_profile()
+        if profile is None:
+            return
+        self._logger.info("Packing profile of {}:\n{}".format(payload.get("path") if payload is not None else None,
+                                                             format_profile(profile.summary(), top=10)))
+
 # -------------------------------------------------------------------------------
     def get_assets(self):
         return {
@@ -130,11 +239,131 @@ class MeatPackPlugin(
 
 # -------------------------------------------------------------------------------
     def on_api_get(self, request):
+        metrics = self._serial_obj.get_metrics()
+        profile = self._serial_obj.get_packing_profile()
+        streamer = self._serial_obj.get_packed_stream()
         return flask.jsonify(
             transmissionStats=self._serial_obj.get_transmission_stats(),
-            enabled=self._serial_obj.packing_enabled
+            enabled=self._serial_obj.packing_enabled,
+            metrics=metrics.snapshot() if metrics is not None else None,
+            linkReport=self._last_link_report,
+            packingProfile=profile.summary() if profile is not None else None,
+            fileProfile=self._file_profile,
+            packedStream=streamer.status() if streamer is not None else None
         )
 
+# -------------------------------------------------------------------------------
+    def get_api_commands(self):
+        return dict(
+            resetMetrics=[],
+            resetProfile=[],
+            profileFile=["path"],
+            streamFile=["path"],
+            cancelStream=[]
+        )
+
+# -------------------------------------------------------------------------------
+    def on_api_command(self, command, data):
+        if command == "resetMetrics":
+            metrics = self._serial_obj.get_metrics()
+            if metrics is not None:
+                metrics.reset()
+        elif command == "resetProfile":
+            profile = self._serial_obj.get_packing_profile()
+            if profile is not None:
+                profile.reset()
+        elif command == "profileFile":
+            # Profiles a file in local storage, as it would be sent with the current settings
+            path = data.get("path")
+            if not self._file_manager.file_exists("local", path):
+                return flask.make_response("File not found: {}".format(path), 404)
+            file_profile = self._file_profile
+            if file_profile is not None and file_profile["state"] == "profiling":
+                return flask.make_response("{} is being profiled already.".format(file_profile["path"]), 409)
+            # Reading a large file takes a while. The result is sent as a plugin message, and returned as
+            # fileProfile by on_api_get().
+            self._file_profile = dict(path=path, state="profiling", profile=None, error=None)
+            thread = threading.Thread(target=self._profile_file, args=(path,))
+            thread.daemon = True
+            thread.start()
+        elif command == "streamFile":
+            # Sends a file in local storage as a packed stream, instead of OctoPrint sending it line by line
+            path = data.get("path")
+            if not self._file_manager.file_exists("local", path):
+                return flask.make_response("File not found: {}".format(path), 404)
+            if not self._can_stream():
+                return flask.make_response("The printer isn't connected and idle.", 409)
+            # Optionally resumed from a layer, a line or a byte position of the file
+            resume = dict(layer=data.get("layer"), source_line=data.get("line"), position=data.get("position"))
+            thread = threading.Thread(target=self._stream_file, args=(path, resume))
+            thread.daemon = True
+            thread.start()
+        elif command == "cancelStream":
+            if self._serial_obj is not None:
+                self._serial_obj.stop_packed_stream()
+        return flask.jsonify(result="ok")
+
+# -------------------------------------------------------------------------------
+    def _profile_file(self, path):
+        try:
+            profile = profile_file(self._file_manager.path_on_disk("local", path),
+                                   no_spaces=self._settings.get_boolean(["omitSpaces"]),
+                                   minimize=self._settings.get_int(["minimizeGcode"]))
+            self._file_profile = dict(path=path, state="done", profile=profile.summary(), error=None)
+        except Exception as e:
+            # Whatever went wrong, the next profileFile command mustn't be refused as if this one was still running
+            self._logger.info("Can't profile {}: {}".format(path, e))
+            self._file_profile = dict(path=path, state="failed", profile=None, error=str(e))
+        self._plugin_manager.send_plugin_message(self._identifier, dict(message="fileProfile",
+                                                                        fileProfile=self._file_profile))
+
+# -------------------------------------------------------------------------------
+    def _can_stream(self):
+        # is_ready() is False while OctoPrint prints, and while a print is paused, being cancelled, etc.
+        return self._serial_obj is not None and self._printer.is_ready()
+
+# -------------------------------------------------------------------------------
+    def _stream_file(self, path, resume):
+        # Packing the stream takes a few seconds for large files, the first time
+        no_spaces = self._settings.get_boolean(["omitSpaces"])
+        file_hash = self._get_local_file_hash(path)
+        cache = self.get_pack_cache()
+        try:
+            if cache.build_stream(self._file_manager.path_on_disk("local", path), file_hash, no_spaces) is None:
+                self._logger.info("{} is being packed already".format(path))
+                return
+            stream = cache.open_stream(file_hash, no_spaces)
+            if stream is None:
+                return
+            # A print may have been started while the stream was packed
+            if not self._can_stream():
+                stream.close()
+                self._logger.info("Not streaming {}, the printer isn't idle anymore".format(path))
+                return
+            try:
+                streamer = self._serial_obj.start_packed_stream(stream, stream.resume_line(**resume))
+            except Exception:
+                stream.close()
+                raise
+            # The device counts the stream's line numbers, OctoPrint its own. Both start over once it's done.
+            streamer.wait()
+            if self._printer.is_operational():
+                self._printer.commands("M110 N0")
+        except (IOError, OSError, ValueError) as e:
+            self._logger.info("Can't stream {}: {}".format(path, e))
+
+# -------------------------------------------------------------------------------
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def get_metrics_exposition(self):
+        metrics = self._serial_obj.get_metrics() if self._serial_obj is not None else None
+        if metrics is None:
+            return flask.make_response("Metrics collection is disabled.\n", 404)
+        return flask.Response(metrics.exposition(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# -------------------------------------------------------------------------------
+    def is_blueprint_csrf_protected(self):
+        return True
+
 # -------------------------------------------------------------------------------
     def get_version(self):
         return self._plugin_version
@@ -164,6 +393,7 @@ class MeatPackPlugin(
         cur_logging_param = self._settings.get_boolean(["logTransmissionStats"])
         cur_song_param = self._settings.get_boolean(["playSongOnPrintComplete"])
         cur_nosp_param = self._settings.get_boolean(["omitSpaces"])
+        cur_engine_param = self._settings.get(["packingEngine"])
 
         if self._serial_obj.packing_enabled != cur_packing_param:
             self._logger.info("G-Code compression changed, now {}... synchronizing with device."
@@ -181,6 +411,9 @@ class MeatPackPlugin(
             self._logger.info("No whitespace setting changed: {}".format(
                 "Enabled" if cur_nosp_param else "Disabled"))
 
+        if self._serial_obj.packing_engine != cur_engine_param:
+            self._logger.info("Packing engine changed: {}".format(cur_engine_param))
+
         self.sync_settings_with_serial_obj()
 
 # -------------------------------------------------------------------------------
@@ -203,5 +436,7 @@ def __plugin_load__():
     global __plugin_hooks__
     __plugin_hooks__ = {"octoprint.comm.transport.serial.factory":
                             __plugin_implementation__.serial_factory_hook,
+                        "octoprint.comm.protocol.gcode.queuing":
+                            __plugin_implementation__.gcode_queuing_hook,
                         "octoprint.plugin.softwareupdate.check_config":
                             __plugin_implementation__.get_update_information}
@@ -0,0 +1,393 @@
+/* Compiled MeatPack packer
+ * Optional extension implementing Packer.pack_line() (the table engine) and the packing of whole blocks of lines.
+ * Output is byte-identical to the pure Python table engine, which is used whenever this module isn't built. The
+ * character and case tables are handed over by meatpack.py (set_tables()), so they are only defined there.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdio.h>
+#include <string.h>
+
+typedef struct {
+    int ready;
+    unsigned char packable[256];
+    unsigned char value[256];
+    unsigned char case_fix[256];
+} ModeTables;
+
+/* Indexed by no-spaces mode */
+static ModeTables mode_tables[2];
+
+/* Bytes a line may grow by when unified (a checksum rewritten as "*255\n") and padded to an even length */
+#define LINE_GROWTH 8
+
+/* Lines up to this length are packed in stack buffers */
+#define STACK_LINE_LENGTH 256
+
+/* Packed size of a line of the given length, at most (three bytes per pair of characters) */
+#define PACKED_SIZE(len) ((((len) + LINE_GROWTH) / 2 + 1) * 3)
+
+
+/* ------------------------------------------------------------------------------- */
+static int is_space(unsigned char c)
+{
+    /* What bytes.rstrip() removes */
+    return c == ' ' || c == '\t' || c == '\n' || c == '\r' || c == '\x0b' || c == '\x0c';
+}
+
+
+/* -------------------------------------------------------------------------------
+ * Case fixing, whitespace removal and checksum update of a G-line, in place. Same as
+ * meatpack._unified_method_bytes(): only the first "G" is looked at, and a line that doesn't change keeps its
+ * checksum as it is. buf needs room for len + LINE_GROWTH bytes. Returns the new length.
+ */
+static Py_ssize_t unify(unsigned char *buf, Py_ssize_t len, const ModeTables *tables)
+{
+    const unsigned char *g = memchr(buf, 'G', (size_t)len);
+    Py_ssize_t idx, out = 0, cs_idx = -1;
+    int changed = 0;
+
+    if (g == NULL || g + 1 >= buf + len || g[1] < '0' || g[1] > '9')
+        return len;
+
+    for (idx = 0; idx < len; idx++) {
+        unsigned char c = buf[idx];
+        unsigned char fixed;
+        if (c == ' ') {
+            changed = 1;
+            continue;
+        }
+        fixed = tables->case_fix[c];
+        changed |= fixed != c;
+        if (fixed == '*' && cs_idx < 0)
+            cs_idx = out;
+        buf[out++] = fixed;
+    }
+
+    if (!changed)
+        return len;
+
+    if (cs_idx >= 0) {
+        unsigned char checksum = 0;
+        for (idx = 0; idx < cs_idx; idx++)
+            checksum ^= buf[idx];
+        out = cs_idx + sprintf((char *)buf + cs_idx, "*%u\n", (unsigned)checksum);
+    }
+    return out;
+}
+
+
+/* -------------------------------------------------------------------------------
+ * Packs one line (with its newline, if any), see Packer.pack_line(). With crlf set, a line ending in \r\n is packed
+ * as if it ended in \n. work needs room for len + LINE_GROWTH bytes, out for PACKED_SIZE(len). Returns the packed
+ * length.
+ */
+static Py_ssize_t pack_one(const unsigned char *line, Py_ssize_t len, const ModeTables *tables, int crlf,
+                           unsigned char *work, unsigned char *out)
+{
+    const unsigned char *packable = tables->packable;
+    const unsigned char *value = tables->value;
+    const unsigned char *comment;
+    unsigned char *pos = out;
+    Py_ssize_t idx, n = len;
+
+    memcpy(work, line, (size_t)len);
+    if (crlf && n >= 2 && work[n - 2] == '\r' && work[n - 1] == '\n')
+        work[--n - 1] = '\n';
+
+    if (n < 2 || work[0] == ';' || work[0] == '\n' || work[0] == '\r')
+        return 0;
+
+    comment = memchr(work, ';', (size_t)n);
+    if (comment != NULL) {
+        n = comment - work;
+        while (n > 0 && is_space(work[n - 1]))
+            n--;
+        work[n++] = '\n';
+    }
+
+    n = unify(work, n, tables);
+
+    /* Pad odd-length lines with a benign \n */
+    if (n & 1)
+        work[n++] = '\n';
+
+    for (idx = 0; idx < n; idx += 2) {
+        unsigned char c1 = work[idx];
+        unsigned char c2 = work[idx + 1];
+        if (packable[c1]) {
+            if (packable[c2]) {
+                *pos++ = (unsigned char)(((value[c2] & 0xF) << 4) | (value[c1] & 0xF));
+            }
+            else {
+                *pos++ = (unsigned char)(0xF0 | (value[c1] & 0xF));
+                *pos++ = c2;
+            }
+        }
+        else if (packable[c2]) {
+            *pos++ = (unsigned char)(((value[c2] & 0xF) << 4) | 0xF);
+            *pos++ = c1;
+        }
+        else {
+            *pos++ = 0xFF;
+            *pos++ = c1;
+            *pos++ = c2;
+        }
+    }
+    return pos - out;
+}
+
+
+/* ------------------------------------------------------------------------------- */
+static const ModeTables *get_tables(int no_spaces)
+{
+    const ModeTables *tables = &mode_tables[no_spaces ? 1 : 0];
+    if (!tables->ready) {
+        PyErr_SetString(PyExc_RuntimeError, "packing tables not set, see set_tables()");
+        return NULL;
+    }
+    return tables;
+}
+
+
+/* ------------------------------------------------------------------------------- */
+PyDoc_STRVAR(pack_line_doc,
+"pack_line(line, no_spaces=False)\n\n"
+"Packs a line (bytes-like) the same way as Packer.pack_line() and returns the packed bytes.");
+
+static PyObject *py_pack_line(PyObject *self, PyObject *args)
+{
+    unsigned char work_stack[STACK_LINE_LENGTH + LINE_GROWTH];
+    unsigned char out_stack[PACKED_SIZE(STACK_LINE_LENGTH)];
+    unsigned char *work = work_stack;
+    unsigned char *out = out_stack;
+    const ModeTables *tables;
+    PyObject *result = NULL;
+    Py_buffer line;
+    int no_spaces = 0;
+    Py_ssize_t n;
+
+    if (!PyArg_ParseTuple(args, "y*|p:pack_line", &line, &no_spaces))
+        return NULL;
+
+    tables = get_tables(no_spaces);
+    if (tables == NULL)
+        goto done;
+
+    if (line.len > STACK_LINE_LENGTH) {
+        work = PyMem_Malloc((size_t)(line.len + LINE_GROWTH));
+        out = PyMem_Malloc((size_t)PACKED_SIZE(line.len));
+        if (work == NULL || out == NULL) {
+            PyErr_NoMemory();
+            goto done;
+        }
+    }
+
+    n = pack_one((const unsigned char *)line.buf, line.len, tables, 0, work, out);
+    result = PyBytes_FromStringAndSize((const char *)out, n);
+
+done:
+    if (work != work_stack)
+        PyMem_Free(work);
+    if (out != out_stack)
+        PyMem_Free(out);
+    PyBuffer_Release(&line);
+    return result;
+}
+
+
+/* ------------------------------------------------------------------------------- */
+PyDoc_STRVAR(pack_lines_doc,
+"pack_lines(data, no_spaces=False)\n\n"
+"Packs a block of lines (bytes-like, split at \\n) and returns the packed lines concatenated. Same as packing\n"
+"every line (with its \\n) with pack_line(), and the text after the last \\n, if any, as it is. The GIL is\n"
+"released while packing.");
+
+static PyObject *py_pack_lines(PyObject *self, PyObject *args)
+{
+    const ModeTables *tables;
+    const unsigned char *pos, *end, *newline;
+    unsigned char *work = NULL, *out = NULL;
+    PyObject *result = NULL;
+    Py_ssize_t out_len = 0, out_size, longest = 0;
+    Py_buffer data;
+    int no_spaces = 0, failed = 0;
+
+    if (!PyArg_ParseTuple(args, "y*|p:pack_lines", &data, &no_spaces))
+        return NULL;
+
+    tables = get_tables(no_spaces);
+    if (tables == NULL)
+        goto done;
+
+    /* g-code packs to well below its size, so the output buffer rarely has to grow */
+    out_size = data.len + 64;
+
+    Py_BEGIN_ALLOW_THREADS
+    pos = (const unsigned char *)data.buf;
+    end = pos + data.len;
+    out = PyMem_RawMalloc((size_t)out_size);
+    failed = out == NULL;
+
+    while (!failed && pos < end) {
+        Py_ssize_t len;
+        newline = memchr(pos, '\n', (size_t)(end - pos));
+        len = newline != NULL ? newline - pos + 1 : end - pos;
+
+        if (len > longest) {
+            PyMem_RawFree(work);
+            work = PyMem_RawMalloc((size_t)(len + LINE_GROWTH));
+            longest = len;
+            if (work == NULL) {
+                failed = 1;
+                break;
+            }
+        }
+        if (out_len + PACKED_SIZE(len) > out_size) {
+            unsigned char *grown;
+            out_size = (out_size + PACKED_SIZE(len)) * 2;
+            grown = PyMem_RawRealloc(out, (size_t)out_size);
+            if (grown == NULL) {
+                failed = 1;
+                break;
+            }
+            out = grown;
+        }
+
+        out_len += pack_one(pos, len, tables, 0, work, out + out_len);
+        pos += len;
+    }
+    Py_END_ALLOW_THREADS
+
+    if (failed)
+        PyErr_NoMemory();
+    else
+        result = PyBytes_FromStringAndSize((const char *)out, out_len);
+
+done:
+    PyMem_RawFree(work);
+    PyMem_RawFree(out);
+    PyBuffer_Release(&data);
+    return result;
+}
+
+
+/* ------------------------------------------------------------------------------- */
+PyDoc_STRVAR(pack_lines_into_doc,
+"pack_lines_into(data, out, no_spaces=False, crlf=False) -> (consumed, written)\n\n"
+"Packs the lines of data (bytes-like, e.g. a memoryview of a mapped file) like pack_lines(), writing the packed\n"
+"bytes into out (a writable buffer) instead of a new bytes object. Stops before the first line that may not fit\n"
+"into out, and returns the bytes of data consumed and of out written. With crlf set, lines ending in \\r\\n are\n"
+"packed as if they ended in \\n. The GIL is released while packing.");
+
+static PyObject *py_pack_lines_into(PyObject *self, PyObject *args)
+{
+    const ModeTables *tables;
+    const unsigned char *start, *pos, *end, *newline;
+    unsigned char *work = NULL, *out;
+    Py_ssize_t out_len = 0, longest = 0;
+    Py_buffer data, out_buf;
+    int no_spaces = 0, crlf = 0, failed = 0;
+
+    if (!PyArg_ParseTuple(args, "y*w*|pp:pack_lines_into", &data, &out_buf, &no_spaces, &crlf))
+        return NULL;
+
+    tables = get_tables(no_spaces);
+    if (tables == NULL) {
+        PyBuffer_Release(&data);
+        PyBuffer_Release(&out_buf);
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    start = pos = (const unsigned char *)data.buf;
+    end = pos + data.len;
+    out = (unsigned char *)out_buf.buf;
+
+    while (pos < end) {
+        Py_ssize_t len;
+        newline = memchr(pos, '\n', (size_t)(end - pos));
+        len = newline != NULL ? newline - pos + 1 : end - pos;
+
+        if (out_len + PACKED_SIZE(len) > out_buf.len)
+            break;
+        if (len > longest) {
+            PyMem_RawFree(work);
+            work = PyMem_RawMalloc((size_t)(len + LINE_GROWTH));
+            longest = len;
+            if (work == NULL) {
+                failed = 1;
+                break;
+            }
+        }
+
+        out_len += pack_one(pos, len, tables, crlf, work, out + out_len);
+        pos += len;
+    }
+    Py_END_ALLOW_THREADS
+
+    PyMem_RawFree(work);
+    PyBuffer_Release(&data);
+    PyBuffer_Release(&out_buf);
+    if (failed)
+        return PyErr_NoMemory();
+    return Py_BuildValue("(nn)", (Py_ssize_t)(pos - start), out_len);
+}
+
+
+/* ------------------------------------------------------------------------------- */
+PyDoc_STRVAR(set_tables_doc,
+"set_tables(no_spaces, packable, value, case_table)\n\n"
+"Sets the tables used in a no-spaces mode: whether each character is packable, its 4-bit value, and the\n"
+"bytes.translate() table fixing the case of G-lines (256 bytes each).");
+
+static PyObject *py_set_tables(PyObject *self, PyObject *args)
+{
+    Py_buffer packable, value, case_fix;
+    ModeTables *tables;
+    int no_spaces;
+
+    if (!PyArg_ParseTuple(args, "py*y*y*:set_tables", &no_spaces, &packable, &value, &case_fix))
+        return NULL;
+
+    if (packable.len != 256 || value.len != 256 || case_fix.len != 256) {
+        PyErr_SetString(PyExc_ValueError, "tables must be 256 bytes long");
+    }
+    else {
+        tables = &mode_tables[no_spaces ? 1 : 0];
+        memcpy(tables->packable, packable.buf, 256);
+        memcpy(tables->value, value.buf, 256);
+        memcpy(tables->case_fix, case_fix.buf, 256);
+        tables->ready = 1;
+    }
+
+    PyBuffer_Release(&packable);
+    PyBuffer_Release(&value);
+    PyBuffer_Release(&case_fix);
+    if (PyErr_Occurred())
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+
+/* ------------------------------------------------------------------------------- */
+static PyMethodDef cpacker_methods[] = {
+    {"pack_line", py_pack_line, METH_VARARGS, pack_line_doc},
+    {"pack_lines", py_pack_lines, METH_VARARGS, pack_lines_doc},
+    {"pack_lines_into", py_pack_lines_into, METH_VARARGS, pack_lines_into_doc},
+    {"set_tables", py_set_tables, METH_VARARGS, set_tables_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef cpacker_module = {
+    PyModuleDef_HEAD_INIT,
+    "_cpacker",
+    "Compiled MeatPack packer (optional, see meatpack.PackEngineNative).",
+    -1,
+    cpacker_methods
+};
+
+PyMODINIT_FUNC PyInit__cpacker(void)
+{
+    return PyModule_Create(&cpacker_module);
+}
@@ -0,0 +1,83 @@
+# Adaptive packing
+# Packing pays off for lines made mostly of packable characters (digits, G, X, ...). Text-heavy lines such as long
+# M-code sequences, M117 messages or g-code carrying a firmware upload gain little, and can even grow, as every pair of
+# unpackable characters costs three bytes. This tracks the ratio of packed to raw bytes over a rolling window of lines
+# and decides when packing should be switched off, and back on. Two thresholds and a minimum number of lines between
+# switches keep it from switching back and forth on mixed content.
+from array import array
+
+# Lines the compression ratio is computed over
+AdaptiveWindow = 200
+
+# Packing is switched off above the first ratio (packed/raw bytes), and back on below the second
+AdaptiveDisableRatio = 0.95
+AdaptiveEnableRatio = 0.85
+
+# Lines sent after a switch before the next one is considered
+AdaptiveMinLinesBetweenSwitches = 1000
+
+
+class AdaptivePacking:
+    """Rolling compression ratio of the lines sent, and the resulting decision whether packing is worth it."""
+
+    def __init__(self, window=AdaptiveWindow, disable_ratio=AdaptiveDisableRatio, enable_ratio=AdaptiveEnableRatio,
+                 min_lines_between_switches=AdaptiveMinLinesBetweenSwitches):
+        self.window = max(1, int(window))
+        self.disable_ratio = disable_ratio
+        self.enable_ratio = enable_ratio
+        self.min_lines_between_switches = min_lines_between_switches
+        self.reset()
+
+# -------------------------------------------------------------------------------
+    def reset(self):
+        self.packing = True
+        self.switches = 0
+        self.lines = 0
+        self.expanded_lines = 0
+        self.expanded_bytes = 0
+        self._raw = array('L', self.window * [0])
+        self._packed = array('L', self.window * [0])
+        self._pos = 0
+        self._filled = 0
+        self._raw_sum = 0
+        self._packed_sum = 0
+        self._since_switch = 0
+
+# -------------------------------------------------------------------------------
+    def ratio(self):
+        """Packed/raw bytes over the window (1.0 before any line was recorded)."""
+        return float(self._packed_sum) / self._raw_sum if self._raw_sum else 1.0
+
+# -------------------------------------------------------------------------------
+    def record(self, raw_len, packed_len):
+        """Adds a line (its length as sent raw, and packed). Returns True if packing should be switched now."""
+        pos = self._pos
+        self._raw_sum += raw_len - self._raw[pos]
+        self._packed_sum += packed_len - self._packed[pos]
+        self._raw[pos] = raw_len
+        self._packed[pos] = packed_len
+        pos += 1
+        self._pos = 0 if pos == self.window else pos
+        if self._filled < self.window:
+            self._filled += 1
+
+        self.lines += 1
+        if packed_len > raw_len:
+            self.expanded_lines += 1
+            self.expanded_bytes += packed_len - raw_len
+
+        self._since_switch += 1
+        if self._since_switch < self.min_lines_between_switches or self._filled < self.window:
+            return False
+
+        ratio = self.ratio()
+        if self.packing:
+            return ratio > self.disable_ratio
+        return ratio < self.enable_ratio
+
+# -------------------------------------------------------------------------------
+    def switched(self):
+        """Packing was switched as suggested by record()."""
+        self.packing = not self.packing
+        self.switches += 1
+        self._since_switch = 0
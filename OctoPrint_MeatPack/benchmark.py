@@ -0,0 +1,507 @@
+# Benchmarks for the packer and serial write path
+# Runs every target (packing engines, _unified_method, pack_file, PackingSerial.write, ...) over generated g-code
+# corpora and reports lines/sec, bytes/sec, compression ratio and bytes allocated per line. Targets and corpora
+# are plain dicts, so new implementations can be registered and compared against the existing ones.
+from __future__ import print_function
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+import OctoPrint_MeatPack.meatpack as mp
+
+
+# -------------------------------------------------------------------------------
+def _checksum_line(line):
+    return mp.line_checksum(line.encode("ascii"))
+
+
+# -------------------------------------------------------------------------------
+def _gen_arcs(rnd, count):
+    # Dense, linearized arcs: many tiny G1 segments (the worst case for serial throughput)
+    lines = []
+    e = 0.0
+    while len(lines) < count:
+        cx, cy, r = rnd.uniform(50, 200), rnd.uniform(50, 200), rnd.uniform(0.5, 20.0)
+        start = rnd.uniform(0, 2 * math.pi)
+        for i in range(rnd.randint(16, 128)):
+            a = start + i * 0.05
+            e += rnd.uniform(0.001, 0.02)
+            lines.append("G1 X{:.3f} Y{:.3f} E{:.5f}\n".format(cx + r * math.cos(a), cy + r * math.sin(a), e))
+    return lines[:count]
+
+
+# -------------------------------------------------------------------------------
+def _gen_arc_welder(rnd, count):
+    # Arc Welder output: G2/G3 arcs mixed with straight moves
+    lines = []
+    while len(lines) < count:
+        r = rnd.random()
+        x, y = rnd.uniform(0, 250), rnd.uniform(0, 210)
+        if r < 0.6:
+            lines.append("G{} X{:.3f} Y{:.3f} I{:.3f} J{:.3f} E{:.5f}\n".format(
+                rnd.choice((2, 3)), x, y, rnd.uniform(-30, 30), rnd.uniform(-30, 30), rnd.uniform(0.01, 2.0)))
+        elif r < 0.95:
+            lines.append("G1 X{:.3f} Y{:.3f} E{:.5f}\n".format(x, y, rnd.uniform(0.001, 0.5)))
+        else:
+            lines.append("G0 F9000 X{:.3f} Y{:.3f}\n".format(x, y))
+    return lines
+
+
+# -------------------------------------------------------------------------------
+def _gen_commented(rnd, count):
+    # Slicer output with comments, feature markers and M-codes
+    lines = []
+    layer = 0
+    while len(lines) < count:
+        r = rnd.random()
+        x, y = rnd.uniform(0, 250), rnd.uniform(0, 210)
+        if r < 0.02:
+            layer += 1
+            lines.append(";LAYER:{}\n".format(layer))
+            lines.append("G1 Z{:.3f} F600 ; move to next layer\n".format(layer * 0.2))
+        elif r < 0.05:
+            lines.append(";TYPE:{}\n".format(rnd.choice(("WALL-OUTER", "WALL-INNER", "SKIN", "FILL"))))
+        elif r < 0.08:
+            lines.append(rnd.choice(("M106 S255\n", "M204 S500\n", "M107\n", "G92 E0\n", "M117 Layer {}\n"
+                                     .format(layer))))
+        elif r < 0.15:
+            lines.append("G0 F9000 X{:.3f} Y{:.3f} ; travel\n".format(x, y))
+        else:
+            lines.append("G1 F1800 X{:.3f} Y{:.3f} E{:.5f} ; perimeter\n".format(x, y, rnd.uniform(0.01, 1.0)))
+    return lines[:count]
+
+
+# -------------------------------------------------------------------------------
+def _gen_checksummed(rnd, count):
+    # Lines as OctoPrint sends them while printing: line number and checksum
+    lines = []
+    for idx, line in enumerate(_gen_arcs(rnd, count)):
+        body = "N{} {}".format(idx + 1, line.rstrip("\n"))
+        lines.append("{}*{}\n".format(body, _checksum_line(body)))
+    return lines
+
+
+# -------------------------------------------------------------------------------
+def _gen_checksummed_compact(rnd, count):
+    # Checksummed lines of g-code sliced without whitespace (nothing for _unified_method to change)
+    lines = []
+    for idx, line in enumerate(_gen_arcs(rnd, count)):
+        body = "N{}{}".format(idx + 1, line.rstrip("\n").replace(" ", ""))
+        lines.append("{}*{}\n".format(body, _checksum_line(body)))
+    return lines
+
+
+# -------------------------------------------------------------------------------
+def _gen_retracts(rnd, count):
+    # Short extrusions separated by travel moves, each with a retraction, Z hop and the same moves undone, as
+    # sliced for many small islands (lots of identical lines)
+    lines = []
+    z = 0.2
+    while len(lines) < count:
+        if rnd.random() < 0.05:
+            z += 0.2
+            lines.append("G1 Z{:.3f} F600\n".format(z))
+            lines.append(rnd.choice(("M106 S255\n", "M204 S500\n", "M204 S1000\n")))
+        lines.append("G1 E-0.8 F2100\n")
+        lines.append("G1 Z{:.3f} F600\n".format(z + 0.4))
+        lines.append("G0 F9000 X{:.3f} Y{:.3f}\n".format(rnd.uniform(0, 250), rnd.uniform(0, 210)))
+        lines.append("G1 Z{:.3f} F600\n".format(z))
+        lines.append("G1 E0.8 F2100\n")
+        for _ in range(rnd.randint(2, 12)):
+            lines.append("G1 F1800 X{:.3f} Y{:.3f} E{:.5f}\n".format(
+                rnd.uniform(0, 250), rnd.uniform(0, 210), rnd.uniform(0.01, 1.0)))
+    return lines[:count]
+
+
+# Corpus generators by name: generator(random.Random, line count) -> list of str lines
+BenchmarkCorpora = {
+    "arcs": _gen_arcs,
+    "arcwelder": _gen_arc_welder,
+    "commented": _gen_commented,
+    "checksummed": _gen_checksummed,
+    "checksummed_compact": _gen_checksummed_compact,
+    "retracts": _gen_retracts,
+}
+
+
+# -------------------------------------------------------------------------------
+def make_corpus(name, count=20000, seed=0):
+    """Returns the named corpus as a list of bytes lines."""
+    return [line.encode("ascii") for line in BenchmarkCorpora[name](random.Random(seed), count)]
+
+
+# -------------------------------------------------------------------------------
+def _set_mode(no_spaces):
+    mp.initialize()
+    mp.set_no_spaces(no_spaces)
+
+
+# -------------------------------------------------------------------------------
+def _engine_target(name):
+    def factory(no_spaces):
+        return mp.get_packing_engine(name, no_spaces), None
+    return factory
+
+
+# -------------------------------------------------------------------------------
+def _minimized_engine_target(name):
+    # The engine behind the g-code minimizer at its highest level, so the ratio shows what minimizing adds
+    def factory(no_spaces):
+        from OctoPrint_MeatPack.gcode_minimizer import GcodeMinimizer, MinimizeModal
+        minimize = GcodeMinimizer(MinimizeModal).minimize
+        pack = mp.get_packing_engine(name, no_spaces)
+
+        def run(line):
+            return pack(minimize(line))
+        return run, None
+    return factory
+
+
+# -------------------------------------------------------------------------------
+def _unified_target(no_spaces):
+    _set_mode(no_spaces)
+
+    def run(line):
+        return mp._unified_method(line.decode("UTF-8", errors="ignore")).encode("UTF-8")
+    return run, None
+
+
+# -------------------------------------------------------------------------------
+def _unified_bytes_target(no_spaces):
+    _set_mode(no_spaces)
+    return mp._unified_method_bytes, None
+
+
+# -------------------------------------------------------------------------------
+def _serial_write_target(no_spaces, pipelined=False, metrics=False):
+    # PackingSerial.write() into a pseudo-terminal, drained by a background thread. Needs pyserial and a posix
+    # host; the device-side sync is skipped by marking the state as synchronized. With pipelined writes only the
+    # time spent in write() is measured, and the packed size lags behind by whatever is still queued.
+    import logging
+    from OctoPrint_MeatPack.packing_serial import PackingSerial
+
+    master, slave = os.openpty()
+    running = [True]
+
+    def drain():
+        while running[0]:
+            try:
+                if not os.read(master, 65536):
+                    break
+            except OSError:
+                break
+
+    drain_thread = threading.Thread(target=drain)
+    drain_thread.daemon = True
+    drain_thread.start()
+
+    port = PackingSerial(logging.getLogger("meatpack.benchmark"), port=os.ttyname(slave), baudrate=115200)
+    port._no_spaces = no_spaces
+    port._set_packer_mode(no_spaces)
+    port._confirmed_sync = True
+    port._sync_pending = False
+    port.play_song_on_print_complete = False
+    port.pipelined_writes = pipelined
+    port.collect_metrics = metrics
+
+    def run(line):
+        before = port._diagBytesSentActualTotal
+        port.write(line)
+        return port._diagBytesSentActualTotal - before
+
+    def close():
+        running[0] = False
+        port.pipelined_writes = False
+        port.close()
+        os.close(slave)
+        os.close(master)
+        drain_thread.join(1.0)
+    return run, close
+
+
+# Per-line targets by name: factory(no_spaces) -> (fn(line bytes) -> packed bytes or packed length, close or None)
+BenchmarkLineTargets = {
+    "unified": _unified_target,
+    "unified_bytes": _unified_bytes_target,
+    "serial_write": _serial_write_target,
+    "serial_write_pipelined": lambda no_spaces: _serial_write_target(no_spaces, pipelined=True),
+    "serial_write_metrics": lambda no_spaces: _serial_write_target(no_spaces, metrics=True),
+}
+for _name in mp.PackingEngines:
+    BenchmarkLineTargets["engine:" + _name] = _engine_target(_name)
+    BenchmarkLineTargets["minimized:" + _name] = _minimized_engine_target(_name)
+
+
+# -------------------------------------------------------------------------------
+def _run_pack_file(in_filename, out_filename, no_spaces):
+    _set_mode(no_spaces)
+    mp.pack_file(in_filename, out_filename)
+
+
+# -------------------------------------------------------------------------------
+def _run_iter_pack_file(in_filename, out_filename, no_spaces):
+    # Text file packed line by line with the classic engine
+    _set_mode(no_spaces)
+    with open(in_filename, "r") as in_file, open(out_filename, "wb") as out_file:
+        for block in mp.iter_pack_file(in_file):
+            out_file.write(block)
+
+
+# -------------------------------------------------------------------------------
+def _run_pack_file_parallel(in_filename, out_filename, no_spaces):
+    mp.pack_file_parallel(in_filename, out_filename, no_spaces=no_spaces)
+
+
+# -------------------------------------------------------------------------------
+def _run_packed_stream(in_filename, out_filename, no_spaces):
+    # Numbered, checksummed lines and their offset index (written next to the output, and not counted in its size)
+    from OctoPrint_MeatPack.packed_stream import build_packed_stream
+    build_packed_stream(in_filename, out_filename, no_spaces)
+
+
+# Whole-file targets by name: fn(in_filename, out_filename, no_spaces)
+BenchmarkFileTargets = {
+    "pack_file": _run_pack_file,
+    "iter_pack_file": _run_iter_pack_file,
+    "pack_file_parallel": _run_pack_file_parallel,
+    "packed_stream": _run_packed_stream,
+}
+
+
+# -------------------------------------------------------------------------------
+def _random_lines(rnd, count, binary=True, max_len=320):
+    # g-code-like lines, and (if binary) lines of arbitrary bytes, some longer than the compiled packer's stack
+    # buffers
+    alphabet = bytearray(b"0123456789.  GXEYZFMSTNIJgxeyzfms*;-+_/?O\t\r")
+    all_bytes = bytearray(range(256)) if binary else alphabet
+    lines = []
+    for _ in range(count):
+        chars = alphabet if rnd.random() < 0.8 else all_bytes
+        line = bytes(bytearray(rnd.choice(chars) for _ in range(rnd.randint(1, rnd.choice((48, max_len))))))
+        lines.append(line + b"\n" if rnd.random() < 0.8 else line)
+    return lines
+
+
+# -------------------------------------------------------------------------------
+def check_parity(engine_a, engine_b, count=20000, random_lines=20000, seed=0):
+    """Packs every corpus and random lines with both engines in both no-spaces modes, and checks that the output is
+    identical. With the compiled packer built, whole blocks packed by mp.pack_block() and files packed by
+    mp.pack_file_mmap() are checked against the pure Python versions as well. The classic engine only matches the
+    others for ASCII, so random lines are ASCII if it's one of the two. Returns a list of mismatches as tuples of
+    (source, no_spaces, line, packed_a, packed_b), an empty list means the engines agree."""
+    rnd = random.Random(seed)
+    sources = [(name, make_corpus(name, count, seed)) for name in sorted(BenchmarkCorpora)]
+    binary = mp.PackEngineClassic not in (engine_a, engine_b)
+    sources.append(("random", _random_lines(rnd, random_lines, binary)))
+    mismatches = []
+
+    for no_spaces in (False, True):
+        pack_a = mp.get_packing_engine(engine_a, no_spaces)
+        pack_b = mp.get_packing_engine(engine_b, no_spaces)
+        for name, lines in sources:
+            for line in lines:
+                packed_a = bytes(pack_a(line))
+                packed_b = bytes(pack_b(line))
+                if packed_a != packed_b:
+                    mismatches.append((name, no_spaces, line, packed_a, packed_b))
+
+            if mp._cpacker is not None:
+                block = b"".join(lines)
+                packed_a = mp.pack_block(block, no_spaces)
+                packed_b = mp._pack_block_python(block, no_spaces)
+                if packed_a != packed_b:
+                    mismatches.append((name + " (block)", no_spaces, block[:64], packed_a[:64], packed_b[:64]))
+
+        if mp._cpacker is not None:
+            mismatches.extend(_check_mapped_parity(sources, no_spaces))
+    return mismatches
+
+
+# -------------------------------------------------------------------------------
+def _check_mapped_parity(sources, no_spaces):
+    # The packers behind pack_file_mmap(), with and without the compiled packer, over all sources as one file (with
+    # CRLF line endings in every other source)
+    import io
+    import mmap
+
+    data = b"".join(b"".join(lines).replace(b"\n", b"\r\n") if idx & 1 else b"".join(lines)
+                    for idx, (_, lines) in enumerate(sources))
+    with tempfile.TemporaryFile() as in_file:
+        in_file.write(data)
+        in_file.flush()
+        mapped = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            packed = []
+            for pack_mapped in (mp._pack_mapped_native, mp._pack_mapped_python):
+                out_file = io.BytesIO()
+                pack_mapped(mapped, out_file, no_spaces, None)
+                packed.append(out_file.getvalue())
+        finally:
+            mapped.close()
+
+    if packed[0] != packed[1]:
+        return [("mapped file", no_spaces, data[:64], packed[0][:64], packed[1][:64])]
+    return []
+
+
+class BenchmarkResult:
+    def __init__(self, target, corpus, no_spaces, lines, raw_bytes, packed_bytes, elapsed, alloc_bytes=None):
+        self.target = target
+        self.corpus = corpus
+        self.no_spaces = no_spaces
+        self.lines = lines
+        self.raw_bytes = raw_bytes
+        self.packed_bytes = packed_bytes
+        self.elapsed = elapsed
+        self.alloc_bytes = alloc_bytes
+
+    @property
+    def lines_per_sec(self):
+        return self.lines / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def bytes_per_sec(self):
+        return self.raw_bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def ratio(self):
+        return float(self.packed_bytes) / self.raw_bytes if self.raw_bytes else 0.0
+
+    @property
+    def alloc_per_line(self):
+        if self.alloc_bytes is None or not self.lines:
+            return None
+        return float(self.alloc_bytes) / self.lines
+
+    def as_dict(self):
+        return dict(target=self.target, corpus=self.corpus, noSpaces=self.no_spaces, lines=self.lines,
+                    linesPerSec=self.lines_per_sec, bytesPerSec=self.bytes_per_sec, ratio=self.ratio,
+                    allocBytesPerLine=self.alloc_per_line)
+
+
+# -------------------------------------------------------------------------------
+def _measure_allocations(fn, lines):
+    # Sum of the peak traced memory while packing each line, i.e. the temporary allocations made per line.
+    # tracemalloc slows everything down, so this is a separate pass from the timed one.
+    if not hasattr(tracemalloc, "reset_peak"):
+        return None
+    total = 0
+    tracemalloc.start()
+    try:
+        for line in lines:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            fn(line)
+            total += tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return total
+
+
+# -------------------------------------------------------------------------------
+def run_line_target(target, corpus, lines, no_spaces, repeat=3, allocations=True):
+    """Times a per-line target over the corpus (best of `repeat` runs)."""
+    fn, close = BenchmarkLineTargets[target](no_spaces)
+    try:
+        raw_bytes = sum(len(line) for line in lines)
+        # Warm up, so lazily built tables aren't counted
+        if lines:
+            fn(lines[0])
+        best = None
+        packed_bytes = 0
+        for _ in range(repeat):
+            packed_bytes = 0
+            start = time.perf_counter()
+            for line in lines:
+                out = fn(line)
+                packed_bytes += out if isinstance(out, int) else len(out)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        alloc_bytes = _measure_allocations(fn, lines) if allocations else None
+    finally:
+        if close is not None:
+            close()
+    return BenchmarkResult(target, corpus, no_spaces, len(lines), raw_bytes, packed_bytes, best, alloc_bytes)
+
+
+# -------------------------------------------------------------------------------
+def run_file_target(target, corpus, lines, no_spaces, repeat=1):
+    """Times a whole-file target over the corpus written to a temporary file."""
+    tmp_dir = tempfile.mkdtemp(prefix="meatpack_bench_")
+    in_filename = os.path.join(tmp_dir, "in.gcode")
+    out_filename = os.path.join(tmp_dir, "out.mpk")
+    try:
+        with open(in_filename, "wb") as in_file:
+            for line in lines:
+                in_file.write(line)
+
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            BenchmarkFileTargets[target](in_filename, out_filename, no_spaces)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+        return BenchmarkResult(target, corpus, no_spaces, len(lines), os.path.getsize(in_filename),
+                               os.path.getsize(out_filename), best)
+    finally:
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+
+
+# -------------------------------------------------------------------------------
+def run(targets=None, corpora=None, modes=(False, True), count=20000, repeat=3, allocations=True):
+    """Runs the given targets (all if None) over the given corpora (all if None) in each no-spaces mode and
+    returns a list of BenchmarkResult."""
+    if targets is None:
+        targets = sorted(BenchmarkLineTargets) + sorted(BenchmarkFileTargets)
+    if corpora is None:
+        corpora = sorted(BenchmarkCorpora)
+
+    results = []
+    for corpus in corpora:
+        lines = make_corpus(corpus, count)
+        for no_spaces in modes:
+            for target in targets:
+                if target in BenchmarkFileTargets:
+                    results.append(run_file_target(target, corpus, lines, no_spaces))
+                else:
+                    results.append(run_line_target(target, corpus, lines, no_spaces, repeat, allocations))
+    return results
+
+
+# -------------------------------------------------------------------------------
+def format_results(results):
+    rows = ["{:<22} {:<12} {:<4} {:>12} {:>12} {:>7} {:>12}".format(
+        "target", "corpus", "nsp", "lines/sec", "bytes/sec", "ratio", "alloc B/line")]
+    for r in results:
+        alloc = r.alloc_per_line
+        rows.append("{:<22} {:<12} {:<4} {:>12.0f} {:>12.0f} {:>7.3f} {:>12}".format(
+            r.target, r.corpus, "yes" if r.no_spaces else "no", r.lines_per_sec, r.bytes_per_sec, r.ratio,
+            "-" if alloc is None else "{:.0f}".format(alloc)))
+    return "\n".join(rows)
+
+
+# -------------------------------------------------------------------------------
+def format_comparison(results, target_a, target_b):
+    """Side-by-side comparison of two targets over the same corpora/modes (speedup of b relative to a)."""
+    by_key = dict(((r.target, r.corpus, r.no_spaces), r) for r in results)
+    rows = ["{:<12} {:<4} {:>14} {:>14} {:>8} {:>10}".format(
+        "corpus", "nsp", target_a, target_b, "speedup", "same size")]
+    for (target, corpus, no_spaces), a in sorted(by_key.items()):
+        if target != target_a:
+            continue
+        b = by_key.get((target_b, corpus, no_spaces))
+        if b is None:
+            continue
+        rows.append("{:<12} {:<4} {:>14.0f} {:>14.0f} {:>7.2f}x {:>10}".format(
+            corpus, "yes" if no_spaces else "no", a.lines_per_sec, b.lines_per_sec,
+            b.lines_per_sec / a.lines_per_sec if a.lines_per_sec else 0.0,
+            "yes" if a.packed_bytes == b.packed_bytes else "NO"))
+    return "\n".join(rows)
@@ -0,0 +1,308 @@
+# Command line tools for MeatPack, usable outside of a running OctoPrint instance.
+#
+#   meatpack pack [-j JOBS] [--no-spaces] [-o OUT_DIR] PATH [PATH ...]
+#   meatpack bench [-t TARGET ...] [-c CORPUS ...] [--compare A B] [--lines N]
+#   meatpack emulate [--baud BAUD] [--file GCODE | --corpus CORPUS] [--no-spaces] [--engine ENGINE] [--pipelined]
+#                    [--adaptive] [--minimize LEVEL]
+#                    [--stream [--corrupt N ...] [--host-every N] [--resume-layer N]]
+#   meatpack unpack PACKED OUT
+#   meatpack verify GCODE PACKED
+#   meatpack fuzz [--iterations N] [--seed SEED]
+#   meatpack parity [--engines A B] [--lines N] [--seed SEED]
+#   meatpack profile [--no-spaces] [--minimize LEVEL] [--top N] [--json] GCODE
+#
+# PATH may be a g-code file or a directory, in which case all g-code files in it are packed.
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+import OctoPrint_MeatPack.meatpack as mp
+
+GCodeExtensions = (".gcode", ".gco", ".g")
+PackedExtension = ".mpk"
+
+
+# -------------------------------------------------------------------------------
+def _find_gcode_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(GCodeExtensions):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+# -------------------------------------------------------------------------------
+def _cmd_pack(args):
+    for in_filename in _find_gcode_files(args.paths):
+        out_dir = args.out_dir or os.path.dirname(in_filename)
+        out_filename = os.path.join(out_dir, os.path.splitext(os.path.basename(in_filename))[0] + PackedExtension)
+
+        start = time.time()
+        # With the compiled packer, a single pass over the mapped file beats handing chunks to worker processes
+        if args.jobs == 1 or (args.jobs is None and mp.PackEngineDefault == mp.PackEngineNative):
+            mp.pack_file_mmap(in_filename, out_filename, no_spaces=args.no_spaces)
+        else:
+            mp.pack_file_parallel(in_filename, out_filename, no_spaces=args.no_spaces, workers=args.jobs)
+        elapsed = time.time() - start
+
+        in_size = os.path.getsize(in_filename)
+        out_size = os.path.getsize(out_filename)
+        print("{} -> {}: {} -> {} bytes (ratio {:.3f}) in {:.2f} sec".format(
+            in_filename, out_filename, in_size, out_size, float(out_size) / max(in_size, 1), elapsed))
+    return 0
+
+
+# -------------------------------------------------------------------------------
+def _cmd_bench(args):
+    import OctoPrint_MeatPack.benchmark as bench
+
+    targets = args.targets
+    if args.compare:
+        targets = list(args.compare)
+    modes = (False, True) if args.mode == "both" else (args.mode == "nsp",)
+
+    results = bench.run(targets=targets, corpora=args.corpora, modes=modes, count=args.lines,
+                        repeat=args.repeat, allocations=not args.no_alloc)
+    print(bench.format_results(results))
+    if args.compare:
+        print()
+        print(bench.format_comparison(results, args.compare[0], args.compare[1]))
+    return 0
+
+
+# -------------------------------------------------------------------------------
+def _cmd_emulate(args):
+    import OctoPrint_MeatPack.emulator as emu
+    from OctoPrint_MeatPack.link_monitor import format_report
+
+    if args.file:
+        with open(args.file, "rb") as in_file:
+            lines = in_file.readlines()
+    else:
+        import OctoPrint_MeatPack.benchmark as bench
+        lines = bench.make_corpus(args.corpus, args.lines)
+
+    if args.stream:
+        return _emulate_stream(args, lines)
+
+    report = emu.run_loopback(lines, baudrate=args.baud, no_spaces=args.no_spaces, engine=args.engine,
+                              window=args.window or 1, protocol_version=args.protocol, reset_at=args.reset_at,
+                              pipelined=args.pipelined, adaptive=args.adaptive, minimize=args.minimize)
+
+    print("Handshake latency:    {:.1f} ms".format(report['handshakeLatency'] * 1000.0))
+    if report['resyncLatency'] is not None:
+        print("Re-sync after reset:  {:.1f} ms".format(report['resyncLatency'] * 1000.0))
+    print("Lines sent/received:  {}/{} ({} decoded correctly)".format(
+        report['lines'], report['linesReceived'], report['linesCorrect']))
+    print("Lines/sec:            {:.0f}".format(report['linesPerSec']))
+    print("Effective bytes/sec:  {:.0f}".format(report['effectiveBytesPerSec']))
+    print("Link bytes/sec:       {:.0f} (of {:.0f} max)".format(report['linkBytesPerSec'], args.baud / 10.0))
+    if args.adaptive:
+        print("Adaptive switches:    {}".format(report['adaptiveSwitches']))
+    if args.minimize:
+        print("Minimizer saved:      {} bytes".format(report['minimizerBytesSaved']))
+    print(format_report(report['linkReport']))
+    for idx, expected, received in report['mismatches']:
+        print("Mismatch at line {}: expected {!r}, received {!r}".format(idx, expected, received))
+    return 0 if report['linesCorrect'] == report['lines'] else 1
+
+
+# -------------------------------------------------------------------------------
+def _emulate_stream(args, lines):
+    import OctoPrint_MeatPack.emulator as emu
+    from OctoPrint_MeatPack.link_monitor import format_report
+
+    report = emu.run_stream(lines, baudrate=args.baud, no_spaces=args.no_spaces, window=args.window,
+                            corrupt=args.corrupt or (), host_every=args.host_every, resume_layer=args.resume_layer)
+
+    print("Stream:               {}{}".format(report['state'],
+                                                ": {}".format(report['error']) if report['error'] else ""))
+    if args.resume_layer is not None:
+        print("Resumed:              layer {} of {}, at line {}".format(args.resume_layer, report['layers'],
+                                                                    report['firstLine']))
+    print("Lines sent/received:  {}/{} ({} decoded correctly)".format(
+        report['lines'], report['linesReceived'], report['linesCorrect']))
+    print("Resends:              {} (requested {} times)".format(report['resends'], report['firmwareResends']))
+    if args.host_every:
+        print("Host commands/oks:    {}/{}".format(report['hostCommands'], report['hostOks']))
+    print("Lines/sec:            {:.0f}".format(report['linesPerSec']))
+    print("Effective bytes/sec:  {:.0f}".format(report['effectiveBytesPerSec']))
+    print("Link bytes/sec:       {:.0f} (of {:.0f} max)".format(report['linkBytesPerSec'], args.baud / 10.0))
+    print(format_report(report['linkReport']))
+    for idx, expected, received in report['mismatches']:
+        print("Mismatch at line {}: expected {!r}, received {!r}".format(idx, expected, received))
+    ok = report['state'] == "done" and report['linesCorrect'] == report['lines'] == report['linesReceived'] and \
+        report['hostOks'] == report['hostCommands']
+    return 0 if ok else 1
+
+
+# -------------------------------------------------------------------------------
+def _cmd_unpack(args):
+    import OctoPrint_MeatPack.unpacker as up
+
+    with open(args.out, "wb") as out_file:
+        for block in up.iter_unpack_file(args.packed):
+            out_file.write(block)
+    return 0
+
+
+# -------------------------------------------------------------------------------
+def _cmd_verify(args):
+    import OctoPrint_MeatPack.unpacker as up
+
+    start = time.time()
+    matches, decoded, mismatch = up.verify_packed_file(args.gcode, args.packed)
+    elapsed = time.time() - start
+    if matches:
+        print("OK: {} decoded bytes match {} ({:.2f} sec)".format(decoded, args.gcode, elapsed))
+        return 0
+    print("MISMATCH: decoded stream differs from {} at decoded byte {}".format(args.gcode, mismatch))
+    return 1
+
+
+# -------------------------------------------------------------------------------
+def _cmd_fuzz(args):
+    import OctoPrint_MeatPack.unpacker as up
+
+    failures = up.fuzz_round_trip(args.iterations, args.seed)
+    for engine, no_spaces, line, expected, decoded in failures[:20]:
+        print("FAIL [{}, nsp={}]: {!r} -> expected {!r}, decoded {!r}".format(
+            engine, no_spaces, line, expected, decoded))
+    print("{} iterations, {} failures".format(args.iterations, len(failures)))
+    return 1 if failures else 0
+
+
+# -------------------------------------------------------------------------------
+def _cmd_parity(args):
+    import OctoPrint_MeatPack.benchmark as bench
+
+    engine_a, engine_b = args.engines
+    for engine in args.engines:
+        if engine not in mp.PackingEngines:
+            print("Packing engine '{}' isn't available (available: {})".format(
+                engine, ", ".join(sorted(mp.PackingEngines))))
+            return 1
+
+    mismatches = bench.check_parity(engine_a, engine_b, count=args.lines, random_lines=args.lines, seed=args.seed)
+    for source, no_spaces, line, packed_a, packed_b in mismatches[:20]:
+        print("MISMATCH [{}, nsp={}]: {!r} -> {}: {!r}, {}: {!r}".format(
+            source, no_spaces, line, engine_a, packed_a, engine_b, packed_b))
+    print("{} vs {}: {} mismatches".format(engine_a, engine_b, len(mismatches)))
+    return 1 if mismatches else 0
+
+
+# -------------------------------------------------------------------------------
+def _cmd_profile(args):
+    import json
+    import OctoPrint_MeatPack.pack_profiler as prof
+
+    summary = prof.profile_file(args.gcode, no_spaces=args.no_spaces, minimize=args.minimize).summary()
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(prof.format_profile(summary, top=args.top))
+    return 0
+
+
+# -------------------------------------------------------------------------------
+def build_parser():
+    parser = argparse.ArgumentParser(prog="meatpack", description="MeatPack g-code packing tools")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    pack = commands.add_parser("pack", help="pack g-code files (in parallel) to {} files".format(PackedExtension))
+    pack.add_argument("paths", nargs="+", help="g-code files or directories containing them")
+    pack.add_argument("-j", "--jobs", type=int, default=None,
+                      help="worker processes (default: all cores, or a single process with the compiled packer)")
+    pack.add_argument("-o", "--out-dir", default=None, help="output directory (default: next to each input)")
+    pack.add_argument("--no-spaces", action="store_true", help="pack with whitespace removal enabled")
+    pack.set_defaults(func=_cmd_pack)
+
+    bench = commands.add_parser("bench", help="benchmark the packer and serial write path")
+    bench.add_argument("-t", "--target", dest="targets", action="append", default=None,
+                       help="target to run, may be repeated (default: all)")
+    bench.add_argument("-c", "--corpus", dest="corpora", action="append", default=None,
+                       help="corpus to use, may be repeated (default: all)")
+    bench.add_argument("--compare", nargs=2, metavar=("A", "B"), default=None,
+                       help="run only targets A and B and compare them side by side")
+    bench.add_argument("--mode", choices=("esp", "nsp", "both"), default="both",
+                       help="no-spaces mode(s) to run in (default: both)")
+    bench.add_argument("--lines", type=int, default=20000, help="lines per corpus (default: 20000)")
+    bench.add_argument("--repeat", type=int, default=3, help="timed runs per target, best is kept (default: 3)")
+    bench.add_argument("--no-alloc", action="store_true", help="skip the (slow) allocation measurement")
+    bench.set_defaults(func=_cmd_bench)
+
+    emulate = commands.add_parser("emulate", help="stream g-code to an emulated MeatPack firmware over a pty")
+    emulate.add_argument("--baud", type=int, default=115200, help="emulated baud rate (default: 115200)")
+    emulate.add_argument("--file", default=None, help="g-code file to send (default: a generated corpus)")
+    emulate.add_argument("--corpus", default="arcs", help="generated corpus to send (default: arcs)")
+    emulate.add_argument("--lines", type=int, default=2000, help="lines of the generated corpus (default: 2000)")
+    emulate.add_argument("--no-spaces", action="store_true", help="enable whitespace removal")
+    emulate.add_argument("--engine", default=mp.PackEngineDefault, choices=sorted(mp.PackingEngines),
+                         help="packing engine (default: {})".format(mp.PackEngineDefault))
+    emulate.add_argument("--window", type=int, default=None,
+                         help="lines in flight before waiting for ok (default: 1, 4 with --stream)")
+    emulate.add_argument("--protocol", type=int, default=1, help="emulated MeatPack protocol version (default: 1)")
+    emulate.add_argument("--reset-at", type=int, default=None, help="reset the printer before this line")
+    emulate.add_argument("--pipelined", action="store_true", help="pack and write on background threads")
+    emulate.add_argument("--adaptive", action="store_true", help="switch packing off while it doesn't pay off")
+    emulate.add_argument("--minimize", type=int, default=0, choices=(0, 1, 2),
+                         help="g-code minimization level: 0 off, 1 numbers, 2 numbers and feedrates (default: 0)")
+    emulate.add_argument("--stream", action="store_true",
+                         help="pack the lines into a packed stream and send that, with ok flow control")
+    emulate.add_argument("--corrupt", type=int, nargs="+", default=None, metavar="N",
+                         help="line numbers the printer fails once and asks to resend (with --stream)")
+    emulate.add_argument("--host-every", type=int, default=0, metavar="N",
+                         help="write a host command every N acknowledged stream lines (with --stream)")
+    emulate.add_argument("--resume-layer", type=int, default=None, metavar="N",
+                         help="resume the stream where layer N (counted from 0) starts (with --stream)")
+    emulate.set_defaults(func=_cmd_emulate)
+
+    unpack = commands.add_parser("unpack", help="decode a packed file back to g-code")
+    unpack.add_argument("packed", help="packed input file")
+    unpack.add_argument("out", help="decoded output file")
+    unpack.set_defaults(func=_cmd_unpack)
+
+    verify = commands.add_parser("verify", help="check that a packed file decodes back to its source")
+    verify.add_argument("gcode", help="source g-code file")
+    verify.add_argument("packed", help="packed file")
+    verify.set_defaults(func=_cmd_verify)
+
+    fuzz = commands.add_parser("fuzz", help="round-trip random lines through every packing engine and the decoder")
+    fuzz.add_argument("--iterations", type=int, default=10000, help="random lines to test (default: 10000)")
+    fuzz.add_argument("--seed", type=int, default=None, help="random seed (default: random)")
+    fuzz.set_defaults(func=_cmd_fuzz)
+
+    parity = commands.add_parser("parity", help="check that two packing engines produce identical output")
+    parity.add_argument("--engines", nargs=2, metavar=("A", "B"),
+                        default=(mp.PackEngineDefault, mp.PackEngineTable if mp.PackEngineDefault !=
+                                 mp.PackEngineTable else mp.PackEngineClassic),
+                        help="engines to compare (default: the default engine and the pure Python table engine)")
+    parity.add_argument("--lines", type=int, default=20000,
+                        help="lines per corpus, and random lines (default: 20000)")
+    parity.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    parity.set_defaults(func=_cmd_parity)
+
+    profile = commands.add_parser("profile", help="packing efficiency per command word of a g-code file")
+    profile.add_argument("gcode", help="g-code file")
+    profile.add_argument("--no-spaces", action="store_true", help="pack with whitespace removal enabled")
+    profile.add_argument("--minimize", type=int, default=0, choices=(0, 1, 2),
+                         help="g-code minimization level applied first (default: 0)")
+    profile.add_argument("--top", type=int, default=20, help="commands listed, by packed bytes (default: 20)")
+    profile.add_argument("--json", action="store_true", help="print the full profile as JSON")
+    profile.set_defaults(func=_cmd_profile)
+
+    return parser
+
+
+# -------------------------------------------------------------------------------
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,514 @@
+# Loopback firmware emulator
+# A stand-in for a MeatPack-capable printer on a pseudo-terminal, so the PackingSerial handshake and send path can
+# be load-tested without hardware. It decodes MeatPack the way the firmware does (byte by byte), answers the [MP]
+# config queries, announces resets with "start" and acknowledges every line with "ok", all at an emulated baud
+# rate. Numbered lines are checked like the firmware checks them, and a line failing the check is asked for again
+# with "Resend: N". Posix only.
+from __future__ import print_function
+import collections
+import os
+import re
+import select
+import threading
+import time
+import OctoPrint_MeatPack.meatpack as mp
+
+# Nibble value -> character, as the firmware's lookup table holds it
+EmulatorCharTable = dict((value, char.encode("ascii")) for char, value in mp.MeatPackReverseLookupTbl.items())
+EmulatorSpaceNibble = mp.MeatPackReverseLookupTbl[' ']
+EmulatorLiteralNibble = 0b1111
+
+EmulatorLineNumberRe = re.compile(br"^N(\d+)")
+EmulatorM110Re = re.compile(br"^M110\s*(?:N(\d+))?")
+
+
+class FirmwareDecoder:
+    """Byte-at-a-time MeatPack decoder mirroring the firmware state machine."""
+
+    def __init__(self, protocol_version=1):
+        self.protocol_version = protocol_version
+        self.reset()
+
+    def reset(self):
+        self.active = False
+        self.no_spaces = False
+        self._cmd_count = 0
+        self._cmd_is_next = False
+        self._full_char_count = 0
+        self._char_buf = b""
+        # Whether packing was active when each decoded newline was received
+        self.newline_modes = collections.deque()
+
+# -------------------------------------------------------------------------------
+    def _get_char(self, nibble):
+        if nibble == EmulatorSpaceNibble and self.no_spaces:
+            return mp.MeatPackSpaceReplacedCharacter.encode("ascii")
+        return EmulatorCharTable[nibble]
+
+# -------------------------------------------------------------------------------
+    def report_state(self):
+        if self.protocol_version >= 1:
+            return "[MP] PV{:02d} {} {}\n".format(self.protocol_version, "ON" if self.active else "OFF",
+                                                  "NSP" if self.no_spaces else "ESP").encode("ascii")
+        return "[MP] {}\n".format("ON" if self.active else "OFF").encode("ascii")
+
+# -------------------------------------------------------------------------------
+    def _handle_command(self, command):
+        if command == mp.MPCommand_EnablePacking:
+            self.active = True
+        elif command == mp.MPCommand_DisablePacking:
+            self.active = False
+        elif command == mp.MPCommand_ResetAll:
+            self.active = False
+            self.no_spaces = False
+        elif command == mp.MPCommand_EnableNoSpaces and self.protocol_version >= 1:
+            self.no_spaces = True
+        elif command == mp.MPCommand_DisableNoSpaces and self.protocol_version >= 1:
+            self.no_spaces = False
+        return self.report_state()
+
+# -------------------------------------------------------------------------------
+    def _handle_rx_char(self, c, out):
+        if not self.active:
+            out.append(c)
+            return
+
+        if self._full_char_count:
+            out.append(c)
+            if self._char_buf:
+                out += self._char_buf
+                self._char_buf = b""
+            self._full_char_count -= 1
+            return
+
+        low = c & 0xF
+        high = (c >> 4) & 0xF
+        if low == EmulatorLiteralNibble:
+            self._full_char_count += 1
+            if high == EmulatorLiteralNibble:
+                self._full_char_count += 1
+            else:
+                self._char_buf = self._get_char(high)
+        else:
+            first = self._get_char(low)
+            out += first
+            # After a newline the second character is padding
+            if first != b"\n":
+                if high == EmulatorLiteralNibble:
+                    self._full_char_count += 1
+                else:
+                    out += self._get_char(high)
+
+# -------------------------------------------------------------------------------
+    def feed(self, data, out):
+        """Decodes data into the out bytearray, returns the list of responses to command words."""
+        responses = []
+        for c in bytearray(data):
+            if c == mp.MPCommand_SignalByte:
+                if self._cmd_count:
+                    self._cmd_is_next = True
+                    self._cmd_count = 0
+                else:
+                    self._cmd_count += 1
+            elif self._cmd_is_next:
+                responses.append(self._handle_command(c))
+                self._cmd_is_next = False
+            else:
+                start = len(out)
+                if self._cmd_count:
+                    self._handle_rx_char(mp.MPCommand_SignalByte, out)
+                    self._cmd_count = 0
+                self._handle_rx_char(c, out)
+                for _ in range(out.count(b"\n", start)):
+                    self.newline_modes.append(self.active)
+        return responses
+
+
+class FirmwareEmulator:
+    """Emulated printer on the master side of a pseudo-terminal. Connect a PackingSerial to `port`."""
+
+    def __init__(self, baudrate=115200, protocol_version=1, corrupt_lines=()):
+        self.baudrate = baudrate
+        self.decoder = FirmwareDecoder(protocol_version)
+        # Line numbers that fail the checksum once, as if they were garbled on the way
+        self.corrupt_lines = set(corrupt_lines)
+        self.last_line = 0
+        self.resends = 0
+        self.lines = []
+        # Whether packing was active on the device when each line was received
+        self.lines_packed = []
+        self.bytes_received = 0
+        self._master, self._slave = os.openpty()
+        self.port = os.ttyname(self._slave)
+        self._line_buf = bytearray()
+        self._rx_clock = 0.0
+        self._running = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+# -------------------------------------------------------------------------------
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+# -------------------------------------------------------------------------------
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        os.close(self._master)
+        os.close(self._slave)
+
+# -------------------------------------------------------------------------------
+    def reset(self):
+        """Emulates a printer reset: MeatPack state is cleared and "start" is announced."""
+        with self._lock:
+            self.decoder.reset()
+            self.last_line = 0
+            del self._line_buf[:]
+            self._send(b"start\n")
+
+# -------------------------------------------------------------------------------
+    def _send(self, data):
+        os.write(self._master, data)
+
+# -------------------------------------------------------------------------------
+    def _throttle(self, byte_count):
+        # Hold off until the bytes would have arrived over a real link (10 bits per byte with start/stop bits)
+        now = time.time()
+        self._rx_clock = max(self._rx_clock, now) + byte_count * 10.0 / self.baudrate
+        if self._rx_clock > now:
+            time.sleep(self._rx_clock - now)
+
+# -------------------------------------------------------------------------------
+    def _run(self):
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._master, 256)
+            except OSError:
+                break
+            if not data:
+                break
+
+            self._throttle(len(data))
+
+            with self._lock:
+                self.bytes_received += len(data)
+                for response in self.decoder.feed(data, self._line_buf):
+                    self._send(response)
+
+                while True:
+                    idx = self._line_buf.find(b"\n")
+                    if idx < 0:
+                        break
+                    line = bytes(self._line_buf[:idx]).rstrip(b"\r")
+                    del self._line_buf[:idx + 1]
+                    packed = self.decoder.newline_modes.popleft()
+                    if line:
+                        error = self._check_line_number(line)
+                        if error is not None:
+                            self._send(error)
+                            continue
+                        self.lines.append(line)
+                        self.lines_packed.append(packed)
+                        self._send(b"ok\n")
+
+# -------------------------------------------------------------------------------
+    def _check_line_number(self, line):
+        # Returns the response to a numbered line that has to be sent again, or None if the line is accepted
+        match = EmulatorLineNumberRe.match(line)
+        if match is None:
+            match = EmulatorM110Re.match(line)
+            if match is not None:
+                self.last_line = int(match.group(1) or 0)
+            return None
+
+        number = int(match.group(1))
+        if number != self.last_line + 1:
+            return self._request_resend("Line Number is not Last Line Number+1")
+        body, star, checksum = line.rpartition(b"*")
+        if not star or not checksum.isdigit() or mp.line_checksum(body) != int(checksum) or \
+                number in self.corrupt_lines:
+            self.corrupt_lines.discard(number)
+            return self._request_resend("checksum mismatch")
+        self.last_line = number
+        return None
+
+# -------------------------------------------------------------------------------
+    def _request_resend(self, error):
+        self.resends += 1
+        return "Error:{}, Last Line: {}\nResend: {}\nok\n".format(error, self.last_line,
+                                                                   self.last_line + 1).encode("ascii")
+
+
+# -------------------------------------------------------------------------------
+def _expected_line(line, no_spaces, packed=True):
+    # What the firmware should end up with for a line sent by the host. Lines sent while packing is off arrive as-is.
+    if not packed:
+        return line.rstrip(b"\r\n")
+    return mp._unified_method_bytes(line, no_spaces).rstrip(b"\r\n")
+
+
+# -------------------------------------------------------------------------------
+def run_loopback(lines, baudrate=115200, no_spaces=True, engine=mp.PackEngineDefault, window=1,
+                 protocol_version=1, reset_at=None, logger=None, timeout=10.0, pipelined=False, adaptive=False,
+                 minimize=0):
+    """Sends the lines through a PackingSerial connected to a FirmwareEmulator, waiting for "ok" before keeping
+    more than `window` lines in flight, and returns a report of the run (see the keys of the returned dict).
+
+    If reset_at is given, the emulated printer is reset before that line is sent and the time until the host has
+    re-synchronized is reported as resyncLatency.
+    """
+    import logging
+    from OctoPrint_MeatPack.pack_cache import normalize_line
+    from OctoPrint_MeatPack.packing_serial import PackingSerial
+
+    if logger is None:
+        logger = logging.getLogger("meatpack.emulator")
+
+    to_send = [line for line in (normalize_line(line) for line in lines) if line]
+
+    emulator = FirmwareEmulator(baudrate, protocol_version)
+    emulator.start()
+
+    oks = threading.Semaphore(0)
+    reading = [True]
+
+    port = PackingSerial(logger, port=emulator.port, baudrate=baudrate, timeout=0.05)
+    port.play_song_on_print_complete = False
+    port.packing_engine = engine
+    port.pipelined_writes = pipelined
+    port.monitor_link = True
+    port.adaptive_packing = adaptive
+    port.minimize_level = minimize
+
+    def read_loop():
+        while reading[0]:
+            try:
+                line = port.readline()
+            except Exception:
+                break
+            if line.startswith(b"ok"):
+                oks.release()
+
+    reader = threading.Thread(target=read_loop)
+    reader.daemon = True
+
+    def wait_for(condition, message):
+        wait_start = time.time()
+        while not condition():
+            if time.time() - wait_start > timeout:
+                raise IOError(message)
+            time.sleep(0.001)
+        return time.time() - wait_start
+
+    def wait_ok():
+        if not oks.acquire(timeout=timeout):
+            raise IOError("Timed out waiting for 'ok' from the emulator")
+
+    resync_latency = None
+
+    try:
+        # The port builds the packing tables for the mode before it starts the handshake, so they aren't timed here
+        # either.
+        mp.get_packing_engine(engine, no_spaces)
+        handshake_start = time.time()
+        port.omit_all_spaces = no_spaces
+        port.packing_enabled = True
+        reader.start()
+
+        wait_for(port._stable_state, "MeatPack handshake with the emulator timed out")
+        handshake_latency = time.time() - handshake_start
+
+        start = time.time()
+        port.begin_link_report()
+        raw_bytes = 0
+        in_flight = 0
+        for idx, line in enumerate(to_send):
+            if idx == reset_at:
+                while in_flight:
+                    wait_ok()
+                    in_flight -= 1
+                handshakes = port.get_transmission_stats()['handshakes']
+                emulator.reset()
+                resync_latency = wait_for(lambda: port.get_transmission_stats()['handshakes'] > handshakes and
+                                          port._stable_state(), "MeatPack re-sync with the emulator timed out")
+
+            if in_flight >= window:
+                wait_ok()
+                in_flight -= 1
+            port.write(line)
+            raw_bytes += len(line)
+            in_flight += 1
+
+        while in_flight:
+            wait_ok()
+            in_flight -= 1
+        elapsed = time.time() - start
+        link_report = port.get_link_report()
+    finally:
+        reading[0] = False
+        if reader.is_alive():
+            reader.join()
+        port.pipelined_writes = False
+        port.close()
+        emulator.stop()
+
+    if minimize:
+        from OctoPrint_MeatPack.gcode_minimizer import GcodeMinimizer
+        minimizer = GcodeMinimizer(minimize)
+        to_send = [minimizer.minimize(line) for line in to_send]
+    # Devices without no-spaces support get the spaces
+    device_no_spaces = no_spaces and protocol_version >= 1
+    expected = [_expected_line(line, device_no_spaces, packed)
+                for line, packed in zip(to_send, emulator.lines_packed)]
+    received = emulator.lines
+    mismatches = [(idx, exp, got) for idx, (exp, got) in enumerate(zip(expected, received)) if exp != got]
+    stats = port.get_transmission_stats()
+
+    return dict(
+        lines=len(to_send),
+        linesReceived=len(received),
+        linesCorrect=min(len(expected), len(received)) - len(mismatches),
+        mismatches=mismatches[:10],
+        elapsed=elapsed,
+        linesPerSec=len(to_send) / elapsed if elapsed > 0 else 0.0,
+        effectiveBytesPerSec=raw_bytes / elapsed if elapsed > 0 else 0.0,
+        packedBytes=stats['packedBytes'],
+        adaptiveSwitches=stats['adaptiveSwitches'],
+        minimizerBytesSaved=stats['minimizerBytesSaved'],
+        totalBytes=stats['totalBytes'],
+        linkBytesPerSec=emulator.bytes_received / elapsed if elapsed > 0 else 0.0,
+        handshakeLatency=handshake_latency,
+        resyncLatency=resync_latency,
+        linkReport=link_report
+    )
+
+
+# -------------------------------------------------------------------------------
+def run_stream(lines, baudrate=115200, no_spaces=True, window=None, corrupt=(), host_every=0, resume_layer=None,
+               logger=None, timeout=30.0):
+    """Packs the lines into a packed stream and sends it through a PackingSerial connected to a FirmwareEmulator,
+    which fails the line numbers in `corrupt` once to have them resent. Every `host_every` acknowledged lines, the
+    host writes "M105" in between, as OctoPrint's temperature polls would. With resume_layer, the stream is resumed
+    where that layer starts. Returns a report of the run (see the keys of the returned dict).
+    """
+    import logging
+    import shutil
+    import tempfile
+    from OctoPrint_MeatPack.pack_cache import normalize_line
+    from OctoPrint_MeatPack.packing_serial import PackingSerial
+    from OctoPrint_MeatPack.packed_stream import PackedStream, PackedStreamWindow, build_packed_stream
+
+    if logger is None:
+        logger = logging.getLogger("meatpack.emulator")
+
+    to_send = [line for line in (normalize_line(line) for line in lines) if line]
+
+    temp_dir = tempfile.mkdtemp(prefix="meatpack-stream-")
+    try:
+        # The source lines as they are, comments and all, for the layer table
+        src_filename = os.path.join(temp_dir, "source.gcode")
+        with open(src_filename, "wb") as src_file:
+            src_file.writelines(line if line[-1:] == b"\n" else line + b"\n" for line in lines)
+        stream_filename = os.path.join(temp_dir, "source.mps")
+        build_packed_stream(src_filename, stream_filename, no_spaces)
+        stream = PackedStream(stream_filename)
+        first_line = stream.resume_line(layer=resume_layer)
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+    emulator = FirmwareEmulator(baudrate, corrupt_lines=corrupt)
+    emulator.start()
+
+    host_oks = [0]
+    reading = [True]
+
+    port = PackingSerial(logger, port=emulator.port, baudrate=baudrate, timeout=0.05)
+    port.play_song_on_print_complete = False
+    port.monitor_link = True
+    port.stream_window = window or PackedStreamWindow
+
+    def read_loop():
+        while reading[0]:
+            try:
+                line = port.readline()
+            except Exception:
+                break
+            # The stream's own "ok"s are swallowed by the port, what comes through is the host's
+            if line.startswith(b"ok"):
+                host_oks[0] += 1
+
+    reader = threading.Thread(target=read_loop)
+    reader.daemon = True
+
+    host_sent = 0
+    try:
+        port.omit_all_spaces = no_spaces
+        port.packing_enabled = True
+        reader.start()
+
+        if not port.wait_for_sync(timeout):
+            raise IOError("MeatPack handshake with the emulator timed out")
+        port.begin_link_report()
+        start = time.time()
+        streamer = port.start_packed_stream(stream, first_line, timeout)
+        next_host = first_line - 1 + host_every
+        while not streamer.wait(0.001):
+            if time.time() - start > timeout:
+                streamer.cancel()
+                raise IOError("Timed out streaming to the emulator")
+            if host_every and streamer.acked >= next_host:
+                port.write(b"M105\n")
+                host_sent += 1
+                next_host += host_every
+        elapsed = time.time() - start
+
+        wait_start = time.time()
+        while host_oks[0] < host_sent and time.time() - wait_start < timeout:
+            time.sleep(0.001)
+        status = streamer.status()
+        link_report = port.get_link_report()
+    finally:
+        reading[0] = False
+        if reader.is_alive():
+            reader.join()
+        port.close()
+        emulator.stop()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    expected = []
+    for number, line in enumerate(to_send[first_line - 1:], first_line):
+        numbered = b"N%d %s" % (number, line[:-1])
+        expected.append(_expected_line(b"%s*%d\n" % (numbered, mp.line_checksum(numbered)), no_spaces))
+    received = [line for line in emulator.lines if line[:1] == b"N"]
+    mismatches = [(idx, exp, got) for idx, (exp, got) in enumerate(zip(expected, received)) if exp != got]
+    raw_bytes = sum(len(line) for line in to_send[first_line - 1:])
+
+    return dict(
+        state=status['state'],
+        error=status['error'],
+        firstLine=first_line,
+        layers=status['layers'],
+        lines=len(expected),
+        linesReceived=len(received),
+        linesCorrect=min(len(expected), len(received)) - len(mismatches),
+        mismatches=mismatches[:10],
+        elapsed=elapsed,
+        linesPerSec=len(expected) / elapsed if elapsed > 0 else 0.0,
+        effectiveBytesPerSec=raw_bytes / elapsed if elapsed > 0 else 0.0,
+        packedBytes=status['bytesSent'],
+        resends=status['resends'],
+        firmwareResends=emulator.resends,
+        hostCommands=host_sent,
+        hostOks=host_oks[0],
+        linkBytesPerSec=emulator.bytes_received / elapsed if elapsed > 0 else 0.0,
+        linkReport=link_report
+    )
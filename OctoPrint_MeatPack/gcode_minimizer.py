@@ -0,0 +1,120 @@
+# G-code minimizer
+# Lossless rewriting of motion lines (G0-G3, G92) ahead of packing, since every character saved is half a packed byte
+# or more. Numbers lose their trailing zeros ("X125.800" -> "X125.8", "E1.000" -> "E1") and the zero before the
+# decimal point ("E0.00907" -> "E.00907"). At the modal level, a feedrate equal to the one the previous move set is
+# dropped as well, which requires seeing every line sent: the tracked feedrate is forgotten whenever it might no longer
+# match the printer's: after other G-codes and tool changes, when a line number doesn't increase (a resend, or line
+# numbers being reset), and when reset() is called (printer reset).
+#
+# Omitting the G-word of repeated moves isn't done, Prusa firmware (and Marlin by default) don't support it.
+import re
+
+from OctoPrint_MeatPack.meatpack import line_checksum
+
+MinimizeOff = 0
+MinimizeNumbers = 1
+MinimizeModal = 2
+
+MinimizeLevels = (MinimizeOff, MinimizeNumbers, MinimizeModal)
+
+# Motion commands, with an optional line number in front. Groups are the line number and the G-code number.
+MinimizerCommandRe = re.compile(br"(?:N(\d+) *)?G(0|1|2|3|92)(?!\d)")
+
+# Commands after which the printer's feedrate is no longer known (other G-codes, tool changes)
+MinimizerResetRe = re.compile(br"(?:N\d+ *)?[GT]\d")
+
+# "125.800" -> "125.8"
+MinimizerTrailingZerosRe = re.compile(br"(\.\d*?[1-9])0+(?!\d)")
+# "125.000" and "125." -> "125"
+MinimizerEmptyFractionRe = re.compile(br"(?<=\d)\.0*(?!\d)")
+# "X0.5" -> "X.5", "X-0.5" -> "X-.5"
+MinimizerLeadingZerosRe = re.compile(br"(?<=[A-Za-z-])0(?=\.)")
+
+MinimizerFeedrateRe = re.compile(br" ?F([-+]?[\d.]+)")
+
+
+class GcodeMinimizer:
+    """Shortens motion lines without changing what they do. Lines must be passed in the order they are sent."""
+
+    def __init__(self, level=MinimizeNumbers):
+        self.level = level
+        self.lines = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.feedrates_dropped = 0
+        self.reset()
+
+# -------------------------------------------------------------------------------
+    def reset(self):
+        """Forgets the tracked feedrate, e.g. after the printer was reset or asked for a resend."""
+        self._feedrate = None
+        self._feedrate_g0 = False
+        self._line_number = -1
+
+# -------------------------------------------------------------------------------
+    @property
+    def bytes_saved(self):
+        return self.bytes_in - self.bytes_out
+
+# -------------------------------------------------------------------------------
+    def minimize(self, line):
+        """Returns the minimized line (bytes), or the line itself if there is nothing to do."""
+        command = MinimizerCommandRe.match(line)
+        if command is None:
+            if self._feedrate is not None and MinimizerResetRe.match(line):
+                self.reset()
+            return line
+
+        # Comments aren't expected (OctoPrint strips them), so such lines are left alone.
+        if b";" in line:
+            self.reset()
+            return line
+
+        cs_idx = line.find(b"*")
+        body = line[:cs_idx] if cs_idx >= 0 else line.rstrip(b"\r\n")
+
+        # The substitutions are comparatively slow, so they only run if there can be something to remove
+        out = body
+        if b"0 " in out or b". " in out or out[-1:] in b"0.":
+            out = MinimizerTrailingZerosRe.sub(br"\1", out)
+            out = MinimizerEmptyFractionRe.sub(b"", out)
+        if b"0." in out:
+            out = MinimizerLeadingZerosRe.sub(b"", out)
+        if self.level >= MinimizeModal and command.group(2) != b"92":
+            line_number = command.group(1)
+            if line_number is not None:
+                line_number = int(line_number)
+                if line_number <= self._line_number:
+                    # Resent (or renumbered) lines: what the printer last accepted isn't known
+                    self.reset()
+                self._line_number = line_number
+            out = self._drop_feedrate(out, command.group(2) == b"0")
+
+        self.lines += 1
+        self.bytes_in += len(line)
+        if out == body:
+            self.bytes_out += len(line)
+            return line
+
+        if cs_idx >= 0:
+            out = b"%s*%d\n" % (out, line_checksum(out))
+        else:
+            out += line[len(body):]
+        self.bytes_out += len(out)
+        return out
+
+# -------------------------------------------------------------------------------
+    def _drop_feedrate(self, body, is_g0):
+        # Switching between G0 and G1-G3 forgets the feedrate, as some firmware keeps a separate one for G0.
+        if is_g0 != self._feedrate_g0:
+            self._feedrate = None
+            self._feedrate_g0 = is_g0
+
+        match = MinimizerFeedrateRe.search(body)
+        if match is None:
+            return body
+        if match.group(1) == self._feedrate:
+            self.feedrates_dropped += 1
+            return body[:match.start()] + body[match.end():]
+        self._feedrate = match.group(1)
+        return body
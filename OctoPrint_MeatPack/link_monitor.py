@@ -0,0 +1,202 @@
+# Serial link saturation monitor
+# Estimates how busy the serial link is from the bytes actually written to the port (10 bits on the wire per byte,
+# with start and stop bits) against the baud rate, in fixed intervals, alongside the rate of "ok" responses. Intervals
+# above the saturation threshold mean the link, not the firmware, limited how fast commands could be sent, which is
+# when the printer is likely to stutter on short segments. A report covers everything since begin_report(), e.g. one
+# print.
+import threading
+import time
+
+LinkMonitorInterval = 1.0
+LinkSaturationThreshold = 0.95
+
+# Most saturated periods kept per report (the longest ones)
+LinkMaxReportedPeriods = 20
+
+
+class LinkMonitor:
+    """Tracks link utilisation and "ok" arrival rate per interval, and summarizes them in reports."""
+
+    def __init__(self, baudrate, threshold=LinkSaturationThreshold, interval=LinkMonitorInterval):
+        self.baudrate = baudrate
+        self.threshold = threshold
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._interval_end = None
+        self._bytes = 0
+        self._oks = 0
+        self.last_utilisation = 0.0
+        self.last_ok_rate = 0.0
+        self._reset_report(time.time())
+
+# -------------------------------------------------------------------------------
+    def _reset_report(self, now):
+        self._report_start = now
+        self._intervals = 0
+        self._saturated_intervals = 0
+        self._total_bytes = 0
+        self._total_oks = 0
+        self._saturated_oks = 0
+        self._peak_utilisation = 0.0
+        # Running sums for the correlation between utilisation and ok rate
+        self._sum_u = self._sum_r = self._sum_uu = self._sum_rr = self._sum_ur = 0.0
+        self._periods = []
+        self._period_count = 0
+        self._period = None
+
+# -------------------------------------------------------------------------------
+    def _close_period(self):
+        period = self._period
+        if period is None:
+            return
+        self._period = None
+        self._period_count += 1
+        self._periods.append(period)
+        if len(self._periods) > LinkMaxReportedPeriods:
+            self._periods.sort(key=lambda p: -p['intervals'])
+            del self._periods[LinkMaxReportedPeriods:]
+
+# -------------------------------------------------------------------------------
+    def _add_interval(self, start, byte_count, oks):
+        utilisation = byte_count * 10.0 / (self.baudrate * self.interval) if self.baudrate else 0.0
+        ok_rate = oks / self.interval
+
+        self.last_utilisation = utilisation
+        self.last_ok_rate = ok_rate
+
+        self._intervals += 1
+        self._total_bytes += byte_count
+        self._total_oks += oks
+        self._sum_u += utilisation
+        self._sum_r += ok_rate
+        self._sum_uu += utilisation * utilisation
+        self._sum_rr += ok_rate * ok_rate
+        self._sum_ur += utilisation * ok_rate
+        if utilisation > self._peak_utilisation:
+            self._peak_utilisation = utilisation
+
+        if utilisation > self.threshold:
+            self._saturated_intervals += 1
+            self._saturated_oks += oks
+            if self._period is None:
+                self._period = dict(start=start - self._report_start, intervals=0, bytes=0, oks=0)
+            self._period['intervals'] += 1
+            self._period['bytes'] += byte_count
+            self._period['oks'] += oks
+        else:
+            self._close_period()
+
+# -------------------------------------------------------------------------------
+    def _advance(self, now):
+        # Closes every interval that has ended by now. Idle intervals are counted in one go.
+        if self._interval_end is None:
+            self._interval_end = now + self.interval
+            return
+        if now < self._interval_end:
+            return
+
+        self._add_interval(self._interval_end - self.interval, self._bytes, self._oks)
+        self._bytes = 0
+        self._oks = 0
+
+        idle = int((now - self._interval_end) / self.interval)
+        if idle:
+            self._close_period()
+            self._intervals += idle
+            self.last_utilisation = 0.0
+            self.last_ok_rate = 0.0
+        self._interval_end += (idle + 1) * self.interval
+
+# -------------------------------------------------------------------------------
+    def record_tx(self, byte_count):
+        """Bytes written to the port."""
+        with self._lock:
+            self._advance(time.time())
+            self._bytes += byte_count
+
+# -------------------------------------------------------------------------------
+    def record_ok(self):
+        """An "ok" line was read from the printer."""
+        with self._lock:
+            self._advance(time.time())
+            self._oks += 1
+
+# -------------------------------------------------------------------------------
+    def live(self):
+        """Utilisation (0..1) and ok/sec of the last complete interval."""
+        with self._lock:
+            self._advance(time.time())
+            return dict(utilisation=self.last_utilisation, okPerSec=self.last_ok_rate,
+                        saturated=self.last_utilisation > self.threshold)
+
+# -------------------------------------------------------------------------------
+    def begin_report(self):
+        with self._lock:
+            now = time.time()
+            self._advance(now)
+            self._reset_report(now)
+
+# -------------------------------------------------------------------------------
+    def report(self):
+        """Summary of the link since begin_report()."""
+        with self._lock:
+            now = time.time()
+            self._advance(now)
+            self._close_period()
+
+            count = self._intervals
+            saturated = self._saturated_intervals
+            unsaturated = count - saturated
+
+            correlation = None
+            if count > 1:
+                var_u = count * self._sum_uu - self._sum_u * self._sum_u
+                var_r = count * self._sum_rr - self._sum_r * self._sum_r
+                if var_u > 0 and var_r > 0:
+                    correlation = (count * self._sum_ur - self._sum_u * self._sum_r) / (var_u * var_r) ** 0.5
+
+            periods = []
+            for period in sorted(self._periods, key=lambda p: p['start']):
+                duration = period['intervals'] * self.interval
+                periods.append(dict(
+                    start=period['start'],
+                    duration=duration,
+                    utilisation=period['bytes'] * 10.0 / (self.baudrate * duration) if self.baudrate else 0.0,
+                    okPerSec=period['oks'] / duration
+                ))
+
+            return dict(
+                baudrate=self.baudrate,
+                threshold=self.threshold,
+                duration=now - self._report_start,
+                measuredTime=count * self.interval,
+                bytesSent=self._total_bytes,
+                meanUtilisation=self._sum_u / count if count else 0.0,
+                peakUtilisation=self._peak_utilisation,
+                saturatedTime=saturated * self.interval,
+                saturatedFraction=float(saturated) / count if count else 0.0,
+                saturatedPeriods=self._period_count,
+                okPerSecSaturated=self._saturated_oks / (saturated * self.interval) if saturated else None,
+                okPerSecUnsaturated=(self._total_oks - self._saturated_oks) / (unsaturated * self.interval)
+                if unsaturated else None,
+                utilisationOkCorrelation=correlation,
+                longestPeriods=periods
+            )
+
+
+# -------------------------------------------------------------------------------
+def format_report(report):
+    """One-line human readable summary of a report()."""
+    if not report['measuredTime']:
+        return "Link at {} baud: not enough data (less than one interval measured).".format(report['baudrate'])
+    text = "Link at {} baud: mean utilisation {:.0%}, peak {:.0%}; above {:.0%} for {:.0f} sec ({:.1%} of the time) " \
+           "in {} period(s).".format(report['baudrate'], report['meanUtilisation'], report['peakUtilisation'],
+                                     report['threshold'], report['saturatedTime'], report['saturatedFraction'],
+                                     report['saturatedPeriods'])
+    if report['okPerSecSaturated'] is not None and report['okPerSecUnsaturated'] is not None:
+        text += " ok/sec while saturated {:.1f} vs. {:.1f} otherwise.".format(report['okPerSecSaturated'],
+                                                                             report['okPerSecUnsaturated'])
+    if report['saturatedFraction'] > 0.05:
+        text += " The serial link was likely a bottleneck (consider packing with whitespace removal, Arc Welder, " \
+                "or a higher baud rate)."
+    return text
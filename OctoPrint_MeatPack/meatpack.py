@@ -1,7 +1,18 @@
 # Core MeatPack methods
 # Packs a data stream, byte by byte
+import collections
+import mmap
+import os
+import re
+import sys
 from array import array
 
+# Optional compiled packer, built by setup.py when a C compiler is available (see PackEngineNative)
+try:
+    from OctoPrint_MeatPack import _cpacker
+except ImportError:
+    _cpacker = None
+
 # For faster lookup and access
 MeatPackLookupTablePackable = array('B', 256 * [0])
 MeatPackLookupTableValue = array('B', 256 * [0])
@@ -71,6 +82,99 @@ MPCommand_SignalByte        = 0xFF
 MeatPack_BothUnpackable = 0b11111111
 
 
+# Packing engines. "classic" is the reference character-pair encoder working on str, "table" is the bulk
+# encoder working on bytes with a precomputed pair table. Both produce identical output for ASCII g-code. "native"
+# is the table engine compiled as a C extension (byte-identical output), only available if the extension is built.
+PackEngineClassic = "classic"
+PackEngineTable = "table"
+PackEngineNative = "native"
+
+# Engine used by the serial write path unless configured otherwise. The table and native engines never decode the
+# line, so each line goes from bytes to packed bytes without an intermediate str.
+PackEngineDefault = PackEngineNative if _cpacker is not None else PackEngineTable
+
+# Read size and output block size used when packing files, so memory use doesn't depend on file size.
+FileChunkSize = 64 * 1024
+FileBlockSize = 64 * 1024
+
+# Amount of text handed to each worker process by pack_file_parallel()
+ParallelChunkSize = 1024 * 1024
+
+# Amount of a mapped file packed at a time by pack_file_mmap(), and the size of its output buffer. Packed data is at
+# most 1.5 times the size of its source (three bytes per pair of characters), plus a few bytes per line.
+MapBlockSize = 1024 * 1024
+MapBufferSize = MapBlockSize * 3 // 2 + 64 * 1024
+
+# A \r not followed by \n, which ends a line when a file is read as text (classic Mac line endings)
+LoneCarriageReturnRe = re.compile(br"\r(?!\n)")
+
+# Pair tables for the table engine, keyed by no-spaces mode. Each table has 65536 entries (one per pair of
+# input bytes, indexed the same way array('H') reads them) holding the packed output for that pair.
+MeatPackPairTables = {}
+
+# Character tables and shared Packer instances, keyed by no-spaces mode
+MeatPackCharTables = {}
+MeatPackPackers = {}
+
+
+# -------------------------------------------------------------------------------
+def _build_case_table(letters):
+    table = bytearray(range(256))
+    for c in bytearray(letters):
+        table[c] = ord(chr(c).upper())
+    return bytes(table)
+
+
+# bytes.translate() tables fixing the case of packable letters in G-lines, keyed by no-spaces mode. Spaces are
+# removed in the same pass (as the delete argument), so a G-line is unified with a single copy.
+MeatPackCaseTables = {
+    False: _build_case_table(b"xg"),
+    True: _build_case_table(b"exg"),
+}
+
+
+# -------------------------------------------------------------------------------
+def _build_fold_shifts(length):
+    # Right shifts (in bits, largest first) folding a little endian integer of `length` bytes onto its lowest byte
+    shift = 8
+    while shift < length * 8:
+        shift <<= 1
+    shifts = []
+    shift >>= 1
+    while shift >= 8:
+        shifts.append(shift)
+        shift >>= 1
+    return tuple(shifts)
+
+
+# Fold shifts for lines up to this many bytes are precomputed (longer ones are computed when needed)
+MeatPackChecksumMaxTableLength = 256
+MeatPackChecksumShifts = [_build_fold_shifts(n) for n in range(MeatPackChecksumMaxTableLength + 1)]
+
+# Python 2 has no int.from_bytes(), the checksum is computed byte by byte there
+MeatPackIntFromBytes = hasattr(int, "from_bytes")
+
+
+# -------------------------------------------------------------------------------
+def line_checksum(data):
+    """XOR of all bytes of data, i.e. the checksum of a g-code line (without the "*"). The bytes are read into one
+    integer which is folded onto its lowest byte, so the work is a few big integer operations instead of a step per
+    character."""
+    if not MeatPackIntFromBytes:
+        checksum = 0
+        for v in bytearray(data):
+            checksum ^= v
+        return checksum
+
+    length = len(data)
+    shifts = MeatPackChecksumShifts[length] if length <= MeatPackChecksumMaxTableLength \
+        else _build_fold_shifts(length)
+    value = int.from_bytes(data, "little")
+    for shift in shifts:
+        value ^= value >> shift
+    return value & 0xFF
+
+
 # -------------------------------------------------------------------------------
 def initialize():
     initialize_arrays()
@@ -111,8 +215,52 @@ def get_command_bytes(command):
     return out
 
 
+# Tokens of a "[MP]" state report, e.g. "[MP] ON PV01 NSP"
+MPResponseTokenRe = re.compile(br" (?:PV(\d+)|(ON)|(OFF)|(NSP)|(ESP))")
+
+
+class MPResponse:
+    """Packing state reported by the device in a "[MP]" line. Fields the line doesn't mention are None."""
+
+    __slots__ = ("protocol_version", "enabled", "no_spaces")
+
+    def __init__(self, protocol_version=None, enabled=None, no_spaces=None):
+        self.protocol_version = protocol_version
+        self.enabled = enabled
+        self.no_spaces = no_spaces
+
+    def __repr__(self):
+        return "MPResponse(protocol_version={!r}, enabled={!r}, no_spaces={!r})".format(
+            self.protocol_version, self.enabled, self.no_spaces)
+
+
 # -------------------------------------------------------------------------------
-def _unified_method(line):
+def parse_response(line):
+    """Parses a "[MP]" line (bytes) in one pass. If both states of a flag appear, ON/NSP win, and the first protocol
+    version is used."""
+    response = MPResponse()
+    for version, on, off, nsp, esp in MPResponseTokenRe.findall(line):
+        if version:
+            if response.protocol_version is None:
+                response.protocol_version = int(version)
+        elif on:
+            response.enabled = True
+        elif off:
+            if response.enabled is None:
+                response.enabled = False
+        elif nsp:
+            response.no_spaces = True
+        elif response.no_spaces is None:
+            response.no_spaces = False
+    return response
+
+
+# -------------------------------------------------------------------------------
+def _unified_method(line, no_spaces=None):
+    # no_spaces defaults to the current global mode.
+    if no_spaces is None:
+        no_spaces = MeatPackOmitWhitespaces
+
     # If it's an "G" command, then remove whitespace.
     m_idx = line.find('G')
     if m_idx >= 0:
@@ -126,22 +274,23 @@ def _unified_method(line):
             # Fix case capitalization for relevant letters (only packable ones)
             # It's faster to chain them together like this then make a
             # separate assignment/call to replace.
-            if MeatPackOmitWhitespaces:
-                line = line.replace('e', 'E').replace('x', 'X').replace('g', 'G')
+            if no_spaces:
+                fixed = line.replace('e', 'E').replace('x', 'X').replace('g', 'G')
             else:
-                line = line.replace('x', 'X').replace('g', 'G')
+                fixed = line.replace('x', 'X').replace('g', 'G')
 
             # Strip whitespace
-            stripped = line.replace(' ', '')
+            stripped = fixed.replace(' ', '')
+
+            # Nothing changed, so a checksum is still valid
+            if stripped == line:
+                return line
 
             # Check for asterisk, meaning there is a checksum we need to recompute after
             # stripping whitespace out
-            if '*' in line:
-                checksum = 0
+            if '*' in stripped:
                 stripped = stripped.partition('*')[0]
-                for i, v in enumerate(stripped):
-                    checksum ^= ord(v)
-                return stripped + "*" + str(checksum) + "\n"
+                return stripped + "*" + str(line_checksum(stripped.encode("latin-1"))) + "\n"
             return stripped
     # otherwise return line
     return line
@@ -149,101 +298,455 @@ def _unified_method(line):
 
 # -------------------------------------------------------------------------------
 def pack_line(line, logger=None):
-    bts = bytearray()
+    return get_packer(MeatPackOmitWhitespaces).pack_line_classic(line, logger)
 
-    if line[0] == ';':
-        return bts
-    elif line[0] == '\n':
-        return bts
-    elif line[0] == '\r':
-        return bts
-    elif len(line) < 2:
-        return bts
-    elif ';' in line:
-        line = line.partition(';')[0].rstrip() + "\n"
 
-    line = _unified_method(line)
+# -------------------------------------------------------------------------------
+def _unified_method_bytes(line, no_spaces=None):
+    # Same as _unified_method(), but for bytes input. no_spaces defaults to the current global mode.
+    if no_spaces is None:
+        no_spaces = MeatPackOmitWhitespaces
 
-    if logger:
-        logger.info("[Test] Line sent: {}".format(line))
+    m_idx = line.find(b'G')
+    if m_idx >= 0:
 
-    line_len = len(line)
+        # Check to see if the G is at the end of the line
+        if m_idx + 1 >= len(line):
+            return line
+
+        # check to see if the "G" has a number after.
+        if line[m_idx + 1:m_idx + 2].isdigit():
+            # Fix case and strip whitespace in one pass
+            stripped = line.translate(MeatPackCaseTables[no_spaces], b' ')
+
+            # Nothing changed (no spaces, case already right), so a checksum is still valid
+            if stripped == line:
+                return line
+
+            cs_idx = stripped.find(b'*')
+            if cs_idx >= 0:
+                stripped = stripped[:cs_idx]
+                return b"%s*%d\n" % (stripped, line_checksum(stripped))
+            return stripped
+    # otherwise return line
+    return line
 
-    for line_idx in range(0, line_len, 2):
-        skip_last = False
-        if line_idx == (line_len - 1):
-            skip_last = True
 
-        char_1 = line[line_idx]
+# -------------------------------------------------------------------------------
+def _get_char_tables(no_spaces):
+    # Returns the (packable, value) tables for the mode as tuples indexed by character code.
+    tables = MeatPackCharTables.get(no_spaces)
+    if tables is not None:
+        return tables
 
-        # If we are at the last character and it needs to be skipped,
-        # pack a benign character like \n into it.
-        char_2 = '\n' if skip_last else line[line_idx + 1]
+    packable = 256 * [0]
+    value = 256 * [0]
 
-        c1_p = is_packable(char_1)
-        c2_p = is_packable(char_2)
+    for char, val in MeatPackReverseLookupTbl.items():
+        packable[ord(char)] = 1
+        value[ord(char)] = val
+
+    if no_spaces:
+        value[ord(MeatPackSpaceReplacedCharacter)] = MeatPackReverseLookupTbl.get(' ')
+        packable[ord(MeatPackSpaceReplacedCharacter)] = 1
+        packable[ord(' ')] = 0
 
-        if c1_p:
-            if c2_p:
-                bts.append(pack_chars(char_1, char_2))
+    tables = MeatPackCharTables[no_spaces] = (tuple(packable), tuple(value))
+    return tables
+
+
+# -------------------------------------------------------------------------------
+def _build_pair_table(no_spaces):
+    packable, value = _get_char_tables(no_spaces)
+
+    # array('H') reads pairs in native byte order, so the first character of a pair lands in the low byte on
+    # little-endian hosts and in the high byte on big-endian ones.
+    first_shift, second_shift = (0, 8) if sys.byteorder == "little" else (8, 0)
+    single = [bytes(bytearray([i])) for i in range(256)]
+    table = [b""] * 65536
+
+    for c1 in range(256):
+        for c2 in range(256):
+            if packable[c1]:
+                if packable[c2]:
+                    packed = single[((value[c2] & 0xF) << 4) | (value[c1] & 0xF)]
+                else:
+                    packed = bytes(bytearray([0xF0 | (value[c1] & 0xF), c2]))
             else:
-                bts.append(pack_chars(char_1, "\0"))
-                bts.append(ord(char_2))
-        else:
-            if c2_p:
-                bts.append(pack_chars("\0", char_2))
-                bts.append(ord(char_1))
+                if packable[c2]:
+                    packed = bytes(bytearray([((value[c2] & 0xF) << 4) | 0xF, c1]))
+                else:
+                    packed = bytes(bytearray([MeatPack_BothUnpackable, c1, c2]))
+            table[(c1 << first_shift) | (c2 << second_shift)] = packed
+
+    return tuple(table)
+
+
+# -------------------------------------------------------------------------------
+def get_pair_table(no_spaces):
+    """Returns the (lazily built, shared) pair table for the given no-spaces mode."""
+    table = MeatPackPairTables.get(no_spaces)
+    if table is None:
+        table = MeatPackPairTables[no_spaces] = _build_pair_table(no_spaces)
+    return table
+
+
+class Packer:
+    """Packs lines for one no-spaces mode.
+
+    A Packer only ever reads its tables, which are built once per mode and shared by all packers of that mode,
+    so any number of them (e.g. one per serial port) can pack concurrently without locking and without touching
+    the module's global mode. get_packer() returns the shared instance for a mode.
+    """
+
+    __slots__ = ("no_spaces", "_packable", "_value", "_pair_table")
+
+    def __init__(self, no_spaces=False):
+        self.no_spaces = bool(no_spaces)
+        self._packable, self._value = _get_char_tables(self.no_spaces)
+        self._pair_table = get_pair_table(self.no_spaces)
+
+# -------------------------------------------------------------------------------
+    def is_packable(self, char):
+        return self._packable[ord(char)] == 1
+
+# -------------------------------------------------------------------------------
+    def pack_chars(self, low, high):
+        return ((self._value[ord(high)] & 0xF) << 4) | (self._value[ord(low)] & 0xF)
+
+# -------------------------------------------------------------------------------
+    def unify(self, line):
+        """Case fixing, whitespace removal and checksum update of a G-line (bytes in, bytes out)."""
+        return _unified_method_bytes(line, self.no_spaces)
+
+# -------------------------------------------------------------------------------
+    def pack_line(self, line, logger=None):
+        """Table-driven packing, taking and returning bytes.
+
+        Output is byte-identical to pack_line_classic() for ASCII input. Each pair of characters is packed with a
+        single lookup into the pair table.
+        """
+        first = line[:1]
+        if first == b';' or first == b'\n' or first == b'\r' or len(line) < 2:
+            return b""
+
+        comment_idx = line.find(b';')
+        if comment_idx >= 0:
+            line = line[:comment_idx].rstrip() + b"\n"
+
+        line = _unified_method_bytes(line, self.no_spaces)
+
+        if logger:
+            logger.info("[Test] Line sent: {}".format(line))
+
+        # Pad odd-length lines with a benign \n, same as pack_line_classic()
+        if len(line) & 1:
+            line += b"\n"
+
+        table = self._pair_table
+        return b"".join([table[pair] for pair in array('H', line)])
+
+# -------------------------------------------------------------------------------
+    def pack_line_native(self, line, logger=None):
+        """Compiled equivalent of pack_line() (bytes in, bytes out). Only usable if the extension is built."""
+        if logger:
+            return self.pack_line(line, logger)
+        return _cpacker.pack_line(line, self.no_spaces)
+
+# -------------------------------------------------------------------------------
+    def pack_line_classic(self, line, logger=None):
+        """Reference character-pair packing. Takes a str (bytes are decoded as UTF-8), returns a bytearray."""
+        if isinstance(line, (bytes, bytearray)):
+            line = line.decode("UTF-8", errors="ignore")
+
+        bts = bytearray()
+
+        if not line:
+            return bts
+        elif line[0] == ';':
+            return bts
+        elif line[0] == '\n':
+            return bts
+        elif line[0] == '\r':
+            return bts
+        elif len(line) < 2:
+            return bts
+        elif ';' in line:
+            line = line.partition(';')[0].rstrip() + "\n"
+
+        line = _unified_method(line, self.no_spaces)
+
+        if logger:
+            logger.info("[Test] Line sent: {}".format(line))
+
+        line_len = len(line)
+
+        for line_idx in range(0, line_len, 2):
+            skip_last = False
+            if line_idx == (line_len - 1):
+                skip_last = True
+
+            char_1 = line[line_idx]
+
+            # If we are at the last character and it needs to be skipped,
+            # pack a benign character like \n into it.
+            char_2 = '\n' if skip_last else line[line_idx + 1]
+
+            c1_p = self.is_packable(char_1)
+            c2_p = self.is_packable(char_2)
+
+            if c1_p:
+                if c2_p:
+                    bts.append(self.pack_chars(char_1, char_2))
+                else:
+                    bts.append(self.pack_chars(char_1, "\0"))
+                    bts.append(ord(char_2))
             else:
-                bts.append(MeatPack_BothUnpackable)
-                bts.append(ord(char_1))
-                bts.append(ord(char_2))
+                if c2_p:
+                    bts.append(self.pack_chars("\0", char_2))
+                    bts.append(ord(char_1))
+                else:
+                    bts.append(MeatPack_BothUnpackable)
+                    bts.append(ord(char_1))
+                    bts.append(ord(char_2))
 
-    return bts
+        return bts
 
 
 # -------------------------------------------------------------------------------
-def pack_file(in_filename, out_filename):
-    in_file = open(in_filename, "r")
-    out_file = open(out_filename, "wb")
+def get_packer(no_spaces):
+    """Returns the shared Packer for the given no-spaces mode."""
+    packer = MeatPackPackers.get(no_spaces)
+    if packer is None:
+        packer = MeatPackPackers[no_spaces] = Packer(no_spaces)
+    return packer
 
-    if not in_file.readable():
-        raise IOError("cannot read input file")
-    if not out_file.writable():
-        raise IOError("cannot write to output file")
 
-    file_data_lines = in_file.readlines()
-    file_idx = 0
+# -------------------------------------------------------------------------------
+def pack_line_table(line, logger=None, no_spaces=None):
+    """Table-driven equivalent of pack_line(), taking and returning bytes (see Packer.pack_line()).
 
-    bts = bytearray()
+    Packs in the given no-spaces mode, or the current global mode if not given.
+    """
+    if no_spaces is None:
+        no_spaces = MeatPackOmitWhitespaces
+    return get_packer(no_spaces).pack_line(line, logger)
 
-    bts.append(MPCommand_SignalByte)
-    bts.append(MPCommand_SignalByte)
-    bts.append(MPCommand_EnablePacking)
 
-    for line in file_data_lines:
-        bts += pack_line(line)
+# -------------------------------------------------------------------------------
+def pack_line_native(line, logger=None, no_spaces=None):
+    """Compiled equivalent of pack_line_table(). Only usable if the extension is built."""
+    if no_spaces is None:
+        no_spaces = MeatPackOmitWhitespaces
+    return get_packer(no_spaces).pack_line_native(line, logger)
 
-    bts.append(MPCommand_SignalByte)
-    bts.append(MPCommand_SignalByte)
-    bts.append(MPCommand_ResetAll)
 
-    out_file.write(bts)
-    out_file.flush()
+# -------------------------------------------------------------------------------
+def _load_native_tables():
+    # The compiled packer works from the same character and case tables as the Python engines
+    for no_spaces in (False, True):
+        packable, value = _get_char_tables(no_spaces)
+        _cpacker.set_tables(no_spaces, bytes(bytearray(packable)), bytes(bytearray(value)),
+                            MeatPackCaseTables[no_spaces])
+
+
+# -------------------------------------------------------------------------------
+def _pack_line_classic_bytes(line):
+    return pack_line(line.decode("UTF-8", errors="ignore"))
+
+
+# Packing engines by name. Every entry takes the raw line as bytes and returns the packed bytes, packing in the
+# current global mode.
+PackingEngines = {
+    PackEngineClassic: _pack_line_classic_bytes,
+    PackEngineTable: pack_line_table,
+}
+
+# The Packer method implementing each engine (bytes in, packed bytes out)
+PackerEngineMethods = {
+    PackEngineClassic: "pack_line_classic",
+    PackEngineTable: "pack_line",
+}
+
+if _cpacker is not None:
+    _load_native_tables()
+    PackingEngines[PackEngineNative] = pack_line_native
+    PackerEngineMethods[PackEngineNative] = "pack_line_native"
+
+
+# -------------------------------------------------------------------------------
+def get_packing_engine(name, no_spaces=None):
+    """Returns the bytes-in/bytes-out packing function for the given engine name (the default one if unknown).
+
+    Without no_spaces, the function packs in the current global mode. With it, the function is bound to the
+    shared Packer for that mode and doesn't depend on the global mode at all.
+    """
+    if no_spaces is None:
+        return PackingEngines.get(name, PackingEngines[PackEngineDefault])
+    method = PackerEngineMethods.get(name, PackerEngineMethods[PackEngineDefault])
+    return getattr(get_packer(no_spaces), method)
 
 
 # -------------------------------------------------------------------------------
-def strip_comments(in_filename, out_filename):
-    in_file = open(in_filename, "r")
-    out_file = open(out_filename, "wb")
+def _iter_file_lines(in_file, chunk_size=FileChunkSize, progress=None):
+    # Yields the lines of a text file (with their newline) while only holding one chunk in memory at a time.
+    # progress(done, total) is called after every chunk, in characters read vs. file size in bytes.
+    total = os.fstat(in_file.fileno()).st_size
+    done = 0
+    tail = ""
 
-    if not in_file.readable():
-        raise IOError("cannot read input file")
-    if not out_file.writable():
-        raise IOError("cannot write to output file")
+    while True:
+        chunk = in_file.read(chunk_size)
+        if not chunk:
+            break
+        done += len(chunk)
+
+        lines = (tail + chunk).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line + "\n"
+
+        if progress:
+            progress(min(done, total), total)
+
+    if tail:
+        yield tail
+
+
+# -------------------------------------------------------------------------------
+def _iter_line_chunks(in_file, chunk_size=ParallelChunkSize, progress=None):
+    # Yields chunks of roughly chunk_size characters, each ending on a line boundary (except possibly the last).
+    total = os.fstat(in_file.fileno()).st_size
+    done = 0
+    tail = ""
+
+    while True:
+        chunk = in_file.read(chunk_size)
+        if not chunk:
+            break
+        done += len(chunk)
+
+        data = tail + chunk
+        cut = data.rfind("\n") + 1
+        tail = data[cut:]
+        if cut:
+            yield data[:cut]
+
+        if progress:
+            progress(min(done, total), total)
+
+    if tail:
+        yield tail
+
+
+# -------------------------------------------------------------------------------
+def _get_file_header(no_spaces):
+    bts = get_command_bytes(MPCommand_EnablePacking)
+    if no_spaces:
+        bts += get_command_bytes(MPCommand_EnableNoSpaces)
+    return bts
+
+
+# -------------------------------------------------------------------------------
+def _pack_chunk(chunk, no_spaces):
+    # Worker for pack_file_parallel()
+    try:
+        data = chunk.encode("ascii")
+    except UnicodeEncodeError:
+        # The table engine only matches pack_line() for ASCII, fall back for anything else.
+        packer = get_packer(no_spaces)
+        lines = chunk.split("\n")
+        last = lines.pop()
+        bts = bytearray()
+        for line in lines:
+            bts += packer.pack_line_classic(line + "\n")
+        if last:
+            bts += packer.pack_line_classic(last)
+        return bytes(bts)
+
+    return pack_block(data, no_spaces)
+
+
+# -------------------------------------------------------------------------------
+def _pack_block_python(data, no_spaces):
+    packer = get_packer(no_spaces)
+    lines = data.split(b"\n")
+    last = lines.pop()
+    out = [packer.pack_line(line + b"\n") for line in lines]
+    if last:
+        out.append(packer.pack_line(last))
+    return b"".join(out)
 
-    file_data_lines = in_file.readlines()
 
-    for line in file_data_lines:
+# -------------------------------------------------------------------------------
+def pack_block(data, no_spaces=False):
+    """Packs a block of lines (bytes) with the table engine, compiled if available: each line with its newline, and
+    the text after the last newline, if any, as it is. Returns the packed lines concatenated."""
+    if _cpacker is not None:
+        return _cpacker.pack_lines(data, no_spaces)
+    return _pack_block_python(data, no_spaces)
+
+
+# -------------------------------------------------------------------------------
+def pack_file_parallel(in_filename, out_filename, no_spaces=False, workers=None, chunk_size=ParallelChunkSize,
+                       progress=None):
+    """Same as pack_file(), but packs chunks of whole lines in a pool of worker processes.
+
+    Output is written in order as chunks complete, with at most two chunks per worker in flight at a time. On Python 2
+    without the "futures" backport the file is packed in this process, by pack_file_mmap().
+    """
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        pack_file_mmap(in_filename, out_filename, no_spaces, progress)
+        return
+
+    if workers is None:
+        import multiprocessing
+        try:
+            workers = multiprocessing.cpu_count()
+        except NotImplementedError:
+            workers = 1
+
+    with open(in_filename, "r") as in_file, open(out_filename, "wb") as out_file, \
+            ProcessPoolExecutor(workers) as pool:
+        out_file.write(_get_file_header(no_spaces))
+
+        pending = collections.deque()
+        for chunk in _iter_line_chunks(in_file, chunk_size, progress):
+            pending.append(pool.submit(_pack_chunk, chunk, no_spaces))
+            if len(pending) >= workers * 2:
+                out_file.write(pending.popleft().result())
+
+        while pending:
+            out_file.write(pending.popleft().result())
+
+        out_file.write(get_command_bytes(MPCommand_ResetAll))
+
+
+# -------------------------------------------------------------------------------
+def iter_pack_file(in_file, chunk_size=FileChunkSize, block_size=FileBlockSize, progress=None):
+    """Generator version of pack_file(). Packs an open text file incrementally and yields the packed stream
+    (including the enable/reset command words) in blocks of roughly block_size bytes."""
+    bts = _get_file_header(MeatPackOmitWhitespaces)
+
+    for line in _iter_file_lines(in_file, chunk_size, progress):
+        bts += pack_line(line)
+        if len(bts) >= block_size:
+            yield bytes(bts)
+            del bts[:]
+
+    bts += get_command_bytes(MPCommand_ResetAll)
+    yield bytes(bts)
+
+
+# -------------------------------------------------------------------------------
+def iter_strip_comments(in_file, chunk_size=FileChunkSize, block_size=FileBlockSize, progress=None):
+    """Generator version of strip_comments(). Yields the stripped file as UTF-8 in blocks of roughly
+    block_size bytes."""
+    bts = bytearray()
+
+    for line in _iter_file_lines(in_file, chunk_size, progress):
         if line[0] == ';':
             continue
         if line[0] == '\n':
@@ -254,4 +757,127 @@ def strip_comments(in_filename, out_filename):
             continue
         if ';' in line:
             line = line.split(';')[0].rstrip() + "\n"
-        out_file.write(line.encode("UTF-8"))
+        bts += line.encode("UTF-8")
+        if len(bts) >= block_size:
+            yield bytes(bts)
+            del bts[:]
+
+    if bts:
+        yield bytes(bts)
+
+
+# -------------------------------------------------------------------------------
+def pack_file(in_filename, out_filename, progress=None):
+    pack_file_mmap(in_filename, out_filename, MeatPackOmitWhitespaces, progress)
+
+
+# -------------------------------------------------------------------------------
+def _mapped_block_end(mapped, start):
+    # End of the block of whole lines starting at start: the last line ending within MapBlockSize bytes, or the
+    # first line if it's longer
+    end = mapped.rfind(b"\n", start, start + MapBlockSize) + 1
+    if end <= start:
+        end = mapped.find(b"\n", start + MapBlockSize) + 1 or len(mapped)
+    return end
+
+
+# -------------------------------------------------------------------------------
+def _pack_mapped_native(mapped, out_file, no_spaces, progress):
+    # The compiled packer reads the lines straight from the mapping and writes into the output buffer.
+    size = len(mapped)
+    out = bytearray(MapBufferSize)
+    start = 0
+    with memoryview(mapped) as view, memoryview(out) as out_view:
+        while start < size:
+            end = _mapped_block_end(mapped, start)
+            consumed, written = _cpacker.pack_lines_into(view[start:end], out, no_spaces, True)
+            out_file.write(out_view[:written])
+            if not consumed:
+                # A line that might not fit into the output buffer
+                end = mapped.find(b"\n", start) + 1 or size
+                line = mapped[start:end]
+                if line.endswith(b"\r\n"):
+                    line = line[:-2] + b"\n"
+                out_file.write(_cpacker.pack_line(line, no_spaces))
+                consumed = end - start
+            start += consumed
+            if progress:
+                progress(start, size)
+
+
+# -------------------------------------------------------------------------------
+def _pack_mapped_python(mapped, out_file, no_spaces, progress):
+    # Splitting a block of lines at once is much faster than finding each line in the mapping from Python.
+    size = len(mapped)
+    out = bytearray(MapBufferSize)
+    used = 0
+    start = 0
+    with memoryview(out) as out_view:
+        while start < size:
+            end = _mapped_block_end(mapped, start)
+            block = mapped[start:end]
+            if b"\r\n" in block:
+                block = block.replace(b"\r\n", b"\n")
+
+            packed = _pack_block_python(block, no_spaces)
+            if used + len(packed) > len(out):
+                out_file.write(out_view[:used])
+                used = 0
+            if len(packed) > len(out):
+                out_file.write(packed)
+            else:
+                out[used:used + len(packed)] = packed
+                used += len(packed)
+
+            start = end
+            if progress:
+                progress(start, size)
+        out_file.write(out_view[:used])
+
+
+# -------------------------------------------------------------------------------
+def _pack_text_file(in_filename, out_file, no_spaces, progress):
+    # Reads the file as text, line by line, as pack_file() did before files were mapped
+    pack_line = get_packer(no_spaces).pack_line_classic
+    bts = bytearray()
+    with open(in_filename, "r") as in_file:
+        for line in _iter_file_lines(in_file, progress=progress):
+            bts += pack_line(line)
+            if len(bts) >= FileBlockSize:
+                out_file.write(bts)
+                del bts[:]
+    out_file.write(bts)
+
+
+# -------------------------------------------------------------------------------
+def pack_file_mmap(in_filename, out_filename, no_spaces=False, progress=None):
+    """Packs a g-code file in a single pass over it, mapped into memory: lines are found and packed where they are,
+    as bytes (no decoding), and the packed data goes through a reused output buffer. Uses the compiled packer if
+    available. As when reading text, lines ending in \\r\\n are packed as if they ended in \\n. Output matches
+    pack_file_parallel() for ASCII files; other bytes are packed as the table engine packs them while printing.
+
+    Lines are only found at \\n. A file with a lone \\r, which also ends a line in text, is read as text instead.
+
+    progress(done, total) is called after every block, in bytes of the source file.
+    """
+    with open(in_filename, "rb") as in_file, open(out_filename, "wb") as out_file:
+        out_file.write(_get_file_header(no_spaces))
+        if os.fstat(in_file.fileno()).st_size:
+            mapped = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if mapped.find(b"\r") >= 0 and LoneCarriageReturnRe.search(mapped):
+                    _pack_text_file(in_filename, out_file, no_spaces, progress)
+                elif _cpacker is not None:
+                    _pack_mapped_native(mapped, out_file, no_spaces, progress)
+                else:
+                    _pack_mapped_python(mapped, out_file, no_spaces, progress)
+            finally:
+                mapped.close()
+        out_file.write(get_command_bytes(MPCommand_ResetAll))
+
+
+# -------------------------------------------------------------------------------
+def strip_comments(in_filename, out_filename, progress=None):
+    with open(in_filename, "r") as in_file, open(out_filename, "wb") as out_file:
+        for block in iter_strip_comments(in_file, progress=progress):
+            out_file.write(block)
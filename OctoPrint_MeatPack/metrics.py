@@ -0,0 +1,217 @@
+# Transmission metrics
+# Rolling-window rates and fixed-bucket histograms for the serial write path, exported as a dict for the API and in
+# the Prometheus text exposition format. Recording takes a lock, so the comm thread, the monitor thread and the
+# pipeline threads can all report into the same instance.
+import bisect
+import threading
+import time
+
+# Monotonic high resolution clock where available
+clock = getattr(time, "perf_counter", time.time)
+
+# Span and slot width (seconds) of the rolling rates
+MetricsWindow = 60.0
+MetricsResolution = 1.0
+
+# Histogram bucket upper bounds, in seconds
+PackTimeBuckets = (2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 5e-3)
+WriteLatencyBuckets = (5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 5e-2)
+HandshakeBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+MetricsPercentiles = (0.5, 0.9, 0.99)
+
+
+class RollingCounter:
+    """Sum of recorded values over the last `window` seconds, kept in a ring of `resolution` wide slots."""
+
+    def __init__(self, window=MetricsWindow, resolution=MetricsResolution):
+        self.window = window
+        self.resolution = resolution
+        self.total = 0
+        slot_count = max(1, int(round(window / resolution)))
+        self._slots = [0] * slot_count
+        self._slot_ids = [-1] * slot_count
+        self._start = None
+
+# -------------------------------------------------------------------------------
+    def add(self, value, now):
+        slot_id = int(now / self.resolution)
+        pos = slot_id % len(self._slots)
+        if self._slot_ids[pos] != slot_id:
+            self._slot_ids[pos] = slot_id
+            self._slots[pos] = 0
+        self._slots[pos] += value
+        self.total += value
+        if self._start is None:
+            self._start = now
+
+# -------------------------------------------------------------------------------
+    def rate(self, now):
+        """Average per second over the window (or since the first value, if that is more recent)."""
+        if self._start is None:
+            return 0.0
+        newest = int(now / self.resolution)
+        oldest = newest - len(self._slots)
+        window_sum = 0
+        for value, slot_id in zip(self._slots, self._slot_ids):
+            if oldest < slot_id <= newest:
+                window_sum += value
+        span = min(self.window, max(now - self._start, self.resolution))
+        return window_sum / span
+
+
+class Histogram:
+    """Fixed-bucket histogram (Prometheus style: a value is counted in the first bucket whose bound is >= it)."""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+# -------------------------------------------------------------------------------
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+# -------------------------------------------------------------------------------
+    def percentile(self, q):
+        """Estimate of the q-th quantile (0..1), interpolated linearly within its bucket. Values beyond the last
+        bound are reported as the last bound."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for idx, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                if idx >= len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[idx - 1] if idx > 0 else 0.0
+                return lower + (self.bounds[idx] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.bounds[-1]
+
+# -------------------------------------------------------------------------------
+    def summary(self):
+        out = dict(count=self.count, mean=self.sum / self.count if self.count else 0.0)
+        for q in MetricsPercentiles:
+            out["p{}".format(int(q * 100))] = self.percentile(q)
+        return out
+
+# -------------------------------------------------------------------------------
+    def exposition(self, name, help_text):
+        lines = ["# HELP {} {}".format(name, help_text), "# TYPE {} histogram".format(name)]
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds, self.counts):
+            cumulative += bucket_count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(name, repr(float(bound)), cumulative))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, self.count))
+        lines.append("{}_sum {}".format(name, repr(float(self.sum))))
+        lines.append("{}_count {}".format(name, self.count))
+        return lines
+
+
+class TransmissionMetrics:
+    """Metrics of one PackingSerial. All times are in seconds."""
+
+    def __init__(self, window=MetricsWindow):
+        self.window = window
+        self._lock = threading.Lock()
+        self.reset()
+
+# -------------------------------------------------------------------------------
+    def reset(self):
+        with self._lock:
+            self._lines = RollingCounter(self.window)
+            self._raw_bytes = RollingCounter(self.window)
+            self._packed_bytes = RollingCounter(self.window)
+            self._pack_time = Histogram(PackTimeBuckets)
+            self._write_latency = Histogram(WriteLatencyBuckets)
+            self._handshake = Histogram(HandshakeBuckets)
+            self._last_handshake = None
+            self._backlog = 0
+            self._backlog_peak = 0
+
+# -------------------------------------------------------------------------------
+    def record_line(self, raw_bytes, packed_bytes, pack_time, write_latency=None):
+        """A line was packed (and, if write_latency is given, written by the write() call that took that long)."""
+        now = clock()
+        with self._lock:
+            self._lines.add(1, now)
+            self._raw_bytes.add(raw_bytes, now)
+            self._packed_bytes.add(packed_bytes, now)
+            self._pack_time.observe(pack_time)
+            if write_latency is not None:
+                self._write_latency.observe(write_latency)
+
+# -------------------------------------------------------------------------------
+    def record_write(self, write_latency):
+        with self._lock:
+            self._write_latency.observe(write_latency)
+
+# -------------------------------------------------------------------------------
+    def record_backlog(self, lines):
+        """Number of lines currently buffered while the packing state is synchronized."""
+        with self._lock:
+            self._backlog = lines
+            if lines > self._backlog_peak:
+                self._backlog_peak = lines
+
+# -------------------------------------------------------------------------------
+    def record_handshake(self, duration):
+        with self._lock:
+            self._handshake.observe(duration)
+            self._last_handshake = duration
+
+# -------------------------------------------------------------------------------
+    def snapshot(self):
+        now = clock()
+        with self._lock:
+            return dict(
+                window=self.window,
+                lines=self._lines.total,
+                rawBytes=self._raw_bytes.total,
+                packedBytes=self._packed_bytes.total,
+                linesPerSec=self._lines.rate(now),
+                rawBytesPerSec=self._raw_bytes.rate(now),
+                packedBytesPerSec=self._packed_bytes.rate(now),
+                packTime=self._pack_time.summary(),
+                writeLatency=self._write_latency.summary(),
+                syncBacklog=self._backlog,
+                syncBacklogPeak=self._backlog_peak,
+                handshake=self._handshake.summary(),
+                lastHandshake=self._last_handshake
+            )
+
+# -------------------------------------------------------------------------------
+    def exposition(self, prefix="meatpack"):
+        """The metrics in the Prometheus text exposition format (version 0.0.4)."""
+        now = clock()
+        lines = []
+
+        def scalar(name, metric_type, help_text, value):
+            name = prefix + "_" + name
+            lines.extend(["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, metric_type),
+                          "{} {}".format(name, value)])
+
+        with self._lock:
+            scalar("lines_total", "counter", "Lines packed and written.", self._lines.total)
+            scalar("raw_bytes_total", "counter", "Bytes of g-code before packing.", self._raw_bytes.total)
+            scalar("packed_bytes_total", "counter", "Bytes written after packing.", self._packed_bytes.total)
+            scalar("lines_per_second", "gauge", "Lines per second over the rolling window.",
+                   repr(self._lines.rate(now)))
+            scalar("raw_bytes_per_second", "gauge", "Raw bytes per second over the rolling window.",
+                   repr(self._raw_bytes.rate(now)))
+            scalar("packed_bytes_per_second", "gauge", "Packed bytes per second over the rolling window.",
+                   repr(self._packed_bytes.rate(now)))
+            lines.extend(self._pack_time.exposition(prefix + "_pack_time_seconds", "Time to pack one line."))
+            lines.extend(self._write_latency.exposition(prefix + "_write_latency_seconds",
+                                                        "Duration of PackingSerial.write() calls."))
+            scalar("sync_backlog_lines", "gauge", "Lines buffered while the packing state is synchronized.",
+                   self._backlog)
+            scalar("sync_backlog_peak_lines", "gauge", "Most lines buffered during a synchronization.",
+                   self._backlog_peak)
+            lines.extend(self._handshake.exposition(prefix + "_handshake_duration_seconds",
+                                                    "Duration of packing state synchronizations."))
+        return "\n".join(lines) + "\n"
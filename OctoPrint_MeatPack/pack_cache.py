@@ -0,0 +1,143 @@
+# Packed stream cache
+# Keeps the packed streams (see packed_stream) of local files, keyed by the file hash and no-spaces mode, so a file
+# is packed only the first time it is streamed. The directory is trimmed to a size, least recently used first.
+import hashlib
+import os
+import threading
+import time
+from OctoPrint_MeatPack.packed_stream import PackedStream, PackedStreamExtension, build_packed_stream, \
+    has_stream_index, stream_index_path
+
+# Per-line sidecars written by earlier versions, removed the next time the cache is trimmed
+PackCacheSidecarExtension = ".mpc"
+
+
+# -------------------------------------------------------------------------------
+def normalize_line(line):
+    """Returns a raw file line as OctoPrint sends it to the printer (comment and surrounding whitespace removed,
+    single trailing newline), or empty bytes if nothing would be sent."""
+    line = line.partition(b';')[0].strip()
+    if not line:
+        return b""
+    return line + b"\n"
+
+
+# -------------------------------------------------------------------------------
+def hash_file(filename, block_size=65536):
+    sha = hashlib.sha1()
+    with open(filename, "rb") as in_file:
+        while True:
+            block = in_file.read(block_size)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class PackCache:
+    """Directory of packed streams with size-bounded, least-recently-used eviction."""
+
+    def __init__(self, directory, logger, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._logger = logger
+        self._building = set()
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+# -------------------------------------------------------------------------------
+    def _log(self, string):
+        self._logger.info("[Cache]: {}".format(string))
+
+# -------------------------------------------------------------------------------
+    def path_for(self, file_hash, no_spaces, extension=PackedStreamExtension):
+        return os.path.join(self.directory, "{}_{}{}".format(file_hash, "nsp" if no_spaces else "esp", extension))
+
+# -------------------------------------------------------------------------------
+    def build_stream(self, src_filename, file_hash, no_spaces):
+        """Packs the source file into a packed stream and its index, unless they already exist. Returns the stream
+        path, or None if it is being built already."""
+        target = self.path_for(file_hash, no_spaces, PackedStreamExtension)
+
+        with self._lock:
+            if target in self._building:
+                return None
+            # Streams packed with an index of an older format are packed again
+            if os.path.exists(target) and has_stream_index(target):
+                os.utime(target, None)
+                return target
+            self._building.add(target)
+
+        try:
+            start = time.time()
+            lines = build_packed_stream(src_filename, target, no_spaces)
+            self._log("Packed {} into a stream of {} lines in {:.1f} sec.".format(os.path.basename(src_filename),
+                                                                                  lines, time.time() - start))
+        finally:
+            with self._lock:
+                self._building.discard(target)
+
+        self.evict()
+        return target
+
+# -------------------------------------------------------------------------------
+    def open_stream(self, file_hash, no_spaces):
+        """Returns the PackedStream of the file, or None if it hasn't been packed (yet). A stream that can't be
+        opened is removed, to be packed again."""
+        target = self.path_for(file_hash, no_spaces, PackedStreamExtension)
+        if not os.path.exists(target):
+            return None
+        try:
+            stream = PackedStream(target)
+        except (IOError, OSError, ValueError) as e:
+            self._log("Discarding packed stream {}: {}".format(os.path.basename(target), e))
+            self._remove(target)
+            return None
+        os.utime(target, None)
+        return stream
+
+# -------------------------------------------------------------------------------
+    def _remove(self, path):
+        # A stream goes together with its index
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        if path.endswith(PackedStreamExtension):
+            try:
+                os.remove(stream_index_path(path))
+            except OSError:
+                pass
+        return True
+
+# -------------------------------------------------------------------------------
+    def evict(self):
+        """Removes the least recently used streams until the cache fits within max_bytes, and any sidecar left by an
+        earlier version."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(PackCacheSidecarExtension):
+                if self._remove(path):
+                    self._log("Removed {}".format(name))
+                continue
+            if not name.endswith(PackedStreamExtension):
+                continue
+            try:
+                st = os.stat(path)
+                size = st.st_size + os.path.getsize(stream_index_path(path))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, size, path))
+            total += size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if self._remove(path):
+                total -= size
+                self._log("Evicted {}".format(os.path.basename(path)))
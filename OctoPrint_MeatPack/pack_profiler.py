@@ -0,0 +1,169 @@
+# Packing efficiency profiler
+# Breaks the compression achieved down by command word (G1, M104, T0, ...): raw vs. packed bytes, the characters
+# that couldn't be packed (anything outside the MeatPackReverseLookupTbl alphabet, after case fixing and whitespace
+# handling), and the packed bytes spent on pairs of unpackable characters, which take three bytes for two characters
+# (MeatPack_BothUnpackable, then both characters as they are). Lines are packed with the default engine, so the sizes
+# are the ones sent to the printer.
+import re
+import threading
+from array import array
+import OctoPrint_MeatPack.meatpack as mp
+from OctoPrint_MeatPack.pack_cache import normalize_line
+
+# Command word of a line, after an optional line number
+ProfileCommandRe = re.compile(br" *(?:[Nn]\d+ *)?([A-Za-z])(\d*(?:\.\d+)?)")
+
+# Unpackable characters listed per command word in summaries (the most frequent ones)
+ProfileTopCharacters = 10
+
+
+class _CommandStats:
+    __slots__ = ("lines", "raw_bytes", "packed_bytes", "unpackable", "both_unpackable_pairs")
+
+    def __init__(self):
+        self.lines = 0
+        self.raw_bytes = 0
+        self.packed_bytes = 0
+        # Character code -> count
+        self.unpackable = {}
+        self.both_unpackable_pairs = 0
+
+
+class PackProfile:
+    """Packing statistics per command word, for the lines added so far."""
+
+    def __init__(self, no_spaces=False):
+        self.no_spaces = bool(no_spaces)
+        self._pack_line = mp.get_packing_engine(mp.PackEngineDefault, self.no_spaces)
+        self._pair_table = mp.get_pair_table(self.no_spaces)
+        packable = mp._get_char_tables(self.no_spaces)[0]
+        # Deleting the packable characters from a line leaves the unpackable ones
+        self._packable_chars = bytes(bytearray([c for c in range(256) if packable[c]]))
+        self._lock = threading.Lock()
+        self.reset()
+
+# -------------------------------------------------------------------------------
+    def reset(self):
+        with self._lock:
+            self._commands = {}
+
+# -------------------------------------------------------------------------------
+    def add(self, line):
+        """Adds a line as it is sent (bytes, comments already removed)."""
+        packed = self._pack_line(line)
+        if not packed:
+            return
+
+        match = ProfileCommandRe.match(line)
+        if match is None:
+            word = "other"
+        else:
+            number = match.group(2).lstrip(b"0")
+            if not number or number[:1] == b".":
+                number = b"0" + number
+            word = (match.group(1).upper() + number).decode("ascii")
+
+        # The line as the packer sees it
+        unified = mp._unified_method_bytes(line, self.no_spaces)
+        unpackable = unified.translate(None, self._packable_chars)
+        both_unpackable = 0
+        if len(unpackable) > 1:
+            if len(unified) & 1:
+                unified += b"\n"
+            table = self._pair_table
+            for pair in array('H', unified):
+                if len(table[pair]) == 3:
+                    both_unpackable += 1
+
+        with self._lock:
+            stats = self._commands.get(word)
+            if stats is None:
+                stats = self._commands[word] = _CommandStats()
+            stats.lines += 1
+            stats.raw_bytes += len(line)
+            stats.packed_bytes += len(packed)
+            stats.both_unpackable_pairs += both_unpackable
+            counts = stats.unpackable
+            for c in bytearray(unpackable):
+                counts[c] = counts.get(c, 0) + 1
+
+# -------------------------------------------------------------------------------
+    def summary(self):
+        """The profile as a dict, commands ordered by packed bytes (largest first)."""
+        with self._lock:
+            commands = sorted(self._commands.items(), key=lambda item: -item[1].packed_bytes)
+            total_lines = sum(stats.lines for _, stats in commands)
+            total_raw = sum(stats.raw_bytes for _, stats in commands)
+            total_packed = sum(stats.packed_bytes for _, stats in commands)
+            total_pairs = sum(stats.both_unpackable_pairs for _, stats in commands)
+
+            out = []
+            for word, stats in commands:
+                chars = sorted(stats.unpackable.items(), key=lambda item: -item[1])
+                out.append(dict(
+                    command=word,
+                    lines=stats.lines,
+                    rawBytes=stats.raw_bytes,
+                    packedBytes=stats.packed_bytes,
+                    ratio=float(stats.packed_bytes) / stats.raw_bytes if stats.raw_bytes else 1.0,
+                    packedShare=float(stats.packed_bytes) / total_packed if total_packed else 0.0,
+                    unpackableChars=sum(stats.unpackable.values()),
+                    topUnpackableChars=[dict(char=chr(c), count=count) for c, count in chars[:ProfileTopCharacters]],
+                    bothUnpackableBytes=stats.both_unpackable_pairs * 3,
+                    bothUnpackableShare=stats.both_unpackable_pairs * 3.0 / stats.packed_bytes
+                    if stats.packed_bytes else 0.0
+                ))
+
+            return dict(
+                noSpaces=self.no_spaces,
+                lines=total_lines,
+                rawBytes=total_raw,
+                packedBytes=total_packed,
+                ratio=float(total_packed) / total_raw if total_raw else 1.0,
+                bothUnpackableBytes=total_pairs * 3,
+                bothUnpackableShare=total_pairs * 3.0 / total_packed if total_packed else 0.0,
+                commands=out
+            )
+
+
+# -------------------------------------------------------------------------------
+def profile_file(filename, no_spaces=False, minimize=0):
+    """Profiles a g-code file as it would be sent while printing (comments and blank lines removed), optionally
+    through the g-code minimizer at the given level. Returns the PackProfile."""
+    profile = PackProfile(no_spaces)
+    minimizer = None
+    if minimize:
+        from OctoPrint_MeatPack.gcode_minimizer import GcodeMinimizer
+        minimizer = GcodeMinimizer(minimize)
+
+    with open(filename, "rb") as in_file:
+        for line in in_file:
+            line = normalize_line(line)
+            if line:
+                profile.add(minimizer.minimize(line) if minimizer is not None else line)
+    return profile
+
+
+# -------------------------------------------------------------------------------
+def _format_char(char):
+    return repr(char) if char.isspace() or not char.isprintable() else char
+
+
+# -------------------------------------------------------------------------------
+def format_profile(summary, top=20):
+    """Text table of a PackProfile.summary(), with the `top` commands by packed bytes."""
+    lines = ["{:<10} {:>9} {:>12} {:>12} {:>6} {:>7} {:>8}  {}".format(
+        "command", "lines", "raw bytes", "packed bytes", "ratio", "share", "3B pairs", "unpackable characters")]
+    for command in summary['commands'][:top]:
+        chars = " ".join("{}:{}".format(_format_char(entry['char']), entry['count'])
+                         for entry in command['topUnpackableChars'])
+        lines.append("{:<10} {:>9} {:>12} {:>12} {:>6.3f} {:>7.1%} {:>8.1%}  {}".format(
+            command['command'], command['lines'], command['rawBytes'], command['packedBytes'], command['ratio'],
+            command['packedShare'], command['bothUnpackableShare'], chars or "-"))
+    if len(summary['commands']) > top:
+        lines.append("({} more commands)".format(len(summary['commands']) - top))
+    lines.append("Total: {} lines, {} -> {} bytes (ratio {:.3f}), {:.1%} of the packed bytes are pairs of unpackable "
+                 "characters ({}).".format(summary['lines'], summary['rawBytes'], summary['packedBytes'],
+                                           summary['ratio'], summary['bothUnpackableShare'],
+                                           "no-spaces" if summary['noSpaces'] else "with spaces"))
+    return "\n".join(lines)
@@ -0,0 +1,524 @@
+# Packed file streaming
+# Prints a g-code file from its packed form without sending it line by line. The file is packed once into a stream
+# of numbered, checksummed lines (so the firmware can ask for resends), with a sidecar index holding the packed-byte
+# offset at which each line starts. While streaming, PackingSerial writes runs of packed lines straight from the
+# mapped stream file, keeping at most `window` lines (and `max_bytes` bytes) unacknowledged. Every "ok" retires the
+# oldest line in flight, "Resend: N" rewinds to line N through the index, and progress is the share of lines
+# acknowledged.
+#
+# Commands OctoPrint sends meanwhile (temperature polls, etc.) are written between two runs of the stream and
+# remembered in the same in-flight queue, so their "ok" still reaches OctoPrint and the stream's don't.
+#
+# Stream line 0 is "M110 N0", resetting the firmware's line number. Source lines are numbered from 1 on, the
+# index holds one offset per stream line plus the end of the stream.
+#
+# The index also maps the source file to the stream, so a print can be resumed part way through without reading or
+# packing anything before that point: the line of the source file each stream line came from (by byte position),
+# the stream line each source line (comments and blank lines included) is sent with, and the stream line at which
+# each layer starts, as marked by the slicer's layer comments. A resumed stream starts with "M110" setting the line
+# number to the one before.
+import bisect
+import collections
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+import OctoPrint_MeatPack.meatpack as mp
+
+PackedStreamExtension = ".mps"
+PackedStreamIndexExtension = ".mpx"
+
+# Index header: magic, flags, stream lines (the M110 line included), source file lines, layers. Then, as 32-bit
+# little-endian integers: the packed offset of every stream line and the end of the stream, the source byte position
+# of every stream line, the stream line of every source line, and the first stream line of every layer.
+PackedStreamIndexHeader = struct.Struct("<4sB3xIII")
+PackedStreamIndexMagic = b"MPX2"
+PackedStreamFlagNoSpaces = 0x01
+
+# Layer change comments (after the ';'): Cura ";LAYER:3", PrusaSlicer/SuperSlicer/OrcaSlicer ";LAYER_CHANGE",
+# Simplify3D "; layer 3, Z = 0.8", KISSlicer "; BEGIN_LAYER_OBJECT z=0.8"
+PackedStreamLayerRe = re.compile(br"\s*(?:LAYER:\s*-?\d|LAYER_CHANGE|layer \d+\s*,|BEGIN_LAYER)", re.IGNORECASE)
+
+# Lines and packed bytes in flight at most by default. Marlin keeps 4 commands queued and has a 128 byte receive
+# buffer, anything beyond that is lost.
+PackedStreamWindow = 4
+PackedStreamMaxBytes = 127
+
+# How often a stream paused while the packing state is being synchronized checks whether it may go on (seconds)
+PackedStreamSyncPoll = 0.05
+
+# Seconds without any response from the printer, with lines in flight, after which their "ok" is taken as lost and
+# they're sent again (OctoPrint's default communication timeout). A line the device did get comes back as a resend
+# request for the one after it. "busy:" keepalives and temperature reports count as responses.
+PackedStreamOkTimeout = 30.0
+
+PackedStreamStreaming = "streaming"
+PackedStreamDone = "done"
+PackedStreamCancelled = "cancelled"
+PackedStreamFailed = "failed"
+
+# Resend requests (Marlin/Prusa "Resend: N", Repetier "rs N"), and the errors reported along with them
+PackedStreamResendRe = re.compile(br"^(?:Resend|rs)[:\s]+N?:?\s*(\d+)", re.IGNORECASE)
+PackedStreamResendErrorRe = re.compile(br"^Error:.*(?:checksum|line number|last line)", re.IGNORECASE)
+
+
+# -------------------------------------------------------------------------------
+def stream_index_path(stream_filename):
+    return os.path.splitext(stream_filename)[0] + PackedStreamIndexExtension
+
+
+# -------------------------------------------------------------------------------
+def has_stream_index(stream_filename):
+    """Whether a stream file has an index of the current format next to it."""
+    try:
+        with open(stream_index_path(stream_filename), "rb") as index_file:
+            return index_file.read(len(PackedStreamIndexMagic)) == PackedStreamIndexMagic
+    except (IOError, OSError):
+        return False
+
+
+# -------------------------------------------------------------------------------
+def _write_index(filename, no_spaces, offsets, positions, source_map, layers):
+    with open(filename, "wb") as out_file:
+        out_file.write(PackedStreamIndexHeader.pack(PackedStreamIndexMagic,
+                                                    PackedStreamFlagNoSpaces if no_spaces else 0,
+                                                    len(positions), len(source_map), len(layers)))
+        for table in (offsets, positions, source_map, layers):
+            if sys.byteorder != "little":
+                table = array('I', table)
+                table.byteswap()
+            table.tofile(out_file)
+
+
+# -------------------------------------------------------------------------------
+def _read_table(in_file, count, filename):
+    table = array('I')
+    try:
+        table.fromfile(in_file, count)
+    except EOFError:
+        raise ValueError("Truncated packed stream index for {}".format(filename))
+    if sys.byteorder != "little":
+        table.byteswap()
+    return table
+
+
+# -------------------------------------------------------------------------------
+def build_packed_stream(src_filename, stream_filename, no_spaces=False):
+    """Packs a g-code file into a stream file, with its index next to it (see stream_index_path()). Lines are sent
+    as OctoPrint would send them (comments and blank lines removed). Returns the number of lines sent."""
+    pack_line = mp.get_packing_engine(mp.PackEngineDefault, no_spaces)
+    offsets = array('I', [0])
+    positions = array('I', [0])
+    source_map = array('I')
+    layers = array('I')
+    checksum = mp.line_checksum
+    layer_re = PackedStreamLayerRe
+
+    tmp = stream_filename + ".tmp"
+    index_filename = stream_index_path(stream_filename)
+    try:
+        with open(src_filename, "rb") as in_file, open(tmp, "wb") as out_file:
+            packed = pack_line(b"M110 N0\n")
+            out_file.write(packed)
+            size = len(packed)
+            offsets.append(size)
+
+            number = 0
+            position = 0
+            for raw in in_file:
+                # A source line that isn't sent maps to the next line that is
+                source_map.append(number + 1)
+                line, _, comment = raw.partition(b';')
+                if comment and layer_re.match(comment):
+                    layers.append(number + 1)
+                line = line.strip()
+                if line:
+                    number += 1
+                    numbered = b"N%d %s" % (number, line)
+                    packed = pack_line(b"%s*%d\n" % (numbered, checksum(numbered)))
+                    out_file.write(packed)
+                    size += len(packed)
+                    offsets.append(size)
+                    positions.append(position)
+                position += len(raw)
+
+        _write_index(index_filename, no_spaces, offsets, positions, source_map, layers)
+        os.rename(tmp, stream_filename)
+    except Exception:
+        # A failed build leaves nothing behind, an index without its stream would be taken for a packed file
+        for filename in (tmp, index_filename):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        raise
+    return number
+
+
+class PackedStream:
+    """A stream file opened for sending: the mapped packed bytes and the offset of every line."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(stream_index_path(filename), "rb") as index_file:
+            header = index_file.read(PackedStreamIndexHeader.size)
+            if len(header) < PackedStreamIndexHeader.size:
+                raise ValueError("Truncated packed stream index for {}".format(filename))
+            magic, flags, count, source_count, layer_count = PackedStreamIndexHeader.unpack(header)
+            if magic != PackedStreamIndexMagic:
+                raise ValueError("Not a packed stream index: {}".format(stream_index_path(filename)))
+            self.offsets = _read_table(index_file, count + 1, filename)
+            self.positions = _read_table(index_file, count, filename)
+            self.source_map = _read_table(index_file, source_count, filename)
+            self.layers = _read_table(index_file, layer_count, filename)
+        self.no_spaces = bool(flags & PackedStreamFlagNoSpaces)
+        # Numbered (source) lines, stream lines are 0 (M110) to this
+        self.lines = count - 1
+
+        self._file = open(filename, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        if size != self.offsets[-1]:
+            self._file.close()
+            raise ValueError("Packed stream {} doesn't match its index".format(filename))
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+# -------------------------------------------------------------------------------
+    def block(self, first, last):
+        """The packed bytes of stream lines first to last (excluded), without copying."""
+        offsets = self.offsets
+        return self._view[offsets[first]:offsets[last]]
+
+# -------------------------------------------------------------------------------
+    def span(self, line):
+        """Packed offset and length of a stream line."""
+        offset = self.offsets[line]
+        return offset, self.offsets[line + 1] - offset
+
+# -------------------------------------------------------------------------------
+    def line_for_source_line(self, source_line):
+        """The stream line a source file line (numbered from 1) is sent with, or the next one sent after it if the
+        line isn't sent. lines + 1 if nothing is sent after it."""
+        if not 0 < source_line <= len(self.source_map):
+            raise ValueError("Line {} is not in the source file ({} lines)".format(source_line, len(self.source_map)))
+        return self.source_map[source_line - 1]
+
+# -------------------------------------------------------------------------------
+    def line_for_position(self, position):
+        """The first stream line whose source starts at or after a byte position in the source file."""
+        return bisect.bisect_left(self.positions, position, 1)
+
+# -------------------------------------------------------------------------------
+    def line_for_layer(self, layer):
+        """The stream line at which a layer starts. Layers are counted from 0, in the order of the slicer's layer
+        comments."""
+        if not 0 <= layer < len(self.layers):
+            raise ValueError("Layer {} is not in the file ({} layers)".format(layer, len(self.layers)))
+        return self.layers[layer]
+
+# -------------------------------------------------------------------------------
+    def resume_line(self, layer=None, source_line=None, position=None):
+        """The stream line to resume at: where a layer starts, a source line is sent, or the first line after a source
+        byte position, whichever is given first. 1 (the start) if none is."""
+        if layer is not None:
+            return self.line_for_layer(int(layer))
+        if source_line is not None:
+            return self.line_for_source_line(int(source_line))
+        if position is not None:
+            return self.line_for_position(int(position))
+        return 1
+
+# -------------------------------------------------------------------------------
+    def layer_of(self, line):
+        """The layer a stream line belongs to, -1 before the first layer."""
+        return bisect.bisect_right(self.layers, line) - 1
+
+# -------------------------------------------------------------------------------
+    def close(self):
+        if self._map is not None:
+            self._view.release()
+            self._map.close()
+            self._file.close()
+            self._map = None
+
+
+class PackedStreamer:
+    """Sends a PackedStream on its own thread, with "ok" flow control and resends.
+
+    `write` writes bytes to the port, and `ready` tells whether the device is in the packing state the stream was
+    packed for. The port hands every "ok" to on_ok() and other responses to on_response(), and writes its own lines
+    through write_host() while the stream is running.
+    """
+
+    def __init__(self, stream, write, ready, window=PackedStreamWindow, max_bytes=PackedStreamMaxBytes,
+                 on_finished=None, first_line=1, preamble=None, ok_timeout=PackedStreamOkTimeout):
+        self.stream = stream
+        # Resuming at a later line, the preamble (packed "M110 N<first_line - 1>") is sent instead of stream line 0
+        self.first_line = max(1, int(first_line))
+        self._preamble = preamble if self.first_line > 1 else None
+        self._resume_preamble = self._preamble
+        self.window = max(1, int(window))
+        self.max_bytes = max(1, int(max_bytes))
+        self.ok_timeout = ok_timeout
+        self.state = PackedStreamStreaming
+        self.error = None
+        self.acked = self.first_line - 2
+        self.resends = 0
+        self.timeouts = 0
+        self.bytes_sent = 0
+        self.start_time = None
+        self.end_time = None
+        self._write = write
+        self._ready = ready
+        self._on_finished = on_finished
+        self._cond = threading.Condition()
+        # Port writes are done with the condition released, so "ok"s and resend requests aren't held up by them. A
+        # line goes in flight and is written under the write lock, so writes keep the order of the in-flight queue.
+        self._write_lock = threading.Lock()
+        # (stream line or None for a host line, generation, packed size). The generation goes up with every
+        # rewind, lines sent before it fail on the device and their "ok" doesn't acknowledge them.
+        self._in_flight = collections.deque()
+        self._in_flight_bytes = 0
+        self._generation = 0
+        self._next = 0 if self._preamble is None else self.first_line
+        self._last_heard = time.time()
+        self._thread = None
+
+# -------------------------------------------------------------------------------
+    @property
+    def running(self):
+        return self.state == PackedStreamStreaming
+
+# -------------------------------------------------------------------------------
+    def start(self):
+        self.start_time = time.time()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+# -------------------------------------------------------------------------------
+    def wait(self, timeout=None):
+        """Waits until the stream has finished, at most timeout seconds. Returns True if it has."""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+            return not thread.is_alive()
+        return not self.running
+
+# -------------------------------------------------------------------------------
+    def cancel(self):
+        self._finish(PackedStreamCancelled)
+
+# -------------------------------------------------------------------------------
+    def fail(self, error):
+        """Stops the stream, e.g. when the printer was reset. What was in flight is forgotten."""
+        with self._cond:
+            if self.running:
+                self._in_flight.clear()
+                self._in_flight_bytes = 0
+        self._finish(PackedStreamFailed, error)
+
+# -------------------------------------------------------------------------------
+    def _finish(self, state, error=None):
+        with self._cond:
+            if not self.running:
+                return
+            self.state = state
+            self.error = error
+            self.end_time = time.time()
+            self._cond.notify_all()
+        if self._on_finished is not None:
+            self._on_finished(self)
+
+# -------------------------------------------------------------------------------
+    def _run(self):
+        try:
+            with self._cond:
+                self._send_loop()
+        except Exception as e:
+            self._finish(PackedStreamFailed, str(e))
+        else:
+            self._finish(PackedStreamDone)
+        finally:
+            # The stream isn't read anymore once the send loop is over
+            self.stream.close()
+
+# -------------------------------------------------------------------------------
+    def _send_loop(self):
+        offsets = self.stream.offsets
+        end = self.stream.lines + 1
+        in_flight = self._in_flight
+        while self.running:
+            preamble = self._preamble
+            if preamble is not None and self._ready():
+                if not self._write_lock.acquire(False):
+                    self._cond.wait(PackedStreamSyncPoll)
+                    continue
+                in_flight.append((self.first_line - 1, self._generation, len(preamble)))
+                self._in_flight_bytes += len(preamble)
+                self.bytes_sent += len(preamble)
+                self._preamble = None
+                self._last_heard = time.time()
+                self._write_released(preamble)
+                continue
+            first = self._next
+            if first >= end:
+                if self.acked >= end - 1:
+                    return
+                self._wait_for_ok()
+                continue
+
+            # The packed bytes only make sense to the device in the packing state they were packed for
+            if not self._ready():
+                self._cond.wait(PackedStreamSyncPoll)
+                continue
+
+            # As many lines as fit into the window, in one write
+            limit = min(end, first + self.window - len(in_flight))
+            budget = offsets[first] + self.max_bytes - self._in_flight_bytes
+            last = first
+            while last < limit and offsets[last + 1] <= budget:
+                last += 1
+            if last == first:
+                if in_flight:
+                    self._wait_for_ok()
+                    continue
+                # A line longer than the byte budget goes out on its own
+                last = first + 1
+
+            # A host line being written goes first
+            if not self._write_lock.acquire(False):
+                self._cond.wait(PackedStreamSyncPoll)
+                continue
+            generation = self._generation
+            for line in range(first, last):
+                in_flight.append((line, generation, offsets[line + 1] - offsets[line]))
+            size = offsets[last] - offsets[first]
+            self._in_flight_bytes += size
+            self.bytes_sent += size
+            self._next = last
+            self._last_heard = time.time()
+            self._write_released(self.stream.block(first, last))
+
+# -------------------------------------------------------------------------------
+    def _write_released(self, data):
+        # Called with the condition and the write lock held, the lines written already in flight: a resend request or
+        # a cancel coming in meanwhile finds them there.
+        self._cond.release()
+        try:
+            self._write(data)
+        finally:
+            self._write_lock.release()
+            self._cond.acquire()
+
+# -------------------------------------------------------------------------------
+    def _wait_for_ok(self):
+        # Called with the condition held
+        if self.ok_timeout is None:
+            self._cond.wait()
+            return
+        remaining = self._last_heard + self.ok_timeout - time.time()
+        if remaining > 0:
+            self._cond.wait(remaining)
+            return
+        if not self._in_flight:
+            return
+
+        # Nothing heard for too long: what's in flight is sent again from the oldest line not acknowledged. Lines
+        # sent before fail on the device like after a resend request, a host line's late "ok" goes to OctoPrint.
+        self._in_flight.clear()
+        self._in_flight_bytes = 0
+        self._generation += 1
+        if self._resume_preamble is not None and self.acked < self.first_line - 1:
+            self._preamble = self._resume_preamble
+        self._next = max(self.acked + 1, self.first_line if self._resume_preamble is not None else 0)
+        self.timeouts += 1
+        self._last_heard = time.time()
+
+# -------------------------------------------------------------------------------
+    def write_host(self, data):
+        """Writes a (packed) line from the host in between two runs of the stream."""
+        with self._write_lock:
+            with self._cond:
+                self._in_flight.append((None, self._generation, len(data)))
+                self._in_flight_bytes += len(data)
+                self._last_heard = time.time()
+            self._write(data)
+        with self._cond:
+            self._cond.notify()
+
+# -------------------------------------------------------------------------------
+    def on_ok(self):
+        """Retires the oldest line in flight. Returns True if the "ok" was for a stream line, and False if it has
+        to be passed on (a host line's, or one nothing was waiting for)."""
+        with self._cond:
+            self._last_heard = time.time()
+            if not self._in_flight:
+                return False
+            line, generation, size = self._in_flight.popleft()
+            self._in_flight_bytes -= size
+            self._cond.notify()
+            if line is None:
+                return False
+            if generation == self._generation and line > self.acked:
+                self.acked = line
+            return True
+
+# -------------------------------------------------------------------------------
+    def on_response(self, line):
+        """Handles a response other than "ok". Returns True if it belongs to the stream (a resend request, or the
+        error reported with it) and must not be passed on."""
+        # Any response shows the printer is still there, "busy:" keepalives included. Reads that timed out are empty.
+        if not line.strip():
+            return False
+        self._last_heard = time.time()
+        match = PackedStreamResendRe.match(line)
+        if match is not None:
+            self._resend(int(match.group(1)))
+            return True
+        return PackedStreamResendErrorRe.match(line) is not None
+
+# -------------------------------------------------------------------------------
+    def _resend(self, number):
+        with self._cond:
+            # The request comes before the "ok" of the line that failed. Every line sent after it fails as well and
+            # asks for the same line again, only the first request is followed.
+            if self._in_flight and self._in_flight[0][1] != self._generation:
+                return
+            # Not one of the lines sent, so not the stream's request
+            if not self.first_line <= number <= self.stream.lines:
+                return
+            self._generation += 1
+            self._next = number
+            self.acked = min(self.acked, number - 1)
+            self.resends += 1
+            self._cond.notify()
+
+# -------------------------------------------------------------------------------
+    def status(self):
+        """The stream's state and progress as a dict."""
+        lines = self.stream.lines
+        acked = max(self.acked, 0)
+        sent = acked - self.first_line + 1
+        end = self.end_time if self.end_time is not None else time.time()
+        elapsed = end - self.start_time if self.start_time is not None else 0.0
+        return dict(
+            file=os.path.basename(self.stream.filename),
+            state=self.state,
+            error=self.error,
+            lines=lines,
+            firstLine=self.first_line,
+            linesAcked=acked,
+            progress=float(acked) / lines if lines else 1.0,
+            layer=self.stream.layer_of(acked),
+            layers=len(self.stream.layers),
+            resends=self.resends,
+            timeouts=self.timeouts,
+            bytesSent=self.bytes_sent,
+            elapsed=elapsed,
+            linesPerSec=max(sent, 0) / elapsed if elapsed > 0 else 0.0
+        )
@@ -1,12 +1,50 @@
-from serial import Serial
+from serial import Serial, SerialTimeoutException
 import OctoPrint_MeatPack.meatpack as mp
 import OctoPrint_MeatPack.song_player as songplay
-from threading import Thread
+from OctoPrint_MeatPack.metrics import TransmissionMetrics, clock
+from OctoPrint_MeatPack.link_monitor import LinkMonitor, LinkSaturationThreshold
+from OctoPrint_MeatPack.adaptive_packing import AdaptivePacking
+from OctoPrint_MeatPack.gcode_minimizer import GcodeMinimizer, MinimizeOff
+from OctoPrint_MeatPack.sync_backlog import SyncBacklog, SyncBacklogTimeout
+from OctoPrint_MeatPack.pack_profiler import PackProfile
+from OctoPrint_MeatPack.packed_stream import PackedStreamer, PackedStreamWindow
+from threading import Thread, Event, Lock, RLock
 import time
 import re
 import enum
 from array import array
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# With the write timeout OctoPrint sets (0), a write only takes what fits into the port's output buffer. The rest is
+# written as the buffer drains, checking again every PortWriteRetryInterval, and a write that makes no progress at
+# all for PortWriteTimeout seconds fails with a write timeout.
+PortWriteRetryInterval = 0.001
+PortWriteTimeout = 10.0
+
+# A state query is sent again if no report arrived within this time (seconds), e.g. because it was sent while the
+# printer was still booting
+HandshakeRetryInterval = 1.0
+
+# Longest time (seconds) a write waits for a synchronization in progress to complete, before the line is held back
+HandshakeWriteWait = 0.1
+
+# Default number of lines the pipelined write mode holds between write() and the packing thread, and between the
+# packing thread and the writer thread
+PipelineQueueSize = 256
+# Longest the pipeline threads are waited for when the port is cleaned up (seconds)
+PipelineStopTimeout = 2.0
+
+# Most bytes of the sync backlog sent with one write once the state is confirmed
+SyncFlushChunkSize = 1024
+
+# A line numbered by OctoPrint: "N<number> <command>*<checksum>"
+NumberedLineRe = re.compile(br"N-?\d+ ?(.*?)(?:\*\d+)?\s*$", re.DOTALL)
+
 
 class MPSyncedConfigFlags(enum.IntEnum):
     Enabled = 0
@@ -59,11 +97,13 @@ class PackingSerial(Serial):
     """
 
     def __init__(self, logger, **kwargs):
-        mp.initialize()
-
         self._packing_enabled = True
         self._no_spaces = False
-        self._expecting_response = False
+        self._packing_engine = mp.PackEngineDefault
+        self._packer = mp.get_packer(False)
+        self._pack_line = mp.get_packing_engine(self._packing_engine, self._packer.no_spaces)
+        # State reports still to come for the commands sent (the device reports after every command)
+        self._pending_reports = 0
         self._confirmed_sync = False
         self._sync_pending = False
         self._query_msg_timer = time.time()
@@ -84,16 +124,46 @@ class PackingSerial(Serial):
         self._totalBytesSec = 0.0
 
         self.statsUpdateCallback = None
-        self._already_initialized = False
 
-        self._buffer = list()
+        self._backlog = SyncBacklog()
+        self._sync_backlog_timeout = SyncBacklogTimeout
+
+        self._pipelined_writes = False
+        self._pipeline_queue_size = PipelineQueueSize
+        # Keeps the sync state check, packing and writing (or queueing) of a line together, and orders lines held
+        # back during a synchronization before any written after it.
+        self._write_lock = RLock()
+        self._pipeline_switch_lock = Lock()
+        self._pack_queue = None
+        self._write_queue = None
+        self._pipeline_threads = []
+        self._pipeline_stopping = False
+        self._pipeline_error = None
+        self._pipeline_peak_depth = 0
+        self._pipeline_stall_time = 0.0
+        self._pipeline_stalls = 0
         self._song_player = None
         self._song_player_thread = None
+        self._metrics = None
+        self._sync_start_time = None
+        self._sync_event = Event()
+        self._handshakes = 0
+        self._handshake_time_total = 0.0
+        self._last_handshake_time = None
+        self._link_monitor = None
+        self._adaptive = None
+        self._packing_suspended = False
+        self._adaptive_switch_due = False
+        self._minimizer = None
+        self._profile = None
+        self._streamer = None
+        self._stream_window = PackedStreamWindow
 
         self._config_sync_flags = array('B', len(MPSyncedConfigFlags) * [0])
         self._config_sync_flags_protocol_ver = array('B', len(MPSyncedConfigFlags) * [0])
         self._init_device_config_protocl_versions()
         self._reset_config_sync_state()
+        self._sync_start_time = None
 
         super(PackingSerial, self).__init__(**kwargs)
 
@@ -106,9 +176,66 @@ class PackingSerial(Serial):
     def packing_enabled(self, value):
         # Set before anything else, to buffer data while state is synchronized.
         self._sync_pending = True
+        self._begin_sync()
+        # Adaptive packing starts over when packing is switched on or off, not every time the settings are saved
+        if value != self._packing_enabled:
+            self._resume_packing()
         self._packing_enabled = value
+        # Lines aren't seen by the minimizer while packing is off, so what it tracked may be stale now.
+        minimizer = self._minimizer
+        if minimizer is not None:
+            minimizer.reset()
         self.query_config_state(True)
 
+# -------------------------------------------------------------------------------
+    @property
+    def minimize_level(self):
+        """G-code minimization applied before packing, one of gcode_minimizer.MinimizeLevels (0 is off)."""
+        minimizer = self._minimizer
+        return minimizer.level if minimizer is not None else MinimizeOff
+
+    @minimize_level.setter
+    def minimize_level(self, value):
+        value = int(value)
+        if value == MinimizeOff:
+            self._minimizer = None
+        elif self._minimizer is None:
+            self._minimizer = GcodeMinimizer(value)
+        elif self._minimizer.level != value:
+            self._minimizer.level = value
+            self._minimizer.reset()
+
+# -------------------------------------------------------------------------------
+    @property
+    def adaptive_packing(self):
+        """If set, packing is switched off on the device while it doesn't pay off, and back on when it does."""
+        return self._adaptive is not None
+
+    @adaptive_packing.setter
+    def adaptive_packing(self, value):
+        if value and self._adaptive is None:
+            self._adaptive = AdaptivePacking()
+        elif not value and self._adaptive is not None:
+            self._adaptive = None
+            if self._packing_suspended:
+                self._sync_pending = True
+                self._begin_sync()
+                self._resume_packing()
+                self.query_config_state(True)
+
+# -------------------------------------------------------------------------------
+    def _resume_packing(self):
+        self._packing_suspended = False
+        self._adaptive_switch_due = False
+        adaptive = self._adaptive
+        if adaptive is not None:
+            adaptive.reset()
+
+# -------------------------------------------------------------------------------
+    def _packing_active(self):
+        # Packing as it should be set on the device: enabled, and not switched off by adaptive packing.
+        return self._packing_enabled and not self._packing_suspended
+
 # -------------------------------------------------------------------------------
     @property
     def omit_all_spaces(self):
@@ -116,11 +243,196 @@ class PackingSerial(Serial):
 
     @omit_all_spaces.setter
     def omit_all_spaces(self, value):
+        # Builds the packing tables for the mode first, so it doesn't count towards (and delay) the handshake
+        mp.get_packing_engine(self._packing_engine, value)
         # Set before anything else, to buffer data while state is synchronized.
         self._sync_pending = True
+        self._begin_sync()
         self._no_spaces = value
         self.query_config_state(True)
 
+# -------------------------------------------------------------------------------
+    @property
+    def packing_engine(self):
+        return self._packing_engine
+
+    @packing_engine.setter
+    def packing_engine(self, value):
+        # Engines produce identical output, so no re-sync with the device is needed.
+        if value == mp.PackEngineNative and value not in mp.PackingEngines:
+            self._log("The compiled packer isn't built, using the '{}' engine.".format(mp.PackEngineDefault))
+            value = mp.PackEngineDefault
+        elif value not in mp.PackingEngines:
+            self._log("Unknown packing engine '{}', using '{}'.".format(value, mp.PackEngineDefault))
+            value = mp.PackEngineDefault
+        self._packing_engine = value
+        self._pack_line = mp.get_packing_engine(value, self._packer.no_spaces)
+
+# -------------------------------------------------------------------------------
+    @property
+    def pipelined_writes(self):
+        """If set, write() only queues the line; packing and writing to the port happen on two worker threads."""
+        return self._pipelined_writes
+
+    @pipelined_writes.setter
+    def pipelined_writes(self, value):
+        if self._pipelined_writes == value:
+            return
+
+        if value:
+            self._pack_queue = queue.Queue(self._pipeline_queue_size)
+            self._write_queue = queue.Queue(self._pipeline_queue_size)
+            self._pipeline_error = None
+            self._pipeline_stopping = False
+            self._pipeline_threads = [Thread(target=self._pipeline_pack_loop),
+                                      Thread(target=self._pipeline_write_loop)]
+            for thread in self._pipeline_threads:
+                thread.daemon = True
+                thread.start()
+            self._pipelined_writes = True
+        else:
+            # Everything queued so far is still packed and written before the threads stop, unless the port is
+            # being cleaned up (then it is dropped, and the threads are only waited for so long). write() waits
+            # meanwhile, and then carries on synchronously.
+            with self._pipeline_switch_lock:
+                timeout = PipelineStopTimeout if self._pipeline_stopping else None
+                try:
+                    self._pack_queue.put(None, timeout=timeout)
+                except queue.Full:
+                    pass
+                for thread in self._pipeline_threads:
+                    thread.join(timeout)
+                    if thread.is_alive():
+                        self._log("Pipeline thread didn't stop within {} sec, leaving it behind.".format(timeout))
+                self._pipeline_threads = []
+                self._pipelined_writes = False
+                self._pack_queue = None
+                self._write_queue = None
+
+# -------------------------------------------------------------------------------
+    @property
+    def pipeline_queue_size(self):
+        """Capacity of each pipeline queue, takes effect the next time pipelined writes are enabled."""
+        return self._pipeline_queue_size
+
+    @pipeline_queue_size.setter
+    def pipeline_queue_size(self, value):
+        self._pipeline_queue_size = max(1, int(value))
+
+# -------------------------------------------------------------------------------
+    @property
+    def sync_backlog_size(self):
+        """Lines held back at most while the packing state is synchronized, before write() has to wait."""
+        return self._backlog.capacity
+
+    @sync_backlog_size.setter
+    def sync_backlog_size(self, value):
+        self._backlog.resize(value)
+
+# -------------------------------------------------------------------------------
+    @property
+    def sync_backlog_timeout(self):
+        """Longest time (in seconds) write() waits for room in a full sync backlog before raising
+        SerialTimeoutException. None (or 0) waits indefinitely. Pipelined writes always wait, and back up into
+        the pipeline queue instead."""
+        return self._sync_backlog_timeout
+
+    @sync_backlog_timeout.setter
+    def sync_backlog_timeout(self, value):
+        self._sync_backlog_timeout = float(value) if value else None
+
+# -------------------------------------------------------------------------------
+    @property
+    def stream_window(self):
+        """Lines a packed stream keeps in flight at most, the firmware acknowledges each with "ok"."""
+        return self._stream_window
+
+    @stream_window.setter
+    def stream_window(self, value):
+        self._stream_window = max(1, int(value))
+
+# -------------------------------------------------------------------------------
+    @property
+    def collect_metrics(self):
+        """If set, detailed metrics (rates, histograms, handshake durations) are recorded, see get_metrics()."""
+        return self._metrics is not None
+
+    @collect_metrics.setter
+    def collect_metrics(self, value):
+        if value and self._metrics is None:
+            self._metrics = TransmissionMetrics()
+        elif not value:
+            self._metrics = None
+
+# -------------------------------------------------------------------------------
+    @property
+    def monitor_link(self):
+        """If set, link utilisation and "ok" rate are tracked, see begin_link_report() and get_link_report()."""
+        return self._link_monitor is not None
+
+    @monitor_link.setter
+    def monitor_link(self, value):
+        if value and self._link_monitor is None:
+            self._link_monitor = LinkMonitor(self.baudrate)
+        elif not value:
+            self._link_monitor = None
+
+# -------------------------------------------------------------------------------
+    @property
+    def link_saturation_threshold(self):
+        monitor = self._link_monitor
+        return monitor.threshold if monitor is not None else LinkSaturationThreshold
+
+    @link_saturation_threshold.setter
+    def link_saturation_threshold(self, value):
+        monitor = self._link_monitor
+        if monitor is not None:
+            monitor.threshold = float(value)
+
+# -------------------------------------------------------------------------------
+    def begin_link_report(self):
+        """Starts a new link report (e.g. when a print starts)."""
+        monitor = self._link_monitor
+        if monitor is not None:
+            monitor.baudrate = self.baudrate
+            monitor.begin_report()
+
+# -------------------------------------------------------------------------------
+    def get_link_report(self):
+        """Returns the link report since begin_link_report(), or None if the link isn't monitored."""
+        monitor = self._link_monitor
+        return monitor.report() if monitor is not None else None
+
+# -------------------------------------------------------------------------------
+    def open(self):
+        super(PackingSerial, self).open()
+        monitor = self._link_monitor
+        if monitor is not None:
+            monitor.baudrate = self.baudrate
+
+# -------------------------------------------------------------------------------
+    @property
+    def profile_packing(self):
+        """If set, packing efficiency per command word is recorded for the lines sent, see get_packing_profile()."""
+        return self._profile is not None
+
+    @profile_packing.setter
+    def profile_packing(self, value):
+        if value and self._profile is None:
+            self._profile = PackProfile(self._packer.no_spaces)
+        elif not value:
+            self._profile = None
+
+# -------------------------------------------------------------------------------
+    def get_packing_profile(self):
+        """Returns the PackProfile being recorded, or None if profiling is disabled."""
+        return self._profile
+
+# -------------------------------------------------------------------------------
+    def get_metrics(self):
+        """Returns the TransmissionMetrics being recorded, or None if metrics are disabled."""
+        return self._metrics
+
 # -------------------------------------------------------------------------------
     @property
     def log_transmission_stats(self):
@@ -149,13 +461,79 @@ class PackingSerial(Serial):
     def _diagLog(self, string):
         self._logger.info("[General] {}".format(string))
 
+# -------------------------------------------------------------------------------
+    def start_packed_stream(self, stream, first_line=1, sync_timeout=SyncBacklogTimeout):
+        """Starts sending a PackedStream, instead of OctoPrint sending the file line by line, from the given stream
+        line on (see PackedStream.resume_line()). The printer has to be idle, and the device in the packing state the
+        stream was packed for. Returns the PackedStreamer."""
+        streamer = self._streamer
+        if streamer is not None and streamer.running:
+            raise ValueError("A packed stream is being sent already")
+        if not 1 <= first_line <= stream.lines + 1:
+            raise ValueError("Line {} is not in the stream ({} lines)".format(first_line, stream.lines))
+        # Adaptive packing would switch packing off in the middle of the stream
+        if not self._packing_enabled or self._adaptive is not None:
+            raise ValueError("Packed streams need packing enabled, without adaptive packing")
+        if not self.wait_for_sync(sync_timeout):
+            raise SerialTimeoutException("Write timeout (MeatPack state not synchronized)")
+        if stream.no_spaces != self._packer.no_spaces:
+            raise ValueError("The stream was packed {} whitespace removal, the device packs {}".format(
+                "with" if stream.no_spaces else "without", "with" if self._packer.no_spaces else "without"))
+
+        preamble = self._pack_line(b"M110 N%d\n" % (first_line - 1)) if first_line > 1 else None
+        self._streamer = PackedStreamer(stream, self._port_write, lambda: self._stream_ready(stream),
+                                        window=self._stream_window, on_finished=self._packed_stream_finished,
+                                        first_line=first_line, preamble=preamble)
+        self._log("Streaming {} ({} lines{}).".format(stream.filename, stream.lines,
+                                                       ", from line {}".format(first_line) if first_line > 1 else ""))
+        self._streamer.start()
+        return self._streamer
+
+# -------------------------------------------------------------------------------
+    def _stream_ready(self, stream):
+        return self._stable_state() and self._packing_active() and self._packer.no_spaces == stream.no_spaces
+
+# -------------------------------------------------------------------------------
+    def _packed_stream_finished(self, streamer):
+        status = streamer.status()
+        self._log("Packed stream {} {} after {} of {} lines in {:.1f} sec ({} resends, {} timeouts){}".format(
+            status['file'], status['state'], status['linesAcked'], status['lines'], status['elapsed'],
+            status['resends'], status['timeouts'], ": {}".format(status['error']) if status['error'] else "."))
+
+# -------------------------------------------------------------------------------
+    def stop_packed_stream(self):
+        """Cancels the packed stream being sent, if any."""
+        streamer = self._streamer
+        if streamer is not None:
+            streamer.cancel()
+
+# -------------------------------------------------------------------------------
+    def get_packed_stream(self):
+        """Returns the PackedStreamer of the last packed stream started, or None."""
+        return self._streamer
+
 # -------------------------------------------------------------------------------
     def cleanup(self):
+        self.stop_packed_stream()
+        # Lines still queued or held back can't be sent anymore. The pipeline threads drop what is left, and
+        # draining the backlog releases them (and writers) from waiting for room in it.
+        self._pipeline_stopping = True
+        self._backlog.drain()
+        self.pipelined_writes = False
         if self._song_player is not None:
             self._song_player.terminate()
         if self._song_player_thread is not None:
             self._song_player_thread.join()
 
+# -------------------------------------------------------------------------------
+    def _set_packer_mode(self, no_spaces):
+        # Each port packs with its own packer, so ports in different modes don't affect each other.
+        self._packer = mp.get_packer(no_spaces)
+        self._pack_line = mp.get_packing_engine(self._packing_engine, no_spaces)
+        profile = self._profile
+        if profile is not None and profile.no_spaces != no_spaces:
+            self._profile = PackProfile(no_spaces)
+
 # -------------------------------------------------------------------------------
     def _update_config_sync_state(self):
         all_synced = True
@@ -167,10 +545,37 @@ class PackingSerial(Serial):
 
 # -------------------------------------------------------------------------------
     def _reset_config_sync_state(self):
+        self._begin_sync()
         self._confirmed_sync = False
         for i in range(0, len(MPSyncedConfigFlags)):
             self._config_sync_flags[i] = 0
 
+# -------------------------------------------------------------------------------
+    def _begin_sync(self):
+        self._sync_event.clear()
+        if self._sync_start_time is None:
+            self._sync_start_time = clock()
+
+# -------------------------------------------------------------------------------
+    def _end_sync(self):
+        start = self._sync_start_time
+        self._sync_start_time = None
+        if start is not None:
+            duration = clock() - start
+            self._handshakes += 1
+            self._handshake_time_total += duration
+            self._last_handshake_time = duration
+            metrics = self._metrics
+            if metrics is not None:
+                metrics.record_handshake(duration)
+        self._sync_event.set()
+
+# -------------------------------------------------------------------------------
+    def wait_for_sync(self, timeout=None):
+        """Waits until the packing state is synchronized with the device, at most timeout seconds. Returns True if
+        it is."""
+        return self._sync_event.wait(timeout) and self._stable_state()
+
 # -------------------------------------------------------------------------------
     def _stable_state(self):
         if not self._sync_pending and self._confirmed_sync:
@@ -181,12 +586,36 @@ class PackingSerial(Serial):
     def readline(self, **kwargs):
         read = super(PackingSerial, self).readline(**kwargs)
 
-        read_str = read.decode("UTF-8", errors="ignore")
+        # Fast path: "ok", by far the most frequent line, is never a reset or a MeatPack state report, so it isn't
+        # decoded or searched at all. Other lines are decoded as latin-1, which can't fail and needs no error handling.
+        if read[:2] == b"ok":
+            monitor = self._link_monitor
+            if monitor is not None:
+                monitor.record_ok()
+            if not self._confirmed_sync:
+                self.query_config_state()
+            # The stream's own acknowledgements aren't for OctoPrint
+            streamer = self._streamer
+            if streamer is not None and streamer.on_ok():
+                return bytes()
+            return read
+
+        read_str = read.decode("latin-1")
 
         # Reset
         if "start" in read_str:
-            self._reset_config_sync_state()
+            minimizer = self._minimizer
+            if minimizer is not None:
+                minimizer.reset()
             self._log("System reset detected -- disabling MeatPack until sync.")
+            # The firmware starts with packing off, adaptive packing starts over as well
+            self._resume_packing()
+            # The firmware is up and reports nothing for commands sent before the reset, so it's queried right away.
+            self._pending_reports = 0
+            self.query_config_state(True)
+            streamer = self._streamer
+            if streamer is not None and streamer.running:
+                streamer.fail("Printer reset")
             return read
 
         # Keep sending queries every so often until response (timed internally)
@@ -196,99 +625,96 @@ class PackingSerial(Serial):
         # Sync packing state
         # -------------------------------------------------------------------------------
         if "[MP]" in read_str:
+            self._handle_state_report(mp.parse_response(read))
+            return bytes()
 
-            # Extract protocol version
-            # -------------------------------------------------------------------------------
-            if " PV" in read_str:
-                protocol_match = re.search(" PV(\d+)", read_str)
-                if protocol_match:
-                    new_version = int(protocol_match.group(1))
-
-                    if new_version != self._protocol_version:
-                        self._log("Detected MeatPack protocol version V{}".format(new_version))
-                    self._protocol_version = int(protocol_match.group(1))
-
-            sync_pending_buf = self._sync_pending
-
-            # Enable/Disable flag is available in all protocl versions
-            # -------------------------------------------------------------------------------
-            # If device packing is on but we want it off, do so here.
-            if " ON" in read_str:
-                # We don't want it enabled but it says it is
-                if not self._packing_enabled:
-                    self._config_sync_flags[MPSyncedConfigFlags.Enabled] = 0
-                    self._sync_pending = True
-                    super(PackingSerial, self).write(mp.get_command_bytes(mp.MPCommand_DisablePacking))
-                    super(PackingSerial, self).flushOutput()
-                    if not sync_pending_buf:
-                        self._log("MeatPack enabled on device but will be set disabled. Sync'ing state.")
-                    # Check again
-                    self.query_config_state()
-                else:
-                    self._log("Config var [Enabled] synchronized (=enabled).")
-                    self._config_sync_flags[MPSyncedConfigFlags.Enabled] = 1
-
-            # If device packing is off but we want it on, do so here.
-            elif " OFF" in read_str:
-                # We do want it enabled, but it says it isn't
-                if self._packing_enabled:
-                    self._sync_pending = True
-                    super(PackingSerial, self).write(mp.get_command_bytes(mp.MPCommand_EnablePacking))
-                    super(PackingSerial, self).flushOutput()
-                    if not sync_pending_buf:
-                        self._log("MeatPack disabled on device but will be set enabled. Sync'ing state.")
-                    # Check again
-                    self.query_config_state()
-                else:
-                    self._log("Config var [Enabled] synchronized (=disabled).")
-                    mp.set_no_spaces(self._no_spaces)
-                    self._config_sync_flags[MPSyncedConfigFlags.Enabled] = 1
+        # Resend requests for stream lines are handled by the stream
+        streamer = self._streamer
+        if streamer is not None and streamer.running and streamer.on_response(read):
+            return bytes()
+
+        return read
+
+# -------------------------------------------------------------------------------
+    def _handle_state_report(self, response):
+        # Handshake state machine. Every command sent to the device (query, enable/disable, no-spaces) is answered
+        # with a state report, and commands are processed in order, so only the report to the last command sent
+        # shows the state the host ends up with. Earlier ones are skipped. Corrections are sent together, right
+        # when that report arrives, and the report to the last of them confirms the state.
+        if self._pending_reports > 0:
+            self._pending_reports -= 1
+        if self._pending_reports > 0:
+            return
+
+        # Extract protocol version
+        # -------------------------------------------------------------------------------
+        if response.protocol_version is not None:
+            if response.protocol_version != self._protocol_version:
+                self._log("Detected MeatPack protocol version V{}".format(response.protocol_version))
+            self._protocol_version = response.protocol_version
+
+        was_pending = self._sync_pending
+        corrections = []
+
+        # Enable/Disable flag is available in all protocl versions
+        # -------------------------------------------------------------------------------
+        if response.enabled is True:
+            # We don't want it enabled but it says it is
+            if not self._packing_active():
+                corrections.append(mp.MPCommand_DisablePacking)
+                if not was_pending:
+                    self._log("MeatPack enabled on device but will be set disabled. Sync'ing state.")
+            else:
+                self._log("Config var [Enabled] synchronized (=enabled).")
+                self._config_sync_flags[MPSyncedConfigFlags.Enabled] = 1
+        elif response.enabled is False:
+            # We do want it enabled, but it says it isn't
+            if self._packing_active():
+                corrections.append(mp.MPCommand_EnablePacking)
+                if not was_pending:
+                    self._log("MeatPack disabled on device but will be set enabled. Sync'ing state.")
+            else:
+                self._log("Config var [Enabled] synchronized (=disabled).")
+                self._config_sync_flags[MPSyncedConfigFlags.Enabled] = 1
 
         # No-Spaces is only available in protocl version 1 and above
         # -------------------------------------------------------------------------------
-            if self._protocol_version >= 1:
-                # No spaces enabled
-                if " NSP" in read_str:
-                    # Need to disable it
-                    if not self._no_spaces:
-                        self._sync_pending = True
-                        super(PackingSerial, self).write(mp.get_command_bytes(mp.MPCommand_DisableNoSpaces))
-                        super(PackingSerial, self).flushOutput()
-                        if not sync_pending_buf:
-                            self._log("No-Spaces enabled on device, but will be set disabled. Sync'ing state.")
-                        self.query_config_state()
-                    # Otherwise we're good
-                    else:
-                        self._log("Config var [NoSpaces] synchronized (=enabled).")
-                        self._config_sync_flags[MPSyncedConfigFlags.NoSpaces] = 1
-                # No spaces disabled
-                elif " ESP" in read_str:
-                    # Need to enabled it
-                    if self._no_spaces:
-                        self._sync_pending = True
-                        super(PackingSerial, self).write(mp.get_command_bytes(mp.MPCommand_EnableNoSpaces))
-                        super(PackingSerial, self).flushOutput()
-                        if not sync_pending_buf:
-                            self._log("No-Spaces enabled on device, but will be set disabled. Sync'ing state.")
-                        self.query_config_state()
-                    # Otherwise we're good
-                    else:
-                        self._log("Config var [NoSpaces] synchronized (=disabled).")
-                        mp.set_no_spaces(self._no_spaces)
-                        self._config_sync_flags[MPSyncedConfigFlags.NoSpaces] = 1
-
-            self._update_config_sync_state()
-            if self._confirmed_sync:
-                self._log("MeatPack configuration successfully synchronized and confirmed between host/device.")
-                mp.set_no_spaces(self._no_spaces)
-                self._sync_pending = False
-                self._flush_buffer()
-                # This flag is used to prevent a rush of query messages at first launch.
-                self._already_initialized = True
+        if self._protocol_version >= 1:
+            if response.no_spaces is True:
+                if not self._no_spaces:
+                    corrections.append(mp.MPCommand_DisableNoSpaces)
+                    if not was_pending:
+                        self._log("No-Spaces enabled on device, but will be set disabled. Sync'ing state.")
+                else:
+                    self._log("Config var [NoSpaces] synchronized (=enabled).")
+                    self._config_sync_flags[MPSyncedConfigFlags.NoSpaces] = 1
+            elif response.no_spaces is False:
+                if self._no_spaces:
+                    corrections.append(mp.MPCommand_EnableNoSpaces)
+                    if not was_pending:
+                        self._log("No-Spaces disabled on device, but will be set enabled. Sync'ing state.")
+                else:
+                    self._log("Config var [NoSpaces] synchronized (=disabled).")
+                    self._config_sync_flags[MPSyncedConfigFlags.NoSpaces] = 1
 
-            return bytes()
+        if corrections:
+            self._sync_pending = True
+            self._reset_config_sync_state()
+            for command in corrections:
+                self._send_handshake_command(command)
+            return
 
-        return read
+        self._update_config_sync_state()
+        if self._confirmed_sync:
+            self._log("MeatPack configuration successfully synchronized and confirmed between host/device.")
+            # Devices without no-spaces support (protocol version 0) get spaces sent as they are.
+            self._set_packer_mode(self._no_spaces and self._protocol_version >= 1)
+            # The backlog goes out before the writers waiting for the sync are let through, in the order it was
+            # written.
+            with self._write_lock:
+                self._flush_backlog()
+                self._sync_pending = False
+                self._end_sync()
 
     # -------------------------------------------------------------------------------
     def _play_song_thread(self):
@@ -304,10 +730,38 @@ class PackingSerial(Serial):
 
     # -------------------------------------------------------------------------------
     def get_transmission_stats(self):
+        monitor = self._link_monitor
+        link = monitor.live() if monitor is not None else None
+        adaptive = self._adaptive
+        minimizer = self._minimizer
+        backlog = self._backlog
+
         return {
+            'linkUtilisation': link['utilisation'] if link is not None else None,
+            'linkOkPerSec': link['okPerSec'] if link is not None else None,
             'totalBytes': self._diagBytesSentTotal,
             'packedBytes': self._diagBytesSentActualTotal,
-            'totalBytesSec': self._totalBytesSec
+            'totalBytesSec': self._totalBytesSec,
+            'pipelineQueueDepth': self._pipeline_depth(),
+            'pipelinePeakDepth': self._pipeline_peak_depth,
+            'pipelineStallTime': self._pipeline_stall_time,
+            'pipelineStalls': self._pipeline_stalls,
+            'handshakes': self._handshakes,
+            'handshakeLatency': self._last_handshake_time,
+            'handshakeLatencyMean': self._handshake_time_total / self._handshakes if self._handshakes else None,
+            'syncBacklogDepth': len(backlog),
+            'syncBacklogPeakDepth': backlog.peak_depth,
+            'syncBacklogWaitTime': backlog.wait_time,
+            'syncBacklogWaits': backlog.waits,
+            'syncBacklogTimeouts': backlog.timeouts,
+            'syncBacklogDropped': backlog.dropped,
+            'adaptivePackingActive': not self._packing_suspended,
+            'adaptiveRatio': adaptive.ratio() if adaptive is not None else None,
+            'adaptiveSwitches': adaptive.switches if adaptive is not None else 0,
+            'expandedLines': adaptive.expanded_lines if adaptive is not None else 0,
+            'minimizedLines': minimizer.lines if minimizer is not None else 0,
+            'minimizerBytesSaved': minimizer.bytes_saved if minimizer is not None else 0,
+            'minimizerFeedratesDropped': minimizer.feedrates_dropped if minimizer is not None else 0
         }
 
         # -------------------------------------------------------------------------------
@@ -334,62 +788,366 @@ class PackingSerial(Serial):
             self._diagBytesSent = 0
             self._diagBytesSentActual = 0
 
+# -------------------------------------------------------------------------------
+    def _port_write(self, data):
+        view = memoryview(data)
+        deadline = None
+        while len(view):
+            written = super(PackingSerial, self).write(view)
+            if written is None:
+                written = len(view)
+            if written:
+                monitor = self._link_monitor
+                if monitor is not None:
+                    monitor.record_tx(written)
+                view = view[written:]
+                deadline = None
+                continue
+            now = time.time()
+            if deadline is None:
+                deadline = now + PortWriteTimeout
+            elif now > deadline:
+                raise SerialTimeoutException("Write timeout")
+            time.sleep(PortWriteRetryInterval)
+
+# -------------------------------------------------------------------------------
+    def _write_command(self, command):
+        # In pipelined mode the command is queued behind everything already packed, so data packed for the old
+        # device state never arrives after the command changing it.
+        if self._pipelined_writes:
+            with self._write_lock:
+                self._write_queue.put(command)
+            return
+        self._write_command_now(command)
+
+# -------------------------------------------------------------------------------
+    def _write_command_now(self, command):
+        self._port_write(mp.get_command_bytes(command))
+        # Waits until the command is out. (flushOutput() would discard whatever hasn't been sent yet.)
+        self.flush()
+
 # -------------------------------------------------------------------------------
     def _flush_buffer(self):
         if self._stable_state():
-            if len(self._buffer) > 0:
-                for line in self._buffer:
-                    super(PackingSerial, self).write(self._process_line_bytes(line))
-                self._buffer *= 0
+            self._flush_backlog()
+
+# -------------------------------------------------------------------------------
+    def _flush_backlog(self):
+        # The backlog is packed and sent in writes of up to SyncFlushChunkSize bytes (a longer line on its own).
+        # Callers hold the write lock, or are the only writer.
+        if len(self._backlog) == 0:
+            return
+        write = self._write_queue.put if self._pipelined_writes else self._port_write
+        chunk = []
+        chunk_size = 0
+        for line in self._backlog.drain():
+            packed = self._process_line_bytes(line)
+            if chunk and chunk_size + len(packed) > SyncFlushChunkSize:
+                write(b"".join(chunk))
+                chunk = []
+                chunk_size = 0
+            chunk.append(packed)
+            chunk_size += len(packed)
+        if chunk:
+            write(b"".join(chunk))
+        self._record_backlog()
+
+# -------------------------------------------------------------------------------
+    def _hold_back(self, data):
+        # Adds a line to the backlog while the state is synchronized, waiting for room if it is full. Returns False
+        # if the state got synchronized meanwhile, and the line should be written right away instead.
+        backlog = self._backlog
+        if len(data) <= 2:
+            backlog.drop()
+            return True
+
+        # A synchronization in progress usually completes within a few milliseconds
+        if self.wait_for_sync(HandshakeWriteWait):
+            return False
+
+        while True:
+            # Checked again under the lock: once the backlog is flushed, the line has to be written after it
+            with self._write_lock:
+                if self._stable_state():
+                    return False
+                if backlog.put(data):
+                    break
+            if not backlog.wait_for_space(self._sync_backlog_timeout):
+                raise SerialTimeoutException("Write timeout (MeatPack state not synchronized)")
+        self._record_backlog()
+        return True
+
+# -------------------------------------------------------------------------------
+    def _record_backlog(self):
+        metrics = self._metrics
+        if metrics is not None:
+            metrics.record_backlog(len(self._backlog))
 
 # -------------------------------------------------------------------------------
     def _process_line_bytes(self, line):
         if not self._packing_enabled:
             return line
-        str_line = line.decode("UTF-8", errors="ignore")
         if self.play_song_on_print_complete:
-            if "M84" in str_line:
+            if b"M84" in line:
                 self._log("End of print detected, playing song...")
                 self._play_song_thread()
 
-        return mp.pack_line(str_line)
+        minimizer = self._minimizer
+        to_pack = minimizer.minimize(line) if minimizer is not None else line
+
+        profile = self._profile
+        if profile is not None:
+            profile.add(to_pack)
+
+        adaptive = self._adaptive
+        if adaptive is not None:
+            return self._process_line_adaptive(to_pack, adaptive)
+
+        return self._pack_line(to_pack)
+
+# -------------------------------------------------------------------------------
+    def _process_line_adaptive(self, to_pack, adaptive):
+        # The line is packed either way, to keep the compression ratio up to date while packing is switched off.
+        packed = self._pack_line(to_pack)
+
+        if adaptive.record(len(to_pack), len(packed)):
+            self._adaptive_switch_due = True
+        return to_pack if self._packing_suspended else packed
+
+# -------------------------------------------------------------------------------
+    def _switch_adaptive_packing(self):
+        # Called once the line that triggered the switch has been written (or queued), so the command goes out
+        # between two lines. Like any other state change, it's confirmed with the device before writing resumes.
+        self._adaptive_switch_due = False
+        adaptive = self._adaptive
+        if adaptive is None or not self._packing_enabled:
+            return
+
+        adaptive.switched()
+        self._packing_suspended = not adaptive.packing
+        self._log("Adaptive packing: compression ratio {:.3f} over the last {} lines, packing {}.".format(
+            adaptive.ratio(), adaptive.window, "re-enabled" if adaptive.packing else "switched off"))
+
+        self._sync_pending = True
+        self._reset_config_sync_state()
+        self._write_command(mp.MPCommand_EnablePacking if adaptive.packing else mp.MPCommand_DisablePacking)
+        self.query_config_state(True)
 
 # -------------------------------------------------------------------------------
     def write(self, data):
+        streamer = self._streamer
+        if streamer is not None and streamer.running:
+            return self._write_streaming(data, streamer)
+
+        if self._pipelined_writes:
+            return self._pipeline_write(data)
+
+        metrics = self._metrics
+        if metrics is not None:
+            return self._write_measured(data, metrics)
+
         # If this is true, we are waiting for a response for the device state. Let's not write anything until it's
         # complete
         total_bytes = len(data)
 
-        if not self._stable_state():
-            if total_bytes > 2:
-                self._buffer.append(data)
-        else:
-            self._flush_buffer()
+        if not self._stable_state() and self._hold_back(data):
+            return total_bytes
 
+        with self._write_lock:
+            self._flush_buffer()
             data_out = self._process_line_bytes(data)
-            super(PackingSerial, self).write(data_out)
-            actual_bytes = len(data_out)
+            self._port_write(data_out)
+        actual_bytes = len(data_out)
+
+        self._benchmark_write_speed(actual_bytes, total_bytes)
+        if self._adaptive_switch_due:
+            self._switch_adaptive_packing()
+        return total_bytes
+
+# -------------------------------------------------------------------------------
+    def _write_streaming(self, data, streamer):
+        # Lines from OctoPrint while a packed stream is sent go out in between two of its writes. They can't be held
+        # back, the stream waits for the same synchronization anyway.
+        # The device counts the stream's line numbers, so lines OctoPrint numbered go out without their number and
+        # checksum (the plugin keeps OctoPrint's prints, and their "M110", from starting during a stream). An "M110"
+        # would set the device's line number in the middle of the stream, it's refused.
+        total_bytes = len(data)
+        if data[:1] == b"N":
+            data = NumberedLineRe.match(data).group(1) + b"\n"
+        if data.lstrip()[:4].upper() == b"M110":
+            raise ValueError("M110 can't be sent while a packed stream is being sent")
+
+        if not self._stable_state() and not self.wait_for_sync(self._sync_backlog_timeout):
+            raise SerialTimeoutException("Write timeout (MeatPack state not synchronized)")
 
-            self._benchmark_write_speed(actual_bytes, total_bytes)
+        data_out = self._process_line_bytes(data)
+        streamer.write_host(data_out)
+        self._benchmark_write_speed(len(data_out), total_bytes)
         return total_bytes
 
+# -------------------------------------------------------------------------------
+    def _write_measured(self, data, metrics):
+        # Same as write(), with timings recorded. Kept apart so write() doesn't pay for metrics when disabled.
+        start = clock()
+        total_bytes = len(data)
+
+        if not self._stable_state() and self._hold_back(data):
+            return total_bytes
+
+        with self._write_lock:
+            self._flush_buffer()
+            pack_start = clock()
+            data_out = self._process_line_bytes(data)
+            pack_time = clock() - pack_start
+            self._port_write(data_out)
+        actual_bytes = len(data_out)
+
+        self._benchmark_write_speed(actual_bytes, total_bytes)
+        metrics.record_line(total_bytes, actual_bytes, pack_time, clock() - start)
+        if self._adaptive_switch_due:
+            self._switch_adaptive_packing()
+        return total_bytes
+
+# -------------------------------------------------------------------------------
+    def _pipeline_depth(self):
+        pack_queue = self._pack_queue
+        write_queue = self._write_queue
+        if pack_queue is None or write_queue is None:
+            return 0
+        return pack_queue.qsize() + write_queue.qsize()
+
+# -------------------------------------------------------------------------------
+    def _pipeline_write(self, data):
+        # Errors from the writer thread are raised here, on the next write, as the port would have raised them.
+        error = self._pipeline_error
+        if error is not None:
+            self._pipeline_error = None
+            raise error
+
+        metrics = self._metrics
+        start = clock() if metrics is not None else 0.0
+
+        with self._pipeline_switch_lock:
+            if not self._pipelined_writes:
+                return self.write(data)
+
+            try:
+                self._pack_queue.put_nowait(data)
+            except queue.Full:
+                stall_start = time.time()
+                self._pack_queue.put(data)
+                self._pipeline_stall_time += time.time() - stall_start
+                self._pipeline_stalls += 1
+
+            depth = self._pack_queue.qsize()
+            if depth > self._pipeline_peak_depth:
+                self._pipeline_peak_depth = depth
+
+        if metrics is not None:
+            metrics.record_write(clock() - start)
+        return len(data)
+
+# -------------------------------------------------------------------------------
+    def _pipeline_pack_loop(self):
+        pack_queue = self._pack_queue
+        write_queue = self._write_queue
+        while True:
+            data = pack_queue.get()
+            if data is None:
+                write_queue.put(None)
+                return
+            if self._pipeline_stopping:
+                continue
+
+            # Same as a synchronous write(). The lock keeps the state check, packing and queueing together, so a
+            # command queued by readline() can't end up between them.
+            total_bytes = len(data)
+            data_out = None
+            if not self._stable_state():
+                self.wait_for_sync(HandshakeWriteWait)
+            while True:
+                with self._write_lock:
+                    if self._stable_state():
+                        self._flush_buffer()
+                        pack_start = clock()
+                        data_out = self._process_line_bytes(data)
+                        pack_time = clock() - pack_start
+                        write_queue.put(data_out)
+                        if self._adaptive_switch_due:
+                            self._switch_adaptive_packing()
+                        break
+                    if total_bytes <= 2:
+                        self._backlog.drop()
+                        break
+                    if self._backlog.put(data):
+                        self._record_backlog()
+                        break
+                # The backlog is full. Waiting happens without the lock, which readline() needs to drain it. It is
+                # bounded like a synchronous write's, so a cleanup is noticed even if the wait isn't woken up.
+                self._backlog.wait_for_space(self._sync_backlog_timeout or None)
+                if self._pipeline_stopping:
+                    break
+
+            if data_out is None:
+                continue
+
+            self._benchmark_write_speed(len(data_out), total_bytes)
+            metrics = self._metrics
+            if metrics is not None:
+                metrics.record_line(total_bytes, len(data_out), pack_time)
+
+# -------------------------------------------------------------------------------
+    def _pipeline_write_loop(self):
+        write_queue = self._write_queue
+        held = []
+        while True:
+            item = held.pop() if held else write_queue.get()
+            if item is None:
+                return
+            if self._pipeline_stopping:
+                continue
+
+            # Commands are queued as their command byte, packed data as bytes. Packed data already waiting behind
+            # this item goes out with the same write.
+            try:
+                if isinstance(item, int):
+                    self._write_command_now(item)
+                else:
+                    batch = [item]
+                    while True:
+                        try:
+                            following = write_queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if following is None or isinstance(following, int):
+                            held.append(following)
+                            break
+                        batch.append(following)
+                    self._port_write(b"".join(batch) if len(batch) > 1 else item)
+            except Exception as e:
+                if self._pipeline_error is None:
+                    self._log("Pipelined write failed: {}".format(e))
+                self._pipeline_error = e
+
+# -------------------------------------------------------------------------------
+    def _send_handshake_command(self, command):
+        self._pending_reports += 1
+        self._query_msg_timer = time.time()
+        self._write_command(command)
+
 # -------------------------------------------------------------------------------
     def query_config_state(self, force=False):
         """Queries the packing state from the system. Sends command and awaits response"""
         if self.isOpen():
 
-            # This is used to prevent too many query messages from going out at once
-            if self._expecting_response:
-                time_limit = 0.6 if self._already_initialized else 3.0
-                if force:
-                    time_limit = 0.25
-                if time.time() - self._query_msg_timer < time_limit:
+            # A report is on its way already, unless it's overdue (lost, or the query was sent while the printer
+            # was booting). Then what was sent before isn't waited for anymore.
+            if self._pending_reports and not force:
+                if time.time() - self._query_msg_timer < HandshakeRetryInterval:
                     return
+                self._pending_reports = 0
 
-            self._query_msg_timer = time.time()
             self._reset_config_sync_state()
-            super(PackingSerial, self).write(mp.get_command_bytes(mp.MPCommand_QueryConfig))
-            self.flushOutput()
-            self._expecting_response = True
+            self._send_handshake_command(mp.MPCommand_QueryConfig)
         else:
             self._log("Cannot query packing state -- port not open.")
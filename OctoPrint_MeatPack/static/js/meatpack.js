@@ -22,6 +22,9 @@ $(function() {
         var name_txrate = gettext("Effective TX Rate");
         var text_txrate = gettext("Total avg data transmitted per second (5 second period).");
 
+        var name_link = gettext("Link Usage");
+        var text_link = gettext("Serial link utilisation (packed bytes x 10 bits / baud rate) over the last second.");
+
         var name_enabled = gettext("Packing State");
         var text_enabled = gettext("State of whether or not g-code packing is enabled.");
 
@@ -35,6 +38,7 @@ $(function() {
         self.totalBytes = 0.0
         self.totalBytesSec = 0.0
         self.packedBytes = 0.0
+        self.linkUtilisation = null
 
         self.packingEnabled = ko.pureComputed(function() {
             return self.settings.settings.plugins.meatpack.enableMeatPack() ? true : false;
@@ -60,6 +64,7 @@ $(function() {
             self.totalBytes = response.transmissionStats.totalBytes;
             self.totalBytesSec = response.transmissionStats.totalBytesSec;
             self.packedBytes = response.transmissionStats.packedBytes;
+            self.linkUtilisation = response.transmissionStats.linkUtilisation;
 
             // self.transmissionStats(response);
             self.dataReceived = true;
@@ -122,6 +127,15 @@ $(function() {
             }
         };
 
+        self.linkString = function() {
+            if (self.dataReceived && self.linkUtilisation !== null && self.linkUtilisation !== undefined){
+                return (self.linkUtilisation * 100.0).toFixed(0) + "%";
+            }
+            else{
+                return "No Data";
+            }
+        };
+
          self.enabledString = ko.pureComputed(function() {
             if (self.packingEnabled()){
                 return "Enabled";
@@ -162,6 +176,10 @@ $(function() {
                 document.getElementById("meatpack_rate_string").innerHTML =
                 "<span title='" +
                 text_txrate + "'>" + name_txrate + "</span>: <strong>" + self.txRateString() + "</strong></div>";
+
+                document.getElementById("meatpack_link_string").innerHTML =
+                "<span title='" +
+                text_link + "'>" + name_link + "</span>: <strong>" + self.linkString() + "</strong></div>";
             }
         };
 
@@ -184,6 +202,9 @@ $(function() {
                 "<div id='meatpack_rate_string' data-bind='visible: showTXStats()'><span title='" +
                 text_txrate + "'>" + name_txrate + "</span>: No Data</div>" +
 
+                "<div id='meatpack_link_string' data-bind='visible: showTXStats()'><span title='" +
+                text_link + "'>" + name_link + "</span>: No Data</div>" +
+
                 "<div id='meatpack_enabled_string' data-bind='visible: showTXStats()'><span title='" +
                 text_enabled + "'>" + name_enabled +
                 "</span>: <strong data-bind='text: enabledString'></strong></div>" +
@@ -203,6 +224,7 @@ $(function() {
         "#meatpack_packed_tx_string",
         "#meatpack_ratio_string",
         "#meatpack_rate_string",
+        "#meatpack_link_string",
         "#meatpack_enabled_string"]
     });
 });
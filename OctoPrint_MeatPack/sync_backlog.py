@@ -0,0 +1,107 @@
+# Sync backlog
+# Lines can't be packed while the packing state is being synchronized with the device, so they are held back until
+# the state is confirmed. The backlog is a ring of fixed capacity allocated up front: once it is full, writers wait
+# for it to drain instead of it growing without bound, e.g. when the handshake after a firmware reset is slow or
+# never completes.
+import threading
+import time
+
+# Lines held back at most, and the longest a write waits for room in the backlog (seconds)
+SyncBacklogCapacity = 256
+SyncBacklogTimeout = 10.0
+
+
+class SyncBacklog:
+    """Fixed-capacity FIFO of lines, with writers blocking (or timing out) while it is full."""
+
+    def __init__(self, capacity=SyncBacklogCapacity):
+        self._cond = threading.Condition()
+        self._slots = []
+        self._head = 0
+        self._count = 0
+        self.capacity = 0
+        self.peak_depth = 0
+        self.wait_time = 0.0
+        self.waits = 0
+        self.timeouts = 0
+        self.dropped = 0
+        self.resize(capacity)
+
+# -------------------------------------------------------------------------------
+    def __len__(self):
+        return self._count
+
+# -------------------------------------------------------------------------------
+    def resize(self, capacity):
+        """Changes the capacity, keeping the lines held back (even if there are more than fit)."""
+        with self._cond:
+            lines = self._take_all()
+            self.capacity = max(1, int(capacity))
+            self._slots = max(self.capacity, len(lines)) * [None]
+            self._slots[:len(lines)] = lines
+            self._head = 0
+            self._count = len(lines)
+            self._cond.notify_all()
+
+# -------------------------------------------------------------------------------
+    def put(self, line):
+        """Appends a line. Returns False (without waiting) if the backlog is full."""
+        with self._cond:
+            count = self._count
+            if count >= self.capacity:
+                return False
+            slots = self._slots
+            slots[(self._head + count) % len(slots)] = line
+            count += 1
+            self._count = count
+            if count > self.peak_depth:
+                self.peak_depth = count
+            return True
+
+# -------------------------------------------------------------------------------
+    def drop(self):
+        """Counts a line that wasn't held back (too short to be a command)."""
+        with self._cond:
+            self.dropped += 1
+
+# -------------------------------------------------------------------------------
+    def wait_for_space(self, timeout=None):
+        """Waits until a line can be added, at most timeout seconds (None waits indefinitely). Returns False if the
+        backlog is still full."""
+        with self._cond:
+            if self._count < self.capacity:
+                return True
+            start = time.time()
+            self.waits += 1
+            deadline = start + timeout if timeout is not None else None
+            while self._count >= self.capacity:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0.0:
+                    self.timeouts += 1
+                    break
+                self._cond.wait(remaining)
+            self.wait_time += time.time() - start
+            return self._count < self.capacity
+
+# -------------------------------------------------------------------------------
+    def drain(self):
+        """Removes and returns all lines, oldest first, and wakes up waiting writers."""
+        with self._cond:
+            lines = self._take_all()
+            self._cond.notify_all()
+            return lines
+
+# -------------------------------------------------------------------------------
+    def _take_all(self):
+        slots = self._slots
+        head = self._head
+        end = head + self._count
+        if end <= len(slots):
+            lines = slots[head:end]
+        else:
+            lines = slots[head:] + slots[:end - len(slots)]
+        for idx in range(self._count):
+            slots[(head + idx) % len(slots)] = None
+        self._head = 0
+        self._count = 0
+        return lines
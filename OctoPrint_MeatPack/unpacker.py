@@ -0,0 +1,283 @@
+# Reference MeatPack decoder
+# Unpacks a packed stream the same way the firmware does, but in bulk, so packed files can be verified on the host at
+# speed. Runs of fully packed bytes are decoded with bytes.translate(); only bytes carrying full-width characters and
+# command words go through Python code.
+import random
+import re
+import OctoPrint_MeatPack.meatpack as mp
+
+UnpackerChunkSize = 1024 * 1024
+
+UnpackerCommandWord = bytes(bytearray([mp.MPCommand_SignalByte, mp.MPCommand_SignalByte]))
+UnpackerNewlineNibble = mp.MeatPackReverseLookupTbl['\n']
+UnpackerLiteralNibble = 0b1111
+
+# Bytes announcing full-width characters. A 0b1111 low nibble means a full-width character comes first, then the
+# packed high character. A 0b1111 high nibble means the packed low character comes first, then a full-width
+# character (except after a newline, where the rest of the byte is padding). 0xFF means two full-width characters.
+UnpackerLowLiteral = bytes(bytearray([(high << 4) | UnpackerLiteralNibble for high in range(15)]))
+UnpackerHighLiteral = bytes(bytearray([0xF0 | low for low in range(15) if low != UnpackerNewlineNibble]))
+
+
+# -------------------------------------------------------------------------------
+def _byte_class(chars):
+    return b"[" + b"".join(re.escape(bytes(bytearray([c]))) for c in bytearray(chars)) + b"]"
+
+
+# A full-width unit: 0xFF plus two characters, or a single-literal byte plus one character.
+UnpackerUnitRe = re.compile(b"(\\xff..|" + _byte_class(UnpackerLowLiteral + UnpackerHighLiteral) + b".)",
+                            re.DOTALL)
+# Any byte that starts a full-width unit (used to find an incomplete unit at the end of the data)
+UnpackerUnitStartRe = re.compile(_byte_class(UnpackerLowLiteral + UnpackerHighLiteral + b"\xff"))
+
+# Decoding tables by no-spaces mode, built on first use
+UnpackerTables = {}
+
+# Runs of plain bytes are joined with 0xFF (which never occurs in a run) and decoded in one go. 0xFF decodes to
+# this byte, which never occurs in decoded output, so the result can be split back into runs.
+UnpackerRunSeparator = b"\x01"
+
+
+class _UnitTable(dict):
+    # Two-character (0xFF) units decode to the characters themselves and aren't stored
+    def __missing__(self, key):
+        return key[1:]
+
+
+# -------------------------------------------------------------------------------
+def _get_tables(no_spaces):
+    tables = UnpackerTables.get(no_spaces)
+    if tables is not None:
+        return tables
+
+    chars = [b"\0"] * 16
+    for char, value in mp.MeatPackReverseLookupTbl.items():
+        chars[value] = char.encode("ascii")
+    if no_spaces:
+        chars[mp.MeatPackReverseLookupTbl[' ']] = mp.MeatPackSpaceReplacedCharacter.encode("ascii")
+
+    # Plain bytes: the low character, and the high character (or \0, which is deleted, after a newline)
+    low = bytearray(256)
+    high = bytearray(256)
+    for c in range(256):
+        low[c] = ord(chars[c & 0xF])
+        high[c] = 0 if (c & 0xF) == UnpackerNewlineNibble else ord(chars[c >> 4])
+    low[0xFF] = ord(UnpackerRunSeparator)
+    high[0xFF] = 0
+
+    # Single full-width units
+    units = _UnitTable()
+    for literal in range(256):
+        lit = bytes(bytearray([literal]))
+        for c in bytearray(UnpackerLowLiteral):
+            units[bytes(bytearray([c, literal]))] = lit + chars[c >> 4]
+        for c in bytearray(UnpackerHighLiteral):
+            units[bytes(bytearray([c, literal]))] = chars[c & 0xF] + lit
+
+    tables = UnpackerTables[no_spaces] = (bytes(low), bytes(high), units)
+    return tables
+
+
+class Unpacker:
+    """Stream decoder for packed data. feed() accepts chunks of any size and returns the decoded bytes available
+    so far; incomplete units at the end of a chunk are kept until the next one. Command words are applied and
+    passed to on_command (if given) as they are found.
+    """
+
+    def __init__(self, active=False, no_spaces=False, on_command=None):
+        self.active = active
+        self.no_spaces = no_spaces
+        self.on_command = on_command
+        self._pending = b""
+
+# -------------------------------------------------------------------------------
+    @property
+    def pending(self):
+        """Bytes held back because they don't form a complete unit yet."""
+        return self._pending
+
+# -------------------------------------------------------------------------------
+    def _handle_command(self, command):
+        if command == mp.MPCommand_EnablePacking:
+            self.active = True
+        elif command == mp.MPCommand_DisablePacking:
+            self.active = False
+        elif command == mp.MPCommand_ResetAll:
+            self.active = False
+            self.no_spaces = False
+        elif command == mp.MPCommand_EnableNoSpaces:
+            self.no_spaces = True
+        elif command == mp.MPCommand_DisableNoSpaces:
+            self.no_spaces = False
+
+        if self.on_command is not None:
+            self.on_command(command)
+
+# -------------------------------------------------------------------------------
+    def _decode(self, data, out):
+        # Decodes data (without command words) into out, returns the incomplete tail.
+        if not self.active:
+            if data.endswith(b"\xff"):
+                out.append(data[:-1])
+                return data[-1:]
+            out.append(data)
+            return b""
+
+        low, high, units = _get_tables(self.no_spaces)
+        parts = UnpackerUnitRe.split(data)
+
+        tail = b""
+        match = UnpackerUnitStartRe.search(parts[-1])
+        if match:
+            tail = parts[-1][match.start():]
+            parts[-1] = parts[-1][:match.start()]
+
+        runs = b"\xff".join(parts[0::2])
+        decoded = bytearray(2 * len(runs))
+        decoded[0::2] = runs.translate(low)
+        decoded[1::2] = runs.translate(high)
+
+        parts[0::2] = decoded.translate(None, b"\0").split(UnpackerRunSeparator)
+        parts[1::2] = list(map(units.__getitem__, parts[1::2]))
+        out.append(b"".join(parts))
+        return tail
+
+# -------------------------------------------------------------------------------
+    def feed(self, data):
+        data = self._pending + bytes(data)
+        out = []
+        carry = b""
+        pos = 0
+
+        while True:
+            idx = data.find(UnpackerCommandWord, pos)
+            if idx < 0 or idx + 2 >= len(data):
+                end = len(data) if idx < 0 else idx
+                carry = self._decode(carry + data[pos:end], out)
+                self._pending = carry + data[end:]
+                break
+
+            # A unit left open before the command word continues after it, as in the firmware
+            carry = self._decode(carry + data[pos:idx], out)
+            self._handle_command(bytearray(data[idx + 2:idx + 3])[0])
+            pos = idx + 3
+
+        return b"".join(out)
+
+
+# -------------------------------------------------------------------------------
+def unpack(data, active=False, no_spaces=False):
+    """Decodes a complete packed buffer in one go."""
+    return Unpacker(active, no_spaces).feed(data)
+
+
+# -------------------------------------------------------------------------------
+def iter_unpack_file(in_filename, chunk_size=UnpackerChunkSize, unpacker=None):
+    """Generator yielding the decoded contents of a packed file (e.g. pack_file() output) in blocks."""
+    if unpacker is None:
+        unpacker = Unpacker()
+    with open(in_filename, "rb") as in_file:
+        while True:
+            chunk = in_file.read(chunk_size)
+            if not chunk:
+                break
+            decoded = unpacker.feed(chunk)
+            if decoded:
+                yield decoded
+
+
+# -------------------------------------------------------------------------------
+def expected_unpacked(line, no_spaces):
+    """Returns what decoding pack_line(line) should give back (bytes in, bytes out)."""
+    first = line[:1]
+    if first == b';' or first == b'\n' or first == b'\r' or len(line) < 2:
+        return b""
+    elif b';' in line:
+        line = line.partition(b';')[0].rstrip() + b"\n"
+
+    line = mp._unified_method_bytes(line, no_spaces)
+
+    # pack_line() pads odd lengths with a newline, which is only dropped when it follows a newline
+    if len(line) & 1 and not line.endswith(b"\n"):
+        line += b"\n"
+    return line
+
+
+# -------------------------------------------------------------------------------
+def verify_packed_file(gcode_filename, packed_filename, chunk_size=UnpackerChunkSize):
+    """Decodes a packed file and compares it against its source g-code file.
+
+    Returns (matches, decoded byte count, offset of the first difference in the decoded stream or None).
+    """
+    unpacker = Unpacker()
+    expected = bytearray()
+    decoded = bytearray()
+    offset = 0
+
+    with open(gcode_filename, "rb") as gcode_file, open(packed_filename, "rb") as packed_file:
+        lines = iter(gcode_file)
+        lines_left = True
+
+        while True:
+            chunk = packed_file.read(chunk_size)
+            if chunk:
+                decoded += unpacker.feed(chunk)
+
+            # Expand the source only as far as needed, so memory use stays bounded
+            while lines_left and len(expected) < len(decoded) + chunk_size:
+                line = next(lines, None)
+                if line is None:
+                    lines_left = False
+                    break
+                expected += expected_unpacked(line.replace(b"\r\n", b"\n"), unpacker.no_spaces)
+
+            count = min(len(expected), len(decoded))
+            if expected[:count] != decoded[:count]:
+                for idx in range(count):
+                    if expected[idx] != decoded[idx]:
+                        return False, offset + len(decoded), offset + idx
+            del expected[:count]
+            del decoded[:count]
+            offset += count
+
+            if not chunk:
+                break
+
+    if expected or decoded:
+        return False, offset + len(decoded), offset
+    return True, offset, None
+
+
+# -------------------------------------------------------------------------------
+def fuzz_round_trip(iterations=10000, seed=None, max_len=48, engines=None):
+    """Property test: random g-code-like lines are packed with each engine in both no-spaces modes, decoded in
+    randomly split chunks and compared to expected_unpacked(). Returns a list of failures as tuples of
+    (engine, no_spaces, line, expected, decoded); an empty list means every round trip matched.
+    """
+    rnd = random.Random(seed)
+    alphabet = b"0123456789.  GXEYZFMSTNIJgxeyzfms*;-+_/?O\t\r"
+    engines = engines or sorted(mp.PackingEngines)
+    failures = []
+
+    for _ in range(iterations):
+        line = bytes(bytearray(rnd.choice(bytearray(alphabet)) for _ in range(rnd.randint(1, max_len))))
+        if rnd.random() < 0.8:
+            line += b"\n"
+
+        for no_spaces in (False, True):
+            expected = expected_unpacked(line, no_spaces)
+            for engine in engines:
+                packed = bytes(mp.get_packing_engine(engine, no_spaces)(line))
+
+                # Split the packed line at random points to exercise the streaming state
+                unpacker = Unpacker(active=True, no_spaces=no_spaces)
+                decoded = bytearray()
+                pos = 0
+                while pos < len(packed):
+                    step = rnd.randint(1, 4)
+                    decoded += unpacker.feed(packed[pos:pos + step])
+                    pos += step
+
+                if bytes(decoded) != expected or unpacker.pending:
+                    failures.append((engine, no_spaces, line, expected, bytes(decoded)))
+    return failures
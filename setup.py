@@ -1,5 +1,5 @@
 # coding=utf-8
-from setuptools import setup
+from setuptools import setup, Extension
 
 # The plugin's identifier, has to be unique
 plugin_identifier = "meatpack"
@@ -52,7 +52,15 @@ plugin_ignored_packages = []
 #     plugin_requires = ["someDependency==dev"]
 #     additional_setup_parameters = {"dependency_links":
 #           ["https://github.com/someUser/someRepo/archive/master.zip#egg=someDependency-dev"]}
-additional_setup_parameters = {}
+additional_setup_parameters = {
+    "entry_points": {
+        "console_scripts": ["meatpack = OctoPrint_MeatPack.cli:main"]
+    },
+    # Compiled packer. Optional: if it can't be built (no compiler), the plugin uses its pure Python packing engines.
+    "ext_modules": [
+        Extension("OctoPrint_MeatPack._cpacker", ["OctoPrint_MeatPack/_cpacker.c"], optional=True)
+    ]
+}
 
 try:
     import octoprint_setuptools
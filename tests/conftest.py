@@ -0,0 +1,12 @@
+# The plugin module (OctoPrint_MeatPack/__init__.py) needs OctoPrint, the modules under test don't. Without OctoPrint
+# installed, the package is registered without running it, so the tests run all the same.
+import os
+import sys
+import types
+
+try:
+    import octoprint  # noqa: F401
+except ImportError:
+    _package = types.ModuleType("OctoPrint_MeatPack")
+    _package.__path__ = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "OctoPrint_MeatPack")]
+    sys.modules["OctoPrint_MeatPack"] = _package
@@ -0,0 +1,338 @@
+# PackingSerial's serial path: what goes out to the port, and what it counts. The tests with an emulated printer
+# (OctoPrint_MeatPack/emulator.py, on a pseudo-terminal) need a posix system.
+import os
+import threading
+import time
+import pytest
+from serial import Serial, SerialTimeoutException
+import OctoPrint_MeatPack.meatpack as mp
+import OctoPrint_MeatPack.packing_serial as ps
+from OctoPrint_MeatPack.packing_serial import PackingSerial
+from OctoPrint_MeatPack.adaptive_packing import AdaptivePacking
+from OctoPrint_MeatPack.emulator import FirmwareEmulator, _expected_line
+from OctoPrint_MeatPack.gcode_minimizer import MinimizeModal
+from OctoPrint_MeatPack.link_monitor import LinkMonitorInterval
+
+
+class _Logger:
+    def info(self, message):
+        pass
+
+
+class _PartialPort:
+    """Stands in for Serial.write() with write_timeout=0: takes at most `chunk` bytes per call, none while stalled."""
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.stalls = 0
+        self.written = bytearray()
+        self.calls = []
+
+    def write(self, data):
+        self.calls.append(len(data))
+        if self.stalls:
+            self.stalls -= 1
+            return 0
+        data = bytes(data)[:self.chunk]
+        self.written += data
+        return len(data)
+
+
+class _EmulatedPrinter:
+    """A PackingSerial connected to a FirmwareEmulator, with a reader thread as OctoPrint has one."""
+
+    def __init__(self, no_spaces=True, protocol_version=1):
+        self.emulator = FirmwareEmulator(1000000, protocol_version)
+        self.emulator.start()
+        self.port = PackingSerial(_Logger(), port=self.emulator.port, baudrate=1000000, timeout=0.05)
+        self.port.play_song_on_print_complete = False
+        self.port.omit_all_spaces = no_spaces
+        self.no_spaces = no_spaces
+        self.responses = []
+        self._reading = True
+        self._reader = threading.Thread(target=self._read_loop)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read_loop(self):
+        while self._reading:
+            line = self.port.readline()
+            if line:
+                self.responses.append(line)
+
+    def wait_for(self, condition, timeout=5.0):
+        end = time.time() + timeout
+        while not condition():
+            if time.time() > end:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def expected(self, lines):
+        # Devices without no-spaces support get the spaces
+        no_spaces = self.no_spaces and self.emulator.decoder.protocol_version >= 1
+        return [_expected_line(line, no_spaces, packed)
+                for line, packed in zip(lines, self.emulator.lines_packed)]
+
+    def close(self):
+        self._reading = False
+        self._reader.join()
+        self.port.close()
+        self.emulator.stop()
+
+
+@pytest.fixture
+def printer(request):
+    # Parametrized indirectly with the protocol version, 1 by default
+    if os.name != "posix":
+        pytest.skip("the emulator needs a pseudo-terminal")
+    printer = _EmulatedPrinter(protocol_version=getattr(request, "param", 1))
+    printer.port.packing_enabled = True
+    assert printer.port.wait_for_sync(5)
+    yield printer
+    printer.close()
+
+
+@pytest.fixture
+def partial_port(monkeypatch):
+    port = _PartialPort(5)
+    monkeypatch.setattr(Serial, "write", port.write)
+    return port
+
+
+@pytest.fixture
+def packing_serial():
+    # Not opened, the port's writes are mocked
+    port = PackingSerial(_Logger())
+    yield port
+    port.cleanup()
+
+
+# -------------------------------------------------------------------------------
+def test_port_write_partial_writes(partial_port, packing_serial):
+    packing_serial.monitor_link = True
+    counted = []
+    packing_serial._link_monitor.record_tx = counted.append
+    partial_port.stalls = 3
+
+    data = bytes(bytearray(range(48)))
+    packing_serial._port_write(data)
+    assert bytes(partial_port.written) == data
+    # Only what the port took is counted
+    assert counted == [5] * 9 + [3]
+
+
+# -------------------------------------------------------------------------------
+def test_port_write_timeout(partial_port, packing_serial, monkeypatch):
+    monkeypatch.setattr(ps, "PortWriteTimeout", 0.05)
+    partial_port.stalls = 1000000
+    with pytest.raises(SerialTimeoutException):
+        packing_serial._port_write(b"G1 X10\n")
+    assert not partial_port.written
+
+
+# -------------------------------------------------------------------------------
+def test_sync_backlog_flush_in_chunks(partial_port, packing_serial, monkeypatch):
+    monkeypatch.setattr(ps, "HandshakeWriteWait", 0.0)
+    monkeypatch.setattr(ps, "SyncFlushChunkSize", 64)
+    partial_port.chunk = 1024
+    packing_serial.sync_backlog_size = 12
+    packing_serial.sync_backlog_timeout = 0.05
+
+    # Not synchronized: the lines are held back until the backlog is full, then writes time out
+    lines = [b"G1 X%d.5 Y%d.25 E0.%d\n" % (n, 2 * n, n) for n in range(12)]
+    for line in lines:
+        assert packing_serial.write(line) == len(line)
+    with pytest.raises(SerialTimeoutException):
+        packing_serial.write(b"G1 X1\n")
+    assert not partial_port.written
+    assert packing_serial.get_transmission_stats()['syncBacklogTimeouts'] == 1
+
+    # Once synchronized, the backlog goes out ahead of the next line, in writes of at most 64 bytes
+    packing_serial._confirmed_sync = True
+    packing_serial._sync_event.set()
+    packing_serial.write(b"M105\n")
+    packed = [packing_serial._pack_line(line) for line in lines + [b"M105\n"]]
+    assert bytes(partial_port.written) == b"".join(packed)
+    assert len(partial_port.calls) > 2 and max(partial_port.calls[:-1]) <= 64
+    assert len(packing_serial._backlog) == 0
+
+
+# -------------------------------------------------------------------------------
+def test_sync_backlog_with_emulator(printer, monkeypatch):
+    monkeypatch.setattr(ps, "HandshakeRetryInterval", 0.1)
+    monkeypatch.setattr(ps, "HandshakeWriteWait", 0.0)
+    monkeypatch.setattr(ps, "SyncFlushChunkSize", 64)
+    decoder = printer.emulator.decoder
+    handle_command = decoder._handle_command
+    answering = [False]
+
+    def stalled(command):
+        # The state changes, the report doesn't come until the printer "answers" again
+        report = handle_command(command)
+        return report if answering[0] else b""
+
+    monkeypatch.setattr(decoder, "_handle_command", stalled)
+    printer.emulator.reset()
+    assert printer.wait_for(lambda: not printer.port._stable_state())
+
+    lines = [b"G1 X%d.5 Y%d.25 E0.%d\n" % (n, 2 * n, n) for n in range(40)]
+    for line in lines:
+        printer.port.write(line)
+    time.sleep(0.2)
+    assert printer.emulator.lines == []
+    assert len(printer.port._backlog) == len(lines)
+
+    answering[0] = True
+    assert printer.wait_for(lambda: len(printer.emulator.lines) == len(lines))
+    assert printer.emulator.lines == printer.expected(lines)
+    assert all(printer.emulator.lines_packed)
+    stats = printer.port.get_transmission_stats()
+    assert stats['syncBacklogPeakDepth'] == len(lines) and stats['syncBacklogTimeouts'] == 0
+
+
+# -------------------------------------------------------------------------------
+def test_adaptive_packing_with_emulator(printer):
+    printer.port.adaptive_packing = True
+    printer.port._adaptive = AdaptivePacking(window=10, min_lines_between_switches=10)
+
+    # Messages gain nothing from packing, it's switched off after the first 10 lines
+    lines = [b"M117 Layer %d of 40, slow print\n" % n for n in range(30)]
+    for line in lines:
+        assert printer.port.write(line) == len(line)
+    assert printer.wait_for(lambda: len(printer.emulator.lines) == len(lines))
+    assert printer.emulator.lines == printer.expected(lines)
+    assert printer.emulator.lines_packed[:10] == [True] * 10 and not any(printer.emulator.lines_packed[11:])
+    stats = printer.port.get_transmission_stats()
+    assert stats['adaptiveSwitches'] == 1 and not stats['adaptivePackingActive']
+    assert printer.port.wait_for_sync(5) and not printer.emulator.decoder.active
+
+    # Saving the settings again doesn't start over
+    printer.port.packing_enabled = True
+    assert printer.port.wait_for_sync(5) and not printer.emulator.decoder.active
+    assert printer.port.get_transmission_stats()['adaptiveSwitches'] == 1
+
+    # A printer reset does
+    handshakes = printer.port.get_transmission_stats()['handshakes']
+    printer.emulator.reset()
+    assert printer.wait_for(lambda: printer.port.get_transmission_stats()['handshakes'] > handshakes and
+                            printer.port._stable_state())
+    assert printer.emulator.decoder.active
+    stats = printer.port.get_transmission_stats()
+    assert stats['adaptiveSwitches'] == 0 and stats['adaptivePackingActive']
+
+
+# -------------------------------------------------------------------------------
+def test_link_monitor_with_emulator(printer):
+    # Off unless enabled
+    assert not printer.port.monitor_link and printer.port.get_link_report() is None
+
+    printer.port.monitor_link = True
+    printer.port.begin_link_report()
+    received = printer.emulator.bytes_received
+    lines = [b"G1 X%d.5 Y%d.25 E0.%d\n" % (n, 2 * n, n) for n in range(200)]
+    for idx, line in enumerate(lines):
+        printer.port.write(line)
+        # One line in flight, as OctoPrint sends while printing
+        assert printer.wait_for(lambda: printer.responses.count(b"ok\n") > idx)
+    # The report covers whole intervals
+    time.sleep(LinkMonitorInterval + 0.05)
+    report = printer.port.get_link_report()
+
+    assert printer.emulator.lines == printer.expected(lines)
+    # Every byte written is counted, once
+    assert report['bytesSent'] == printer.emulator.bytes_received - received
+    assert report['baudrate'] == 1000000 and report['measuredTime'] > 0
+    assert 0 < report['meanUtilisation'] < report['threshold'] and report['saturatedPeriods'] == 0
+
+
+# -------------------------------------------------------------------------------
+def test_pipelined_writes_with_emulator(printer):
+    printer.port.pipelined_writes = True
+    lines = [b"G1 X%d.5 Y%d.25 E0.%d\n" % (n, 2 * n, n) for n in range(400)]
+    # Up to 8 lines in flight. Halfway through, whitespace removal is switched off: the commands are queued behind
+    # the lines packed before, and the lines after them are held back until the device has confirmed.
+    for idx, line in enumerate(lines):
+        if idx == 200:
+            printer.port.omit_all_spaces = False
+        assert printer.wait_for(lambda: printer.responses.count(b"ok\n") >= idx - 8)
+        assert printer.port.write(line) == len(line)
+    assert printer.wait_for(lambda: len(printer.emulator.lines) == len(lines))
+    printer.port.pipelined_writes = False
+
+    expected = [_expected_line(line, idx < 200) for idx, line in enumerate(lines)]
+    assert printer.emulator.lines == expected
+    assert all(printer.emulator.lines_packed)
+    assert not printer.emulator.decoder.no_spaces
+    stats = printer.port.get_transmission_stats()
+    assert stats['pipelineQueueDepth'] == 0 and stats['pipelinePeakDepth'] >= 1
+    assert stats['syncBacklogTimeouts'] == 0
+
+
+# -------------------------------------------------------------------------------
+def _numbered(number, body):
+    line = b"N%d %s" % (number, body)
+    return b"%s*%d\n" % (line, mp.line_checksum(line))
+
+
+# -------------------------------------------------------------------------------
+def test_minimizer_with_emulator(printer):
+    printer.port.minimize_level = MinimizeModal
+    # As OctoPrint sends a print: numbered and checksummed. The emulator checks the checksums of the minimized lines.
+    sent = [(b"G1 X10.500 Y20.250 E0.5000 F1800", b"G1 X10.5 Y20.25 E.5 F1800"),
+            (b"G1 X11.000 Y21 F1800", b"G1 X11 Y21"),
+            (b"G1 X12 Y22 E1.0 F1800", b"G1 X12 Y22 E1"),
+            (b"M117 Printing 1.500", b"M117 Printing 1.500"),
+            # Homing may change the feedrate
+            (b"G28", b"G28"),
+            (b"G1 X1 F1800", b"G1 X1 F1800")]
+    lines = [b"M110 N0\n"] + [_numbered(number, raw) for number, (raw, _) in enumerate(sent, 1)]
+    minimized = [b"M110 N0\n"] + [_numbered(number, body) for number, (_, body) in enumerate(sent, 1)]
+    for idx, line in enumerate(lines):
+        printer.port.write(line)
+        assert printer.wait_for(lambda: printer.responses.count(b"ok\n") > idx)
+    assert printer.emulator.lines == printer.expected(minimized)
+    assert printer.emulator.resends == 0
+    stats = printer.port.get_transmission_stats()
+    assert stats['minimizerBytesSaved'] == sum(len(line) for line in lines) - sum(len(line) for line in minimized)
+    assert stats['minimizerFeedratesDropped'] == 2
+
+    # After a printer reset, the feedrate it had is forgotten
+    handshakes = stats['handshakes']
+    printer.emulator.reset()
+    assert printer.wait_for(lambda: printer.port.get_transmission_stats()['handshakes'] > handshakes and
+                            printer.port._stable_state())
+    del printer.emulator.lines[:]
+    del printer.emulator.lines_packed[:]
+    del printer.responses[:]
+    printer.port.write(b"G1 X2.50 F1800\n")
+    assert printer.wait_for(lambda: b"ok\n" in printer.responses)
+    assert printer.emulator.lines == printer.expected([b"G1 X2.5 F1800\n"])
+
+
+# -------------------------------------------------------------------------------
+@pytest.mark.parametrize("printer", [0, 1], indirect=True)
+def test_state_reports_with_emulator(printer):
+    decoder = printer.emulator.decoder
+    assert decoder.active and decoder.no_spaces == (decoder.protocol_version >= 1)
+    assert printer.port.get_transmission_stats()['handshakes'] == 1
+
+    # Settings changed several times before the device has answered: the reports to earlier commands are skipped,
+    # the one to the last command sent decides what is corrected
+    for no_spaces in (False, True, False, True):
+        printer.port.omit_all_spaces = no_spaces
+    printer.port.packing_enabled = False
+    printer.port.packing_enabled = True
+    assert printer.port.wait_for_sync(5)
+    assert printer.wait_for(lambda: printer.port._pending_reports == 0)
+    assert decoder.active and decoder.no_spaces == (decoder.protocol_version >= 1)
+    assert printer.port._stable_state()
+
+    lines = [b"G1 X%d.5 Y%d.25 E0.%d\n" % (n, 2 * n, n) for n in range(20)]
+    for idx, line in enumerate(lines):
+        printer.port.write(line)
+        assert printer.wait_for(lambda: printer.responses.count(b"ok\n") > idx)
+    assert printer.emulator.lines == printer.expected(lines)
+    assert all(printer.emulator.lines_packed)
+    # The reports are the plugin's, OctoPrint doesn't see them
+    assert not [response for response in printer.responses if b"[MP]" in response]
@@ -0,0 +1,16 @@
+# The packing engines have to produce the same bytes: the table engine as the classic one for ASCII, and the compiled
+# packer (block and mapped file packing included) as the table engine. Same check as "meatpack parity".
+import pytest
+import OctoPrint_MeatPack.meatpack as mp
+from OctoPrint_MeatPack.benchmark import check_parity
+
+
+# -------------------------------------------------------------------------------
+def test_table_matches_classic():
+    assert check_parity(mp.PackEngineTable, mp.PackEngineClassic, count=1000, random_lines=2000, seed=22) == []
+
+
+# -------------------------------------------------------------------------------
+@pytest.mark.skipif(mp._cpacker is None, reason="compiled packer not built")
+def test_native_matches_table():
+    assert check_parity(mp.PackEngineNative, mp.PackEngineTable, count=1000, random_lines=2000, seed=22) == []
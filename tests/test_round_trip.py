@@ -0,0 +1,235 @@
+# Round trips through the packers, the decoder and the files the plugin writes: packed files and packed streams with
+# their index (.mps/.mpx). Run with "python -m pytest tests".
+import os
+import threading
+import pytest
+import OctoPrint_MeatPack.meatpack as mp
+from OctoPrint_MeatPack.pack_cache import PackCache, PackCacheSidecarExtension
+from OctoPrint_MeatPack.packed_stream import (PackedStream, PackedStreamer, build_packed_stream, has_stream_index,
+                                              stream_index_path)
+from OctoPrint_MeatPack.unpacker import Unpacker, expected_unpacked, fuzz_round_trip, verify_packed_file
+
+GCODE = (b"; generated by a slicer\n"
+         b"M104 S210\n"
+         b"G28 ; home all axes\n"
+         b"\n"
+         b";LAYER:0\n"
+         b"G1 Z0.2 F3000\n"
+         b"G1 X10.5 Y20.25 E0.5\n"
+         b"G1 X11 Y21 E0.75 ; extrude\n"
+         b";LAYER:1\n"
+         b"G1 Z0.4\n"
+         b"   G1 X12.125 Y22.5 E1.0   \n"
+         b"M107\n")
+
+# Source lines of GCODE that are sent, as the firmware should get them
+SENT = [b"M104 S210", b"G28", b"G1 Z0.2 F3000", b"G1 X10.5 Y20.25 E0.5", b"G1 X11 Y21 E0.75", b"G1 Z0.4",
+        b"G1 X12.125 Y22.5 E1.0", b"M107"]
+
+# pack_file() output for GCODE. Without whitespace removal it's what the first, per-character packer wrote. With it,
+# the enable-no-spaces command word follows the enable-packing one, so the file decodes on a device left in its
+# default mode.
+PACKED_FILE = {
+    False: bytes.fromhex("fffffb1f4d40fb5312c02dc81d0f5a2a3f4600c01d1ea0f559022af545a0c51d1ef159120f457ac51d0f5a4acc1d1ea2"
+                         "21f559225a1f450acc1f4d70ccfffff9"),
+    True: bytes.fromhex("fffffbfffff71f4d40ff205312c02dc81d0f5a2a3f4600c01d1ea0f559022ab5a0c51d1ef159120b7ac51d0f5a4acc1d"
+                        "1ea221f559225a1b0acc1f4d70ccfffff9")
+}
+
+
+class _Logger:
+    def info(self, message):
+        pass
+
+
+@pytest.fixture
+def gcode_file(tmp_path):
+    filename = str(tmp_path / "part.gcode")
+    with open(filename, "wb") as out_file:
+        out_file.write(GCODE)
+    return filename
+
+
+@pytest.fixture
+def no_spaces_setting():
+    # pack_file() and iter_pack_file() follow the module-wide setting
+    yield mp.set_no_spaces
+    mp.set_no_spaces(False)
+
+
+# -------------------------------------------------------------------------------
+def test_fuzz_round_trip():
+    assert fuzz_round_trip(iterations=500, seed=8) == []
+
+
+# -------------------------------------------------------------------------------
+@pytest.mark.parametrize("line_ending", [b"\n", b"\r\n"])
+@pytest.mark.parametrize("no_spaces", [False, True])
+def test_packed_file_round_trip(tmp_path, no_spaces_setting, line_ending, no_spaces):
+    src = str(tmp_path / "part.gcode")
+    packed = str(tmp_path / "part.mp")
+    with open(src, "wb") as out_file:
+        out_file.write(GCODE.replace(b"\n", line_ending))
+    no_spaces_setting(no_spaces)
+    mp.pack_file(src, packed)
+
+    matches, count, offset = verify_packed_file(src, packed)
+    assert matches and offset is None
+    assert count > 0
+
+
+# -------------------------------------------------------------------------------
+@pytest.mark.parametrize("no_spaces", [False, True])
+def test_pack_file_output(tmp_path, no_spaces_setting, gcode_file, no_spaces):
+    packed = str(tmp_path / "part.mp")
+    no_spaces_setting(no_spaces)
+    mp.pack_file(gcode_file, packed)
+    with open(packed, "rb") as in_file:
+        assert in_file.read() == PACKED_FILE[no_spaces]
+    # The parallel packer writes the same bytes
+    mp.pack_file_parallel(gcode_file, packed, no_spaces, workers=2, chunk_size=32)
+    with open(packed, "rb") as in_file:
+        assert in_file.read() == PACKED_FILE[no_spaces]
+
+
+# -------------------------------------------------------------------------------
+@pytest.mark.parametrize("no_spaces", [False, True])
+def test_pack_file_lone_carriage_returns(tmp_path, no_spaces_setting, no_spaces):
+    # A lone \r ends a line, as it does when the file is read as text
+    src = str(tmp_path / "part.gcode")
+    packed = str(tmp_path / "part.mp")
+    with open(src, "wb") as out_file:
+        out_file.write(GCODE.replace(b"\n", b"\r", 5).replace(b"\n", b"\r\n", 3))
+    no_spaces_setting(no_spaces)
+    mp.pack_file(src, packed)
+
+    with open(src, "r") as in_file:
+        expected = b"".join(mp.iter_pack_file(in_file))
+    with open(packed, "rb") as in_file:
+        assert in_file.read() == expected
+
+
+# -------------------------------------------------------------------------------
+def _decode_stream(stream, first, last):
+    unpacker = Unpacker(active=True, no_spaces=stream.no_spaces)
+    lines = unpacker.feed(bytes(stream.block(first, last))).split(b"\n")
+    assert lines[-1] == b"" and not unpacker.pending
+    return lines[:-1]
+
+
+# -------------------------------------------------------------------------------
+@pytest.mark.parametrize("no_spaces", [False, True])
+def test_packed_stream_round_trip(tmp_path, gcode_file, no_spaces):
+    filename = str(tmp_path / "part.mps")
+    assert build_packed_stream(gcode_file, filename, no_spaces) == len(SENT)
+    assert has_stream_index(filename)
+    assert not os.path.exists(filename + ".tmp")
+
+    stream = PackedStream(filename)
+    try:
+        assert stream.lines == len(SENT)
+        assert stream.no_spaces == no_spaces
+
+        # Every line decodes to its numbered, checksummed source line, on its own and as one block
+        expected = [mp._unified_method_bytes(b"M110 N0\n", no_spaces).rstrip(b"\n")]
+        for number, line in enumerate(SENT, 1):
+            numbered = b"N%d %s" % (number, line)
+            expected.append(expected_unpacked(b"%s*%d\n" % (numbered, mp.line_checksum(numbered)),
+                                              no_spaces).rstrip(b"\n"))
+        assert _decode_stream(stream, 0, stream.lines + 1) == expected
+        for line in range(stream.lines + 1):
+            offset, size = stream.span(line)
+            assert offset == stream.offsets[line] and size > 0
+            assert _decode_stream(stream, line, line + 1) == [expected[line]]
+
+        # The index maps the source file to the stream
+        assert list(stream.layers) == [3, 6]
+        assert stream.layer_of(2) == -1 and stream.layer_of(3) == 0 and stream.layer_of(8) == 1
+        assert stream.resume_line() == 1
+        assert stream.resume_line(layer=1) == 6
+        # Source line 4 is blank and 5 a layer comment, both are sent with the next line sent, line 3
+        assert stream.resume_line(source_line=4) == 3
+        assert stream.resume_line(source_line=6) == 3
+        assert stream.resume_line(position=GCODE.index(b"G1 Z0.4")) == 6
+        assert stream.resume_line(position=len(GCODE)) == stream.lines + 1
+        with pytest.raises(ValueError):
+            stream.resume_line(layer=2)
+    finally:
+        stream.close()
+
+
+# -------------------------------------------------------------------------------
+def test_packed_streamer_answers_while_writing(tmp_path, gcode_file):
+    # A write that doesn't return (a full port) must not keep "ok"s, resend requests and host lines from getting in
+    filename = str(tmp_path / "part.mps")
+    build_packed_stream(gcode_file, filename)
+    writes = []
+    release = threading.Event()
+
+    def write(data):
+        writes.append(bytes(data))
+        if len(writes) == 1:
+            release.wait(5)
+
+    streamer = PackedStreamer(PackedStream(filename), write, lambda: True, window=2, max_bytes=1024)
+    streamer.start()
+    try:
+        while not writes:
+            release.wait(0.01)
+        assert streamer.on_response(b"Resend: 1")
+        assert streamer.on_ok()
+        # A host line is written once the stream's write is done
+        host = threading.Thread(target=streamer.write_host, args=(b"M105\n",))
+        host.start()
+        host.join(0.2)
+        assert host.is_alive() and len(writes) == 1
+        release.set()
+        host.join(5)
+        assert not host.is_alive() and b"M105\n" in writes
+        while streamer.running:
+            streamer.on_ok()
+            release.wait(0.01)
+        assert streamer.state == "done" and streamer.resends == 1
+    finally:
+        release.set()
+        streamer.cancel()
+        streamer.wait(5)
+
+
+# -------------------------------------------------------------------------------
+def test_packed_stream_build_failure_leaves_nothing(tmp_path, gcode_file, monkeypatch):
+    filename = str(tmp_path / "part.mps")
+
+    def failing_write_index(*args):
+        raise IOError("disk full")
+
+    monkeypatch.setattr("OctoPrint_MeatPack.packed_stream._write_index", failing_write_index)
+    with pytest.raises(IOError):
+        build_packed_stream(gcode_file, filename)
+    assert not os.path.exists(filename)
+    assert not os.path.exists(filename + ".tmp")
+    assert not os.path.exists(stream_index_path(filename))
+
+
+# -------------------------------------------------------------------------------
+def test_pack_cache_streams_and_eviction(tmp_path, gcode_file):
+    cache = PackCache(str(tmp_path / "cache"), _Logger())
+    # A sidecar left by an earlier version
+    sidecar = cache.path_for("0123abcd", False, PackCacheSidecarExtension)
+    with open(sidecar, "wb") as out_file:
+        out_file.write(b"\0" * 64)
+
+    first = cache.build_stream(gcode_file, "0123abcd", False)
+    assert first == cache.path_for("0123abcd", False)
+    assert not os.path.exists(sidecar)
+    stream = cache.open_stream("0123abcd", False)
+    assert stream is not None and stream.lines == len(SENT)
+    stream.close()
+    assert cache.open_stream("0123abcd", True) is None
+
+    # Only the most recently used stream fits
+    cache.max_bytes = os.path.getsize(first) + os.path.getsize(stream_index_path(first))
+    os.utime(first, (0, 0))
+    second = cache.build_stream(gcode_file, "4567ef01", False)
+    assert os.path.exists(second) and not os.path.exists(first)
+    assert not os.path.exists(stream_index_path(first))